@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# pyTroykaIMU acquisition scheduler
+# Polls every sensor of TroykaIMU at its own output data rate and returns fresh samples only
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   scheduler = AcquisitionScheduler(TroykaIMU())
+#   for name, timestamp, sample in scheduler.samples():
+#       print(name, sample)
+#
+#   engine = AcquisitionEngine(TroykaIMU())
+#   engine.start()
+#   timestamps, gyro = engine.latest('gyroscope', 100)
+#   engine.stop()
+
+import threading
+import time
+import numpy as np
+
+
+class AcquisitionScheduler(object):
+    # Если данные ещё не готовы, повторяем опрос через эту долю периода ODR
+    RETRY_FRACTION = 0.125
+    # Выключенный датчик (power-down или ONE SHOT) проверяем с этим периодом, с:
+    # после перенастройки на непрерывный режим опрос возобновится сам
+    IDLE_PERIOD = 0.5
+
+    sensors = ('gyroscope', 'accelerometer', 'magnetometer', 'barometer')
+
+    # raw=True - выдавать сырые значения регистров (для записи в журнал flightlog)
+    def __init__(self, imu, sensors=sensors, raw=False):
+        self.imu = imu
+        if raw:
+            self._readers = {
+                'gyroscope': imu.gyroscope.read_new_xyz,
+                'accelerometer': imu.accelerometer.read_new_xyz,
+                'magnetometer': imu.magnetometer.read_new_xyz,
+                'barometer': imu.barometer.read_new_raw,
+            }
+        else:
+            self._readers = {
+                'gyroscope': imu.gyroscope.read_new_radians_per_second_xyz,
+                'accelerometer': imu.accelerometer.read_new_gxyz,
+                'magnetometer': imu.magnetometer.read_new_calibrate_gauss_xyz,
+                'barometer': imu.barometer.read_new,
+            }
+        self.sensors = tuple(sensors)
+        self._drivers = dict((name, getattr(imu, name)) for name in self.sensors)
+        now = time.monotonic()
+        self._due = dict((name, now) for name in self.sensors)
+
+    def period(self, name):
+        rate = getattr(self.imu, name).data_rate_hz()
+        return 1.0 / rate if rate else None
+
+    def reschedule(self, *names):
+        # Опросить датчики (по умолчанию все) немедленно, например сразу после перенастройки ODR
+        now = time.monotonic()
+        for name in names or self.sensors:
+            self._due[name] = now
+
+    def dropped_samples(self):
+        return dict((name, getattr(self.imu, name).dropped_samples) for name in self.sensors)
+
+    def next_due(self):
+        due = [self._due[name] for name in self.sensors if self._due[name] is not None]
+        return min(due) if due else None
+
+    def poll(self):
+        # Опрашиваем датчики, у которых подошло время. Возвращает [(имя, метка времени нс, замер)]
+        now = time.monotonic()
+        samples = []
+        for name in self.sensors:
+            due = self._due[name]
+            if due is None or due > now:
+                continue
+            period = self.period(name)
+            if period is None:
+                # Датчик выключен или в режиме ONE SHOT: только проверяем, не включили ли его
+                self._due[name] = now + self.IDLE_PERIOD
+                continue
+            sample = self._readers[name]()
+            if sample is None:
+                self._due[name] = now + period * self.RETRY_FRACTION
+            else:
+                # Метка времени, которую драйвер поставил при чтении с готовыми данными
+                samples.append((name, self._drivers[name].timestamp, sample))
+                self._due[name] = max(due + period, now + period * self.RETRY_FRACTION)
+        return samples
+
+    def samples(self, duration=None):
+        # Генератор свежих замеров; между опросами спим до ближайшего срока
+        deadline = None if duration is None else time.monotonic() + duration
+        while deadline is None or time.monotonic() < deadline:
+            for sample in self.poll():
+                yield sample
+            due = self.next_due()
+            if due is None:
+                return
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class RingBuffer(object):
+    # Кольцевой буфер замеров с метками времени на заранее выделенных массивах
+    def __init__(self, capacity, width, dtype=np.float64):
+        self.capacity = capacity
+        self._data = np.zeros((capacity, width), dtype=dtype)
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        # Общее число записанных замеров; индекс в буфере - count % capacity
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def append(self, timestamp, values):
+        with self._condition:
+            index = self.count % self.capacity
+            self._timestamps[index] = timestamp
+            self._data[index] = values
+            self.count += 1
+            self._condition.notify_all()
+
+    def _slice(self, start, stop):
+        # Копия замеров с номерами start..stop-1 в хронологическом порядке
+        indices = np.arange(start, stop) % self.capacity
+        return self._timestamps[indices], self._data[indices]
+
+    def latest(self, n=1):
+        with self._condition:
+            n = min(n, self.count, self.capacity)
+            return self._slice(self.count - n, self.count)
+
+    def since(self, position):
+        # Замеры, записанные после position (значение count при прошлом чтении).
+        # Возвращает (новая позиция, метки времени, данные); то, что уже перезаписано, пропускается
+        with self._condition:
+            start = max(position, self.count - self.capacity)
+            timestamps, data = self._slice(start, self.count)
+            return self.count, timestamps, data
+
+    def wait(self, position, timeout=None):
+        # Блокируемся, пока count не станет больше position. Возвращает новое значение count
+        with self._condition:
+            self._condition.wait_for(lambda: self.count > position, timeout)
+            return self.count
+
+
+class AcquisitionEngine(object):
+    # Фоновый поток опроса датчиков на их ODR с записью в кольцевые буферы
+    widths = {
+        'gyroscope': 3,
+        'accelerometer': 3,
+        'magnetometer': 3,
+        'barometer': 2,
+    }
+
+    def __init__(self, imu, sensors=AcquisitionScheduler.sensors, capacity=4096, raw=False):
+        self.scheduler = AcquisitionScheduler(imu, sensors, raw)
+        self.buffers = dict((name, RingBuffer(capacity, self.widths[name])) for name in self.scheduler.sensors)
+        # Кортеж заменяется целиком, поэтому поток опроса обходит его без блокировок
+        self._listeners = ()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        # callback(name, timestamp, sample) вызывается в потоке опроса для каждого нового замера.
+        # Обработчик, выбросивший исключение, отключается, опрос для остальных продолжается
+        self._listeners += (callback,)
+
+    def remove_listener(self, callback):
+        self._listeners = tuple(listener for listener in self._listeners if listener != callback)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='AcquisitionEngine')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        scheduler = self.scheduler
+        buffers = self.buffers
+        while not self._stop.is_set():
+            for name, timestamp, sample in scheduler.poll():
+                buffers[name].append(timestamp, sample)
+                for callback in self._listeners:
+                    try:
+                        callback(name, timestamp, sample)
+                    except Exception as error:
+                        print('acquisition listener {!r} removed after error: {!r}'.format(callback, error))
+                        self.remove_listener(callback)
+            due = scheduler.next_due()
+            if due is None:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def latest(self, name, n=1):
+        return self.buffers[name].latest(n)
+
+    def wait(self, name, position, timeout=None):
+        return self.buffers[name].wait(position, timeout)
+
+    def dropped_samples(self):
+        return self.scheduler.dropped_samples()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Common control register handling of the TroykaIMU sensor drivers
+# Profile write with read-back verification, warm attach and shadow register synchronisation
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Драйвер задаёт:
+#   register        - карту регистров с 'CTRL_REG1'
+#   ctrl_registers  - имена регистров управления, идущих подряд с CTRL_REG1
+#   _ctrlReg1..N    - теневые значения этих регистров
+#   _address        - адрес на шине (или переопределяет ctrl_address)
+
+
+class CtrlRegisters(object):
+    ctrl_registers = ()
+
+    def ctrl_address(self):
+        return self._address
+
+    @classmethod
+    def range_conf(cls, sens_range):
+        # Биты диапазона для профиля; неизвестный диапазон - понятная ошибка вместо KeyError
+        if sens_range not in cls.adr_fs_conf:
+            raise ValueError('unsupported range {!r}, expected one of {}'.format(sens_range, cls.range_fs))
+        return cls.adr_fs_conf[sens_range]
+
+    def configure(self, profile):
+        # Записываем профиль одной транзакцией с автоинкрементом и проверяем чтением
+        values = [profile[name] for name in self.ctrl_registers]
+        self.wire.write_i2c_block_data(self.ctrl_address(), self.register['CTRL_REG1'] | (1 << 7), values)
+        return self.sync_ctrl_registers() == values
+
+    def warm_configure(self, profile):
+        # Подключение к уже работающему датчику без сброса: читаем CTRL_REG* одним блоком
+        # и переписываем только отличающиеся регистры
+        values = [profile[name] for name in self.ctrl_registers]
+        current = list(self.read_ctrl_registers())
+        changed = False
+        for name, value, actual in zip(self.ctrl_registers, values, current):
+            if value != actual:
+                self.wire.write_byte_data(self.ctrl_address(), self.register[name], value)
+                changed = True
+        self.warm_sync()
+        return self.sync_ctrl_registers(None if changed else current) == values
+
+    def warm_sync(self):
+        # Прочие настройки, которые сохранились на работающем датчике, но не входят в профиль
+        pass
+
+    def read_ctrl_registers(self):
+        return self.wire.read_i2c_block_data(self.ctrl_address(), self.register['CTRL_REG1'] | (1 << 7),
+                                             len(self.ctrl_registers))
+
+    def sync_ctrl_registers(self, values=None):
+        # Обновляем теневые _ctrlReg* и зависящие от них величины по фактическому состоянию датчика
+        if values is None:
+            values = self.read_ctrl_registers()
+        for i, value in enumerate(values):
+            setattr(self, '_ctrlReg{}'.format(i + 1), value)
+        self.sync_range()
+        return values
+
+    def sync_range(self):
+        # Множитель по битам диапазона в теневых регистрах
+        pass
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Discovery of TroykaIMU sensors with an on-disk cache
+# Scans the known sensor addresses, verifies WHO_AM_I and remembers address, chip id and the last applied
+# configuration per bus, so that restarts can skip probing and sensor resets
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   imu = open_imu(1)              # первый запуск: опрос адресов, сброс и запись кэша
+#   imu = open_imu(1)              # следующие: адреса и конфигурация из кэша, без опроса и сброса
+#
+#   print(scan(smbus.SMBus(1)))    # все датчики Troyka на шине
+
+import json
+import os
+from lis331dlh import LIS331DLH     # Акселерометр
+from l3g4200d import L3G4200D       # Гироскоп
+from lis3mdl import LIS3MDL         # Магнитометр
+from lps331ap import LPS331AP       # Барометр
+from pytroykaimu import TroykaIMU
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
+
+# Датчики и их возможные адреса (адрес по умолчанию первым)
+SENSORS = (
+    ('accelerometer', LIS331DLH, (0x18, 0x19)),
+    ('gyroscope', L3G4200D, (0x68, 0x69)),
+    ('magnetometer', LIS3MDL, (0x1C, 0x1E)),
+    ('barometer', LPS331AP, (LPS331AP.I2C_DEFAULT_ADDRESS_LOW, LPS331AP.I2C_DEFAULT_ADDRESS_HIGH)),
+)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'pytroykaimu', 'discovery.json')
+
+
+def read_chip_id(bus, address, driver):
+    # WHO_AM_I по адресу или None, если устройство не отвечает
+    try:
+        return bus.read_byte_data(address, driver.register['WHO_AM_I'])
+    except (IOError, OSError):
+        return None
+
+
+def scan(bus):
+    # Все датчики Troyka на шине: {имя: [{'address': адрес, 'chip_id': WHO_AM_I}, ...]}
+    found = {}
+    for name, driver, addresses in SENSORS:
+        for address in addresses:
+            chip_id = read_chip_id(bus, address, driver)
+            if chip_id == driver.I2C_IDENTITY:
+                found.setdefault(name, []).append({'address': address, 'chip_id': chip_id})
+    return found
+
+
+class DiscoveryCache(object):
+    # JSON файл: {номер шины: {имя датчика: {'address', 'chip_id', 'config'}}}
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, port):
+        return self.load().get(str(port))
+
+    def put(self, port, entries):
+        cache = self.load()
+        cache[str(port)] = entries
+        self._save(cache)
+
+    def invalidate(self, port):
+        cache = self.load()
+        if cache.pop(str(port), None) is not None:
+            self._save(cache)
+
+    def _save(self, cache):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Пишем во временный файл и переименовываем, чтобы параллельный запуск не прочитал половину файла
+        temporary = '{}.{}'.format(self.path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    @staticmethod
+    def validate(bus, entries):
+        # Кэш действителен, если по каждому адресу отвечает тот же датчик,
+        # а его регистры управления совпадают с последней записанной конфигурацией
+        drivers = dict((name, driver) for name, driver, addresses in SENSORS)
+        for name, entry in entries.items():
+            driver = drivers[name]
+            if read_chip_id(bus, entry['address'], driver) != entry['chip_id']:
+                return False
+            config = entry.get('config')
+            if config is None:
+                return False
+            try:
+                values = bus.read_i2c_block_data(entry['address'], driver.register['CTRL_REG1'] | (1 << 7),
+                                                 len(config))
+            except (IOError, OSError):
+                return False
+            if list(values) != config:
+                return False
+        return True
+
+
+def _entries(found):
+    # Для каждого датчика берём первый найденный адрес
+    return dict((name, dict(candidates[0])) for name, candidates in found.items())
+
+
+def discover(port=1, bus=None, cache=None):
+    # Адреса датчиков на шине. Возвращает (записи кэша, True если взяты из действительного кэша)
+    if bus is None:
+        bus = smbus.SMBus(port)
+    cache = cache if cache is not None else DiscoveryCache()
+    entries = cache.get(port)
+    if entries and DiscoveryCache.validate(bus, entries):
+        return entries, True
+    return _entries(scan(bus)), False
+
+
+def open_imu(port=1, bus=None, profiles=None, cache=None):
+    # TroykaIMU с адресами из кэша. Если кэш действителен, датчики уже работают: подключаемся
+    # без опроса и сброса, переписывая только отличающиеся от профилей регистры; затем кэш обновляется
+    if bus is None:
+        bus = smbus.SMBus(port)
+    cache = cache if cache is not None else DiscoveryCache()
+    entries, cached = discover(port, bus, cache)
+    addresses = dict((name, entry['address']) for name, entry in entries.items())
+    imu = TroykaIMU(port, bus=bus, profiles=profiles, addresses=addresses, warm=cached)
+    for name, entry in entries.items():
+        sensor = getattr(imu, name)
+        entry['config'] = [getattr(sensor, '_ctrlReg{}'.format(i + 1)) for i in range(len(sensor.ctrl_registers))]
+    cache.put(port, entries)
+    return imu
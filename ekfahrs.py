@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+    Multiplicative extended Kalman filter AHRS.
+    Nominal state: orientation quaternion and gyroscope bias; error state: 3 attitude angles (body frame)
+    and 3 gyroscope bias components with a 6x6 covariance. The gyroscope propagates the state at its own rate,
+    accelerometer and magnetometer corrections are applied whenever their samples arrive.
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+    You should have received a copy of the GNU Lesser General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import warnings
+from math import sqrt, sin, cos, atan2
+import numpy as np
+from madgwickahrs import MadgwickAHRS, _vector, _earth_field
+
+
+def _compose(q0, q1, q2, q3, r0, r1, r2, r3):
+    """
+    Normalised Hamilton product q * r of two quaternions given as floats
+    :return: w, x, y, z
+    """
+    w = q0 * r0 - q1 * r1 - q2 * r2 - q3 * r3
+    x = q0 * r1 + q1 * r0 + q2 * r3 - q3 * r2
+    y = q0 * r2 - q1 * r3 + q2 * r0 + q3 * r1
+    z = q0 * r3 + q1 * r2 - q2 * r1 + q3 * r0
+    norm = sqrt(w * w + x * x + y * y + z * z)
+    return w / norm, x / norm, y / norm, z / norm
+
+
+class EKFAHRS(object):
+    sample_period = 1 / 256
+    # Gyroscope angle random walk, rad/s/sqrt(Hz)
+    gyro_noise = 0.005
+    # Gyroscope bias random walk, rad/s^2/sqrt(Hz)
+    bias_noise = 0.0001
+    # Standard deviation of the normalised accelerometer and magnetometer directions
+    accel_noise = 0.05
+    mag_noise = 0.05
+    # Initial standard deviations of the attitude (rad) and the gyroscope bias (rad/s)
+    attitude_sigma = 0.5
+    bias_sigma = 0.05
+    # Timestamp of the previous step in nanoseconds (time.monotonic_ns())
+    timestamp = None
+    _q = (1.0, 0.0, 0.0, 0.0)
+
+    def __init__(self, sampleperiod=None, quaternion=None, gyro_noise=None, bias_noise=None, accel_noise=None,
+                 mag_noise=None):
+        """
+        Initialize the class with the given parameters.
+        :param sampleperiod: The sample period in seconds
+        :param quaternion: Initial quaternion
+        :param gyro_noise: Gyroscope angle random walk, rad/s/sqrt(Hz)
+        :param bias_noise: Gyroscope bias random walk, rad/s^2/sqrt(Hz)
+        :param accel_noise: Standard deviation of the normalised accelerometer measurement
+        :param mag_noise: Standard deviation of the normalised magnetometer measurement
+        :return:
+        """
+        if sampleperiod is not None:
+            self.sample_period = sampleperiod
+        if gyro_noise is not None:
+            self.gyro_noise = gyro_noise
+        if bias_noise is not None:
+            self.bias_noise = bias_noise
+        if accel_noise is not None:
+            self.accel_noise = accel_noise
+        if mag_noise is not None:
+            self.mag_noise = mag_noise
+        if quaternion is not None:
+            self.quaternion = quaternion
+        self.bias = np.zeros(3)
+        # Matrices are allocated once; every step works in place
+        self._p = np.zeros((6, 6))
+        self._phi = np.eye(6)
+        self._h = np.zeros((3, 6))
+        self._ph = np.zeros((6, 3))
+        self._s = np.zeros((3, 3))
+        self._s_inv = np.zeros((3, 3))
+        self._k = np.zeros((6, 3))
+        self._ks = np.zeros((6, 3))
+        self._t6 = np.zeros((6, 6))
+        self._y = np.zeros(3)
+        self._dx = np.zeros(6)
+        self._u = np.zeros(3)
+        self._pu = np.zeros(6)
+        self.reset_covariance()
+
+    quaternion = MadgwickAHRS.quaternion
+    step_period = MadgwickAHRS.step_period
+    stream = MadgwickAHRS.stream
+
+    def reset_covariance(self, attitude_sigma=None, bias_sigma=None):
+        """
+        Reset the error covariance to a diagonal matrix
+        :param attitude_sigma: Standard deviation of the attitude error, rad
+        :param bias_sigma: Standard deviation of the gyroscope bias, rad/s
+        """
+        attitude_sigma = self.attitude_sigma if attitude_sigma is None else attitude_sigma
+        bias_sigma = self.bias_sigma if bias_sigma is None else bias_sigma
+        self._p[:] = 0
+        self._p[0:3, 0:3] = np.eye(3) * attitude_sigma ** 2
+        self._p[3:6, 3:6] = np.eye(3) * bias_sigma ** 2
+
+    @property
+    def covariance(self):
+        """
+        Error state covariance: attitude error (rad, body frame) and gyroscope bias (rad/s)
+        :return: A copy of the 6x6 covariance matrix
+        """
+        return self._p.copy()
+
+    @property
+    def attitude_sigma_xyz(self):
+        """
+        Standard deviations of the attitude error around the body axes, rad
+        :return: x, y, z
+        """
+        return tuple(np.sqrt(np.diag(self._p)[0:3]).tolist())
+
+    def propagate(self, gyroscope, dt=None, timestamp=None):
+        """
+        Propagate the state and the covariance with one gyroscope sample
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        """
+        dt = self.step_period(dt, timestamp)
+        gx, gy, gz = _vector(gyroscope)
+        bx, by, bz = self.bias.tolist()
+        wx = gx - bx
+        wy = gy - by
+        wz = gz - bz
+
+        # Nominal state: q = q * exp(0.5 * w * dt)
+        rate = sqrt(wx * wx + wy * wy + wz * wz)
+        angle = rate * dt
+        if angle > 0:
+            s = sin(angle / 2) / rate
+            q0, q1, q2, q3 = self._q
+            self._q = _compose(q0, q1, q2, q3, cos(angle / 2), wx * s, wy * s, wz * s)
+
+        # Error state transition: d(attitude)/dt = -[w x] attitude - bias
+        phi = self._phi
+        phi[0, 1] = wz * dt
+        phi[0, 2] = -wy * dt
+        phi[1, 0] = -wz * dt
+        phi[1, 2] = wx * dt
+        phi[2, 0] = wy * dt
+        phi[2, 1] = -wx * dt
+        phi[0, 3] = phi[1, 4] = phi[2, 5] = -dt
+        np.dot(phi, self._p, out=self._t6)
+        np.dot(self._t6, phi.T, out=self._p)
+        attitude_noise = self.gyro_noise ** 2 * dt
+        bias_noise = self.bias_noise ** 2 * dt
+        for i in range(3):
+            self._p[i, i] += attitude_noise
+            self._p[i + 3, i + 3] += bias_noise
+
+    def correct_accel(self, accelerometer):
+        """
+        Correct roll and pitch with an accelerometer sample
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :return: False if the measurement was rejected
+        """
+        ax, ay, az = _vector(accelerometer)
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if norm == 0:
+            warnings.warn("accelerometer is zero")
+            return False
+        q0, q1, q2, q3 = self._q
+        # Expected direction of gravity in the sensor frame
+        vx = 2 * (q1 * q3 - q0 * q2)
+        vy = 2 * (q0 * q1 + q2 * q3)
+        vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+        self._correct(ax / norm, ay / norm, az / norm, vx, vy, vz, self.accel_noise)
+        return True
+
+    def correct_mag(self, magnetometer):
+        """
+        Correct the heading with a magnetometer sample. Only the rotation around the earth vertical (expressed
+        in the sensor frame) is observed and corrected, so the correction does not disturb roll and pitch
+        :param magnetometer: A three-element array containing the magnetometer data.
+        :return: False if the measurement was rejected
+        """
+        mx, my, mz = _vector(magnetometer)
+        norm = sqrt(mx * mx + my * my + mz * mz)
+        if norm == 0:
+            warnings.warn("magnetometer is zero")
+            return False
+        mx /= norm
+        my /= norm
+        mz /= norm
+        q0, q1, q2, q3 = self._q
+        hx, hy, hz = _earth_field(q0, q1, q2, q3, mx, my, mz)
+        bx = sqrt(hx * hx + hy * hy)
+        if bx < 1e-6:
+            # The field is vertical: it carries no heading information
+            return False
+        # Expected direction of the field (bx, 0, hz) in the sensor frame
+        wx = 2 * bx * (0.5 - q2 * q2 - q3 * q3) + 2 * hz * (q1 * q3 - q0 * q2)
+        wy = 2 * bx * (q1 * q2 - q0 * q3) + 2 * hz * (q0 * q1 + q2 * q3)
+        wz = 2 * bx * (q0 * q2 + q1 * q3) + 2 * hz * (0.5 - q1 * q1 - q2 * q2)
+        # Earth vertical in the sensor frame
+        ux = 2 * (q1 * q3 - q0 * q2)
+        uy = 2 * (q0 * q1 + q2 * q3)
+        uz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+        # Heading innovation: signed angle around the vertical between the horizontal projections
+        # of the predicted and the measured field
+        sine = ux * (my * wz - mz * wy) + uy * (mz * wx - mx * wz) + uz * (mx * wy - my * wx)
+        cosine = mx * wx + my * wy + mz * wz - (mx * ux + my * uy + mz * uz) * (wx * ux + wy * uy + wz * uz)
+        # Direction noise becomes angle noise inversely to the horizontal component of the field
+        self._correct_heading(ux, uy, uz, atan2(sine, cosine), (self.mag_noise / bx) ** 2)
+        return True
+
+    def _correct(self, mx, my, mz, px, py, pz, noise):
+        """
+        Kalman update with a measured direction m and the predicted direction p = R.T * reference.
+        For the error q_true = q * dq(theta) the measurement Jacobian is [p x] for the attitude and 0 for the bias
+        """
+        h = self._h
+        h[0, 1] = -pz
+        h[0, 2] = py
+        h[1, 0] = pz
+        h[1, 2] = -px
+        h[2, 0] = -py
+        h[2, 1] = px
+        p = self._p
+        # S = H P H.T + R, K = P H.T S^-1
+        np.dot(p, h.T, out=self._ph)
+        np.dot(h, self._ph, out=self._s)
+        r = noise ** 2
+        self._s[0, 0] += r
+        self._s[1, 1] += r
+        self._s[2, 2] += r
+        self._invert_s()
+        np.dot(self._ph, self._s_inv, out=self._k)
+        y = self._y
+        y[0] = mx - px
+        y[1] = my - py
+        y[2] = mz - pz
+        dx = np.dot(self._k, y, out=self._dx)
+
+        # P = P - K S K.T, kept symmetric
+        np.dot(self._k, self._s, out=self._ks)
+        np.dot(self._ks, self._k.T, out=self._t6)
+        p -= self._t6
+        np.add(p, p.T, out=self._t6)
+        np.multiply(self._t6, 0.5, out=p)
+
+        self._inject(dx)
+
+    def _correct_heading(self, ux, uy, uz, angle, r):
+        """
+        Scalar Kalman update of the attitude error around the vertical u (sensor frame): H = [u.T, 0].
+        The attitude part of the gain is projected onto u, so correlations in P cannot tilt the estimate;
+        the covariance is updated in Joseph form, which stays valid for the modified gain
+        """
+        u = self._u
+        u[0] = ux
+        u[1] = uy
+        u[2] = uz
+        p = self._p
+        pu = np.dot(p[:, 0:3], u, out=self._pu)
+        s = ux * pu[0] + uy * pu[1] + uz * pu[2] + r
+        k = np.multiply(pu, 1 / s, out=self._dx)
+        along = ux * k[0] + uy * k[1] + uz * k[2]
+        k[0] = ux * along
+        k[1] = uy * along
+        k[2] = uz * along
+
+        # P = (I - K H) P (I - K H).T + K r K.T = P - K (P H.T).T - (P H.T) K.T + s K K.T
+        t = self._t6
+        np.outer(k, pu, out=t)
+        p -= t
+        p -= t.T
+        np.outer(k, k, out=t)
+        t *= s
+        p += t
+        np.add(p, p.T, out=t)
+        np.multiply(t, 0.5, out=p)
+
+        np.multiply(k, angle, out=k)
+        self._inject(k)
+
+    def _inject(self, dx):
+        # Error state (attitude angles, bias) into the nominal state: q = q * dq(attitude / 2)
+        ex, ey, ez, dbx, dby, dbz = dx.tolist()
+        q0, q1, q2, q3 = self._q
+        self._q = _compose(q0, q1, q2, q3, 1.0, ex / 2, ey / 2, ez / 2)
+        self.bias[0] += dbx
+        self.bias[1] += dby
+        self.bias[2] += dbz
+
+    def _invert_s(self):
+        # Inverse of the symmetric 3x3 innovation covariance via the adjugate
+        a, b, c = self._s[0].tolist()
+        d, e, f = self._s[1].tolist()
+        g, h, i = self._s[2].tolist()
+        c00 = e * i - f * h
+        c01 = c * h - b * i
+        c02 = b * f - c * e
+        determinant = a * c00 + d * c01 + g * c02
+        s = self._s_inv
+        s[0, 0] = c00 / determinant
+        s[0, 1] = c01 / determinant
+        s[0, 2] = c02 / determinant
+        s[1, 0] = (f * g - d * i) / determinant
+        s[1, 1] = (a * i - c * g) / determinant
+        s[1, 2] = (c * d - a * f) / determinant
+        s[2, 0] = (d * h - e * g) / determinant
+        s[2, 1] = (b * g - a * h) / determinant
+        s[2, 2] = (a * e - b * d) / determinant
+
+    def update(self, gyroscope, accelerometer, magnetometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a AHRS sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param magnetometer: A three-element array containing the magnetometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        :return:
+        """
+        self.propagate(gyroscope, dt, timestamp)
+        self.correct_accel(accelerometer)
+        self.correct_mag(magnetometer)
+
+    def update_imu(self, gyroscope, accelerometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a IMU sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        """
+        self.propagate(gyroscope, dt, timestamp)
+        self.correct_accel(accelerometer)
@@ -1,7 +1,6 @@
 from socket import *
 from madgwickahrs import MadgwickAHRS
 from pytroykaimu import TroykaIMU
-import time
 import datetime
 
 # Адрес
@@ -40,14 +39,15 @@ def main():
             # Время ожидания данных от клиента
             tcpCliSock.settimeout(5)
             print_log('connection from: ' + str(addr))
+            # После паузы на ожидание клиента не интегрируем большой интервал
+            imufilter.timestamp = None
 
             # Соединились, передаем данные
             while True:
-                start_time = time.clock()
-
-                imufilter.update(imu.gyroscope.read_radians_per_second_xyz(),
-                              imu.accelerometer.read_gxyz(),
-                              imu.magnetometer.read_calibrate_gauss_xyz())
+                # Все датчики одним запросом с общей меткой времени:
+                # период шага фильтра считается по разнице меток
+                sample = imu.read_all()
+                imufilter.update(sample.gyro, sample.accel, sample.mag, timestamp=sample.timestamp)
 
                 data = imufilter.quaternion
                 dataencode = str(data).encode('utf-8').ljust(128, b' ')
@@ -69,8 +69,6 @@ def main():
                     # тут включить контроль fps
                     #time.sleep(0.05)
 
-                imufilter.sample_period = 50 / (time.clock() - start_time)
-                print(imufilter.sample_period)
         except KeyboardInterrupt:
             # Закрываем сервер
             print_log('Server was closed')
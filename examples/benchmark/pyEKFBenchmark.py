@@ -0,0 +1,52 @@
+# Время шага EKFAHRS: прогноз по гироскопу на каждом замере, коррекция по акселерометру
+# и магнитометру на их собственной, меньшей частоте. Для сравнения - шаг MadgwickAHRS и MahonyAHRS
+import time
+import numpy as np
+from ekfahrs import EKFAHRS
+from madgwickahrs import MadgwickAHRS
+from mahonyahrs import MahonyAHRS
+
+STEPS = 5000
+# Делители частоты: гироскоп 800 Гц, акселерометр 100 Гц, магнитометр 80 Гц
+ACCEL_DIVIDER = 8
+MAG_DIVIDER = 10
+
+
+def samples(steps):
+    random = np.random.RandomState(1)
+    t = np.arange(steps) / 800.0
+    gyro = np.column_stack((0.3 * np.sin(t), 0.2 * np.cos(0.7 * t), 0.5 + 0.1 * np.sin(0.3 * t)))
+    accel = np.column_stack((0.1 * np.sin(t), -0.05 * np.cos(t), np.ones(steps))) + random.normal(0, 0.01, (steps, 3))
+    mag = np.column_stack((0.3 * np.cos(0.5 * t), 0.3 * np.sin(0.5 * t), -0.4 * np.ones(steps)))
+    mag += random.normal(0, 0.005, (steps, 3))
+    return gyro.tolist(), accel.tolist(), mag.tolist()
+
+
+def timed(function, *columns):
+    start = time.perf_counter()
+    for values in zip(*columns):
+        function(*values)
+    return (time.perf_counter() - start) / len(columns[0]) * 1e6
+
+
+gyro, accel, mag = samples(STEPS)
+ekf = EKFAHRS(sampleperiod=1 / 800.0)
+print('EKFAHRS.propagate      {:6.1f} us'.format(timed(ekf.propagate, gyro)))
+print('EKFAHRS.correct_accel  {:6.1f} us'.format(timed(ekf.correct_accel, accel)))
+print('EKFAHRS.correct_mag    {:6.1f} us'.format(timed(ekf.correct_mag, mag)))
+print('EKFAHRS.update         {:6.1f} us'.format(timed(ekf.update, gyro, accel, mag)))
+
+# Датчики с собственными частотами: в среднем на шаг гироскопа
+ekf = EKFAHRS(sampleperiod=1 / 800.0)
+start = time.perf_counter()
+for i, g in enumerate(gyro):
+    ekf.propagate(g)
+    if i % ACCEL_DIVIDER == 0:
+        ekf.correct_accel(accel[i])
+    if i % MAG_DIVIDER == 0:
+        ekf.correct_mag(mag[i])
+print('EKFAHRS native rates   {:6.1f} us per gyroscope sample, attitude sigma {} rad'.format(
+    (time.perf_counter() - start) / STEPS * 1e6, ', '.join('{:.4f}'.format(s) for s in ekf.attitude_sigma_xyz)))
+
+print('MadgwickAHRS.update    {:6.1f} us'.format(timed(MadgwickAHRS(beta=0.1).update, gyro, accel, mag)))
+print('MahonyAHRS.update      {:6.1f} us'.format(timed(MahonyAHRS().update, gyro, accel, mag)))
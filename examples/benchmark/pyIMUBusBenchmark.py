@@ -0,0 +1,32 @@
+# Оценка пропускной способности цикла чтения без Raspberry Pi
+# на виртуальной шине с моделью задержек I2C 100/400 кГц
+from pytroykaimu import TroykaIMU
+from virtualbus import troyka_bus
+
+LOOPS = 2000
+# накладные расходы ядра на одну транзакцию, с
+OVERHEAD = 0.00005
+
+
+def separate_reads(imu):
+    imu.gyroscope.read_radians_per_second_xyz()
+    imu.accelerometer.read_gxyz()
+    imu.magnetometer.read_calibrate_gauss_xyz()
+
+
+def snapshot(imu):
+    imu.read_all()
+
+
+for speed in (100000, 400000):
+    for name, loop in (('separate reads', separate_reads), ('read_all', snapshot)):
+        bus = troyka_bus(speed=speed, overhead=OVERHEAD)
+        imu = TroykaIMU(bus=bus)
+        imu.magnetometer.calibrate_matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [0, 0, 0])
+        transactions, busy_time, start = bus.transactions, bus.busy_time, bus.now()
+        for i in range(LOOPS):
+            loop(imu)
+        elapsed = bus.now() - start
+        print('{:>6} kHz  {:<15} {:8.1f} loops/s  {:5.2f} transactions/loop  bus busy {:5.1f}%'.format(
+            speed // 1000, name, LOOPS / elapsed, (bus.transactions - transactions) / float(LOOPS),
+            100 * (bus.busy_time - busy_time) / elapsed))
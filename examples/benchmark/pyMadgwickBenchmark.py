@@ -0,0 +1,198 @@
+# Сравнение скорости и результатов MadgwickAHRS с прежней реализацией на numpy
+# (объекты Quaternion и массивы numpy на каждом шаге), которая оставлена здесь как эталон
+import time
+import warnings
+import numpy as np
+from numpy.linalg import norm
+from madgwickahrs import MadgwickAHRS
+from quaternion import Quaternion
+
+STEPS = 5000
+
+
+class ReferenceMadgwickAHRS(MadgwickAHRS):
+    # Атрибут класса перекрывает свойство quaternion: эталон хранит состояние в объекте Quaternion
+    quaternion = Quaternion(1, 0, 0, 0)
+
+    def update(self, gyroscope, accelerometer, magnetometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a AHRS sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param magnetometer: A three-element array containing the magnetometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        :return:
+        """
+        dt = self.step_period(dt, timestamp)
+        q = self.quaternion
+
+        gyroscope = np.array(gyroscope, dtype=float).flatten()
+        accelerometer = np.array(accelerometer, dtype=float).flatten()
+        magnetometer = np.array(magnetometer, dtype=float).flatten()
+
+        # Normalise accelerometer measurement
+        if norm(accelerometer) == 0:
+            warnings.warn("accelerometer is zero")
+            return
+        accelerometer /= norm(accelerometer)
+
+        # Normalise magnetometer measurement
+        if norm(magnetometer) == 0:
+            warnings.warn("magnetometer is zero")
+            return
+        magnetometer /= norm(magnetometer)
+
+        h = q * (Quaternion(0, magnetometer[0], magnetometer[1], magnetometer[2]) * q.conj())
+        b = np.array([0, norm(h[1:3]), 0, h[3]])
+
+        # Gradient descent algorithm corrective step
+        f = np.array([
+            2 * (q[1] * q[3] - q[0] * q[2]) - accelerometer[0],
+            2 * (q[0] * q[1] + q[2] * q[3]) - accelerometer[1],
+            2 * (0.5 - q[1] ** 2 - q[2] ** 2) - accelerometer[2],
+            2 * b[1] * (0.5 - q[2] ** 2 - q[3] ** 2) + 2 * b[3] * (q[1] * q[3] - q[0] * q[2]) - magnetometer[0],
+            2 * b[1] * (q[1] * q[2] - q[0] * q[3]) + 2 * b[3] * (q[0] * q[1] + q[2] * q[3]) - magnetometer[1],
+            2 * b[1] * (q[0] * q[2] + q[1] * q[3]) + 2 * b[3] * (0.5 - q[1] ** 2 - q[2] ** 2) - magnetometer[2]
+        ])
+        j = np.array([
+            [-2 * q[2], 2 * q[3], -2 * q[0], 2 * q[1]],
+            [2 * q[1], 2 * q[0], 2 * q[3], 2 * q[2]],
+            [0, -4 * q[1], -4 * q[2], 0],
+            [-2 * b[3] * q[2], 2 * b[3] * q[3], -4 * b[1] * q[2] - 2 * b[3] * q[0], -4 * b[1] * q[3] + 2 * b[3] * q[1]],
+            [-2 * b[1] * q[3] + 2 * b[3] * q[1], 2 * b[1] * q[2] + 2 * b[3] * q[0], 2 * b[1] * q[1] + 2 * b[3] * q[3],
+             -2 * b[1] * q[0] + 2 * b[3] * q[2]],
+            [2 * b[1] * q[2], 2 * b[1] * q[3] - 4 * b[3] * q[1], 2 * b[1] * q[0] - 4 * b[3] * q[2], 2 * b[1] * q[1]]
+        ])
+        step = j.T.dot(f)
+        step /= norm(step)  # normalise step magnitude
+
+        # Compute rate of change of quaternion
+        qdot = (q * Quaternion(0, gyroscope[0], gyroscope[1], gyroscope[2])) * 0.5 - self.beta * step.T
+
+        # Integrate to yield quaternion
+        q += qdot * dt
+        self.quaternion = Quaternion(q / norm(q))  # normalise quaternion
+
+    def update_imu(self, gyroscope, accelerometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a IMU sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        """
+        dt = self.step_period(dt, timestamp)
+        q = self.quaternion
+
+        gyroscope = np.array(gyroscope, dtype=float).flatten()
+        accelerometer = np.array(accelerometer, dtype=float).flatten()
+
+        # Normalise accelerometer measurement
+        if norm(accelerometer) == 0:
+            warnings.warn("accelerometer is zero")
+            return
+        accelerometer /= norm(accelerometer)
+
+        # Gradient descent algorithm corrective step
+        f = np.array([
+            2 * (q[1] * q[3] - q[0] * q[2]) - accelerometer[0],
+            2 * (q[0] * q[1] + q[2] * q[3]) - accelerometer[1],
+            2 * (0.5 - q[1] ** 2 - q[2] ** 2) - accelerometer[2]
+        ])
+        j = np.array([
+            [-2 * q[2], 2 * q[3], -2 * q[0], 2 * q[1]],
+            [2 * q[1], 2 * q[0], 2 * q[3], 2 * q[2]],
+            [0, -4 * q[1], -4 * q[2], 0]
+        ])
+        step = j.T.dot(f)
+        step /= norm(step)  # normalise step magnitude
+
+        # Compute rate of change of quaternion
+        qdot = (q * Quaternion(0, gyroscope[0], gyroscope[1], gyroscope[2])) * 0.5 - self.beta * step.T
+
+        # Integrate to yield quaternion
+        q += qdot * dt
+        self.quaternion = Quaternion(q / norm(q))  # normalise quaternion
+
+
+def samples(steps):
+    # Медленное вращение вокруг наклонной оси с шумом датчиков
+    random = np.random.RandomState(1)
+    t = np.arange(steps) / 256.0
+    gyro = np.column_stack((0.3 * np.sin(t), 0.2 * np.cos(0.7 * t), 0.5 + 0.1 * np.sin(0.3 * t)))
+    accel = np.column_stack((0.1 * np.sin(t), -0.05 * np.cos(t), np.ones(steps))) + random.normal(0, 0.01, (steps, 3))
+    mag = np.column_stack((0.3 * np.cos(0.5 * t), 0.3 * np.sin(0.5 * t), -0.4 * np.ones(steps)))
+    mag += random.normal(0, 0.005, (steps, 3))
+    return gyro.tolist(), accel.tolist(), mag.tolist()
+
+
+def run(ahrs, gyro, accel, mag, imu):
+    trajectory = []
+    start = time.perf_counter()
+    if imu:
+        for g, a in zip(gyro, accel):
+            ahrs.update_imu(g, a)
+            trajectory.append(ahrs.quaternion.q)
+    else:
+        for g, a, m in zip(gyro, accel, mag):
+            ahrs.update(g, a, m)
+            trajectory.append(ahrs.quaternion.q)
+    elapsed = time.perf_counter() - start
+    return np.array(trajectory, dtype=float), elapsed
+
+
+gyro, accel, mag = samples(STEPS)
+# Первый вызов компилирует ядра, если установлена numba
+MadgwickAHRS().update(gyro[0], accel[0], mag[0])
+MadgwickAHRS().update_imu(gyro[0], accel[0])
+MadgwickAHRS().update_batch(gyro[:1], accel[:1], mag[:1])
+MadgwickAHRS().update_imu_batch(gyro[:1], accel[:1])
+for imu in (False, True):
+    reference, reference_time = run(ReferenceMadgwickAHRS(beta=0.1), gyro, accel, mag, imu)
+    fused, fused_time = run(MadgwickAHRS(beta=0.1), gyro, accel, mag, imu)
+    # Чистое время шага без чтения ориентации
+    ahrs = MadgwickAHRS(beta=0.1)
+    start = time.perf_counter()
+    if imu:
+        for g, a in zip(gyro, accel):
+            ahrs.update_imu(g, a)
+    else:
+        for g, a, m in zip(gyro, accel, mag):
+            ahrs.update(g, a, m)
+    step_time = time.perf_counter() - start
+    print('{:<10} reference {:8.0f} updates/s  fused {:8.0f} updates/s ({:8.0f} without reading quaternion)  '
+          'x{:.1f}  max difference {:.1e}'.format('update_imu' if imu else 'update', STEPS / reference_time,
+                                                  STEPS / fused_time, STEPS / step_time,
+                                                  reference_time / step_time, np.abs(reference - fused).max()))
+    # Пакетная обработка массива замеров
+    start = time.perf_counter()
+    if imu:
+        batch = MadgwickAHRS(beta=0.1).update_imu_batch(gyro, accel)
+    else:
+        batch = MadgwickAHRS(beta=0.1).update_batch(gyro, accel, mag)
+    batch_time = time.perf_counter() - start
+    print('{:<10} batch     {:8.0f} updates/s  x{:.1f}  max difference {:.1e}'.format(
+        'update_imu' if imu else 'update', STEPS / batch_time, reference_time / batch_time,
+        np.abs(reference - batch).max()))
+
+# Раздельные шаги: propagate на каждом замере гироскопа, коррекции с частотой акселерометра и магнитометра
+ahrs = MadgwickAHRS(beta=0.1)
+ahrs.propagate(gyro[0])
+ahrs.correct_accel(accel[0])
+ahrs.correct_mag(mag[0])
+start = time.perf_counter()
+for g in gyro:
+    ahrs.propagate(g)
+propagate_time = time.perf_counter() - start
+ahrs = MadgwickAHRS(beta=0.1)
+start = time.perf_counter()
+for i, g in enumerate(gyro):
+    ahrs.propagate(g)
+    if i % 8 == 0:
+        ahrs.correct_accel(accel[i])
+    if i % 10 == 0:
+        ahrs.correct_mag(mag[i])
+multirate_time = time.perf_counter() - start
+print('{:<10} {:8.0f} updates/s  gyroscope with accelerometer/8, magnetometer/10 {:8.0f} updates/s'.format(
+    'propagate', STEPS / propagate_time, STEPS / multirate_time))
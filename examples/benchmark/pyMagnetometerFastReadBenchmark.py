@@ -0,0 +1,25 @@
+# Сравнение времени шины для чтения магнитометра LIS3MDL
+# в обычном режиме (6 байт) и в режиме FAST_READ (3 старших байта)
+from lis3mdl import LIS3MDL
+from virtualbus import VirtualSMBus, LIS3MDLRegisters, constant
+
+READS = 5000
+# накладные расходы ядра на одну транзакцию, с
+OVERHEAD = 0.00005
+
+for speed in (100000, 400000):
+    bus = VirtualSMBus(speed=speed, overhead=OVERHEAD)
+    bus.attach(LIS3MDL.I2C_DEFAULT_ADDRESS, LIS3MDLRegisters(constant(3000, 2000, -1000)))
+    magnetometer = LIS3MDL(bus=bus)
+    magnetometer.calibrate_matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [1, 1, 1])
+    results = []
+    for fast in (False, True):
+        magnetometer.fast_read(fast)
+        busy_time = bus.busy_time
+        for i in range(READS):
+            magnetometer.read_xyz()
+        results.append((bus.busy_time - busy_time) / READS)
+        heading = magnetometer.read_azimut()
+        print('{:>4} kHz  FAST_READ={:<5}  {:6.1f} us/read  azimuth {:6.2f}'.format(
+            speed // 1000, str(fast), results[-1] * 1e6, heading))
+    print('          bus time saving: {:.0f}%'.format(100 * (1 - results[1] / results[0])))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Binary flight log for raw and processed TroykaIMU streams
+# Fixed header with channel table, followed by fixed-size 16 byte records:
+#   int64 timestamp (ns) | uint8 channel | uint8 flags | 6 bytes of data (int16 x 3 or raw register block)
+# Flags: FLAG_NO_TEMPERATURE - the barometer record carries a fresh pressure without a fresh temperature
+# The reader memory-maps the file and exposes the columns of the whole log as numpy views without copying.
+# Channels are interleaved in write order, so selecting one channel gathers its records into a copy
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример записи:
+#   imu = TroykaIMU()
+#   log = FlightLogWriter('flight.imu', imu_channels(imu))
+#   engine = AcquisitionEngine(imu, raw=True)
+#   engine.add_listener(log.listener)
+#   engine.start()
+#   ...
+#   engine.stop()
+#   log.close()
+#
+# Пример чтения:
+#   log = FlightLogReader('flight.imu')
+#   timestamps, gyro = log.scaled('gyroscope')     # рад/с
+
+import mmap
+import struct
+from collections import namedtuple
+import numpy as np
+from rawframes import decode_pressure_temperature
+
+MAGIC = b'TIMULOG\x00'
+VERSION = 1
+HEADER_SIZE = 1024
+
+# Формат данных канала
+LAYOUT_XYZ = 0          # три int16: сырые значения датчика
+LAYOUT_PRESSURE = 1     # блок LPS331AP: 24 бита давления и int16 температуры
+LAYOUT_QUATERNION = 2   # векторная часть единичного кватерниона (w >= 0) в int16
+
+# Флаги записи
+FLAG_NO_TEMPERATURE = 1     # LPS331AP: новое давление без новой температуры (T_DA не установлен)
+
+# name - имя канала; scale - перевод в физические единицы (raw * scale);
+# mult - множитель драйвера (_mult) для точного воспроизведения его вычислений
+Channel = namedtuple('Channel', 'name layout scale mult')
+
+RECORD = np.dtype({
+    'names': ['timestamp', 'channel', 'flags', 'raw', 'bytes'],
+    'formats': ['<i8', 'u1', 'u1', ('<i2', (3,)), ('u1', (6,))],
+    'offsets': [0, 8, 9, 10, 10],
+    'itemsize': 16,
+})
+
+_HEADER = struct.Struct('<8sHHHH')
+_CHANNEL = struct.Struct('<16sB7xdd')
+MAX_CHANNELS = (HEADER_SIZE - _HEADER.size) // _CHANNEL.size
+
+QUATERNION_SCALE = 1 / 32767.0
+
+
+def imu_channels(imu, measure=None):
+    # Каналы сырых данных всех датчиков TroykaIMU с текущими множителями драйверов
+    barometer = imu.barometer
+    pressure_measure = barometer.pressure_measure[measure or barometer.DEFAULT_PRESSURE_MEASURE]
+    return [
+        Channel('gyroscope', LAYOUT_XYZ, imu.gyroscope._mult * imu.gyroscope.DEG_TO_RAD, imu.gyroscope._mult),
+        Channel('accelerometer', LAYOUT_XYZ, imu.accelerometer._mult, imu.accelerometer._mult),
+        Channel('magnetometer', LAYOUT_XYZ, 1.0 / imu.magnetometer._mult, imu.magnetometer._mult),
+        Channel('barometer', LAYOUT_PRESSURE, 1.0 / pressure_measure, pressure_measure),
+    ]
+
+
+class FlightLogWriter(object):
+    _xyz = struct.Struct('<qBx3h')
+    _pressure = struct.Struct('<qBBHBhx')
+
+    def __init__(self, path, channels, buffering=1 << 20):
+        if len(channels) > MAX_CHANNELS:
+            raise ValueError('Too many channels, maximum is {}'.format(MAX_CHANNELS))
+        self.channels = list(channels)
+        self._index = dict((channel.name, i) for i, channel in enumerate(self.channels))
+        self._file = open(path, 'wb', buffering=buffering)
+        header = bytearray(HEADER_SIZE)
+        _HEADER.pack_into(header, 0, MAGIC, VERSION, HEADER_SIZE, RECORD.itemsize, len(self.channels))
+        for i, channel in enumerate(self.channels):
+            _CHANNEL.pack_into(header, _HEADER.size + i * _CHANNEL.size, channel.name.encode('ascii'),
+                               channel.layout, channel.scale, channel.mult)
+        self._file.write(header)
+        # Готовые упаковщики по номеру канала, чтобы не ветвиться на каждой записи
+        self._writers = [self._writer(channel.layout) for channel in self.channels]
+
+    def _writer(self, layout):
+        write = self._file.write
+        if layout == LAYOUT_XYZ:
+            pack = self._xyz.pack
+            return lambda index, timestamp, values: write(pack(timestamp, index, values[0], values[1], values[2]))
+        if layout == LAYOUT_PRESSURE:
+            pack = self._pressure.pack
+            def write_pressure(index, timestamp, values):
+                if values[1] is None:
+                    write(pack(timestamp, index, FLAG_NO_TEMPERATURE, values[0] & 0xffff, values[0] >> 16 & 0xff, 0))
+                else:
+                    write(pack(timestamp, index, 0, values[0] & 0xffff, values[0] >> 16 & 0xff, values[1]))
+            return write_pressure
+        if layout == LAYOUT_QUATERNION:
+            pack = self._xyz.pack
+
+            def write_quaternion(index, timestamp, values):
+                sign = -1 if values[0] < 0 else 1
+                write(pack(timestamp, index, int(round(sign * values[1] * 32767)),
+                           int(round(sign * values[2] * 32767)), int(round(sign * values[3] * 32767))))
+            return write_quaternion
+        raise ValueError('Unknown channel layout {}'.format(layout))
+
+    def write(self, name, timestamp, values):
+        # values - сырые значения (x, y, z), (давление, температура) или кватернион (w, x, y, z)
+        index = self._index[name]
+        self._writers[index](index, timestamp, values)
+
+    def write_frames(self, name, timestamps, frames):
+        # Пакетная запись массива (N, 3) int16 кадров, например из rawframes.decode_xyz
+        records = np.zeros(len(timestamps), dtype=RECORD)
+        records['timestamp'] = timestamps
+        records['channel'] = self._index[name]
+        records['raw'] = frames
+        self._file.write(records.tobytes())
+
+    def listener(self, name, timestamp, sample):
+        # Обработчик для AcquisitionEngine(imu, raw=True).add_listener
+        if name in self._index:
+            self.write(name, timestamp, sample)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FlightLogReader(object):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size, record_size, count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or record_size != RECORD.itemsize:
+            self.close()
+            raise ValueError('{} is not a flight log'.format(path))
+        self.version = version
+        self.channels = []
+        for i in range(count):
+            name, layout, scale, mult = _CHANNEL.unpack_from(self._mmap, _HEADER.size + i * _CHANNEL.size)
+            self.channels.append(Channel(name.rstrip(b'\x00').decode('ascii'), layout, scale, mult))
+        self._index = dict((channel.name, i) for i, channel in enumerate(self.channels))
+        # Незаконченная последняя запись (например, при обрыве питания) отбрасывается
+        records = (len(self._mmap) - header_size) // record_size
+        self.records = np.frombuffer(self._mmap, dtype=RECORD, count=records, offset=header_size)
+        # Номера записей каждого канала: журнал просматривается один раз на канал
+        self._positions = {}
+
+    # Столбцы всего журнала - представления без копирования
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @property
+    def channel_ids(self):
+        return self.records['channel']
+
+    @property
+    def raw(self):
+        return self.records['raw']
+
+    def __len__(self):
+        return len(self.records)
+
+    def channel_positions(self, name):
+        index = self._index[name]
+        if index not in self._positions:
+            self._positions[index] = np.flatnonzero(self.channel_ids == index)
+        return self._positions[index]
+
+    def channel_records(self, name):
+        # Записи одного канала. Каналы в журнале чередуются в порядке записи, поэтому это копия
+        # (16 байт на запись канала), а не представление. Без копирования - только журнал из одного канала
+        # или столбцы всего журнала (timestamps, channel_ids, raw) вместе с channel_positions
+        positions = self.channel_positions(name)
+        if len(positions) == len(self.records):
+            return self.records
+        return self.records.take(positions)
+
+    def channel(self, name):
+        # Метки времени и сырые значения канала. У барометра температура - float64 с NaN там,
+        # где в записи не было новой температуры
+        records = self.channel_records(name)
+        layout = self.channels[self._index[name]].layout
+        if layout == LAYOUT_PRESSURE:
+            pressure, temperature = decode_pressure_temperature(
+                np.ascontiguousarray(records['bytes'][:, :5]).tobytes())
+            temperature = temperature.astype(np.float64)
+            temperature[(records['flags'] & FLAG_NO_TEMPERATURE) != 0] = np.nan
+            return records['timestamp'], pressure, temperature
+        return records['timestamp'], records['raw']
+
+    def scaled(self, name):
+        # Метки времени и значения канала в физических единицах
+        channel = self.channels[self._index[name]]
+        if channel.layout == LAYOUT_PRESSURE:
+            timestamps, pressure, temperature = self.channel(name)
+            return timestamps, np.column_stack((pressure * channel.scale, temperature / 480 + 42.5))
+        timestamps, raw = self.channel(name)
+        values = raw * channel.scale
+        if channel.layout == LAYOUT_QUATERNION:
+            w = np.sqrt(np.clip(1 - (values ** 2).sum(axis=1), 0, None))
+            values = np.column_stack((w, values))
+        return timestamps, values
+
+    def close(self):
+        self.records = None
+        self._positions = {}
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Представления ещё используются: отображение освободится вместе с ними
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+# I2C transaction profiler for TroykaIMU drivers
+# Wraps the wire object of the drivers and counts transactions, bytes and latency per sensor and register.
+# Nothing is wrapped until attach() is called, so drivers run without overhead when profiling is off
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   imu = TroykaIMU()
+#   profiler = I2CProfiler(speed=400000, dump_on_exit='i2c_profile.json')
+#   profiler.attach(imu)
+#   ...
+#   print(profiler.summary())
+#   profiler.detach()
+
+import atexit
+import json
+import threading
+import time
+
+# Гистограмма задержек: корзина k содержит задержки от 2^(k-1) до 2^k мкс
+HISTOGRAM_BUCKETS = 24
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * (HISTOGRAM_BUCKETS + 1)
+
+    def add(self, latency_ns):
+        self.count += 1
+        self.total_ns += latency_ns
+        if latency_ns > self.max_ns:
+            self.max_ns = latency_ns
+        self.buckets[min((latency_ns // 1000).bit_length(), HISTOGRAM_BUCKETS)] += 1
+
+    def percentile(self, fraction):
+        # Верхняя граница корзины, в которую попадает заданная доля замеров, мкс
+        threshold = fraction * self.count
+        accumulated = 0
+        for bucket, count in enumerate(self.buckets):
+            accumulated += count
+            if count and accumulated >= threshold:
+                return 1 << bucket
+        return 0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total_ns / 1000.0 / self.count if self.count else 0.0,
+            'max_us': self.max_ns / 1000.0,
+            'p50_us': self.percentile(0.5),
+            'p99_us': self.percentile(0.99),
+            'buckets_us': dict(('<{}'.format(1 << bucket), count)
+                               for bucket, count in enumerate(self.buckets) if count),
+        }
+
+
+class ProfiledBus(object):
+    # Обёртка объекта шины с интерфейсом smbus.SMBus; остальные атрибуты берутся у исходной шины
+    def __init__(self, wire, profiler):
+        self.wire = wire
+        self.profiler = profiler
+        # i2c_rdwr есть только у шин, которые его поддерживают (smbus2): иначе hasattr(bus, 'i2c_rdwr')
+        # у обёртки отличался бы от исходной шины и профилировщик менял бы путь чтения в read_all
+        if hasattr(wire, 'i2c_rdwr'):
+            self.i2c_rdwr = self._i2c_rdwr
+
+    def __getattr__(self, name):
+        return getattr(self.wire, name)
+
+    def read_byte_data(self, address, reg):
+        start = time.perf_counter_ns()
+        value = self.wire.read_byte_data(address, reg)
+        self.profiler.record('read_byte_data', address, reg, 1, 4, 2, start)
+        return value
+
+    def read_word_data(self, address, reg):
+        start = time.perf_counter_ns()
+        value = self.wire.read_word_data(address, reg)
+        self.profiler.record('read_word_data', address, reg, 2, 5, 2, start)
+        return value
+
+    def read_i2c_block_data(self, address, reg, length=32):
+        start = time.perf_counter_ns()
+        values = self.wire.read_i2c_block_data(address, reg, length)
+        self.profiler.record('read_i2c_block_data', address, reg, length, 3 + length, 2, start)
+        return values
+
+    def write_byte_data(self, address, reg, value):
+        start = time.perf_counter_ns()
+        self.wire.write_byte_data(address, reg, value)
+        self.profiler.record('write_byte_data', address, reg, 1, 3, 1, start)
+
+    def write_i2c_block_data(self, address, reg, values):
+        start = time.perf_counter_ns()
+        self.wire.write_i2c_block_data(address, reg, values)
+        self.profiler.record('write_i2c_block_data', address, reg, len(values), 2 + len(values), 1, start)
+
+    def _i2c_rdwr(self, *messages):
+        start = time.perf_counter_ns()
+        self.wire.i2c_rdwr(*messages)
+        self.profiler.record_rdwr(messages, start)
+
+
+class I2CProfiler(object):
+    # speed - частота шины, Гц: по ней оценивается время занятости шины
+    # dump_on_exit - путь к JSON файлу или True (вывод в консоль) для сохранения отчёта при выходе
+    def __init__(self, speed=400000, dump_on_exit=None):
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._names = {}
+        self._registers = {}
+        self._drivers = []
+        self.reset()
+        self._dump_on_exit = dump_on_exit
+        self._exit_hook = False
+        self._register_exit_hook()
+
+    def _register_exit_hook(self):
+        if self._dump_on_exit and not self._exit_hook:
+            atexit.register(self.dump, None if self._dump_on_exit is True else self._dump_on_exit)
+            self._exit_hook = True
+
+    def reset(self):
+        with self._lock:
+            # (датчик, регистр) -> [транзакции, байты данных]
+            self.transfers = {}
+            self.latency = {}
+            self.bus_clocks = 0
+            self.transactions = 0
+            self._start = time.perf_counter_ns()
+
+    def attach(self, *targets):
+        # targets - TroykaIMU или отдельные драйверы датчиков
+        wrapped = {}
+        self._register_exit_hook()
+        for target in targets:
+            drivers = [(name, getattr(target, name)) for name in
+                       ('gyroscope', 'accelerometer', 'magnetometer', 'barometer') if hasattr(target, name)]
+            if not drivers:
+                drivers = [(type(target).__name__, target)]
+            for name, driver in drivers:
+                address = getattr(driver, '_address', getattr(driver, '_addr', None))
+                self._names[address] = name
+                self._registers[address] = dict((reg, register) for register, reg in driver.register.items())
+                wire = driver.wire
+                if isinstance(wire, ProfiledBus) and wire.profiler is self:
+                    # Драйвер уже подключён: повторная обёртка осталась бы на нём после detach
+                    continue
+                # Общая шина оборачивается один раз; обёртка другого профилировщика остаётся внутри
+                if id(wire) not in wrapped:
+                    wrapped[id(wire)] = ProfiledBus(wire, self)
+                self._drivers.append((driver, wire))
+                driver.wire = wrapped[id(wire)]
+        return self
+
+    def detach(self):
+        # Возвращаем исходные шины в обратном порядке и снимаем сохранение отчёта при выходе
+        for driver, wire in reversed(self._drivers):
+            driver.wire = wire
+        self._drivers = []
+        if self._exit_hook:
+            atexit.unregister(self.dump)
+            self._exit_hook = False
+
+    def record(self, method, address, reg, length, bus_bytes, starts, start):
+        latency = time.perf_counter_ns() - start
+        key = (self._names.get(address, hex(address)), self._register_name(address, reg))
+        with self._lock:
+            transfer = self.transfers.get(key)
+            if transfer is None:
+                transfer = self.transfers[key] = [0, 0]
+            transfer[0] += 1
+            transfer[1] += length
+            histogram = self.latency.get(method)
+            if histogram is None:
+                histogram = self.latency[method] = LatencyHistogram()
+            histogram.add(latency)
+            # 9 тактов на байт (8 бит + ACK) и 2 такта на START/STOP, как в virtualbus
+            self.bus_clocks += bus_bytes * 9 + starts * 2
+            self.transactions += 1
+
+    def record_rdwr(self, messages, start):
+        # Несколько сообщений одной транзакцией I2C_RDWR: байты учитываются по датчикам,
+        # задержка - одна на всю транзакцию
+        latency = time.perf_counter_ns() - start
+        registers = {}
+        with self._lock:
+            for message in messages:
+                if message.flags & 0x1:
+                    key = (self._names.get(message.addr, hex(message.addr)),
+                           self._register_name(message.addr, registers.get(message.addr, 0)))
+                    transfer = self.transfers.get(key)
+                    if transfer is None:
+                        transfer = self.transfers[key] = [0, 0]
+                    transfer[0] += 1
+                    transfer[1] += message.len
+                else:
+                    registers[message.addr] = list(message)[0]
+            histogram = self.latency.get('i2c_rdwr')
+            if histogram is None:
+                histogram = self.latency['i2c_rdwr'] = LatencyHistogram()
+            histogram.add(latency)
+            self.bus_clocks += sum(1 + message.len for message in messages) * 9 + len(messages) * 2
+            self.transactions += 1
+
+    def _register_name(self, address, reg):
+        # Бит автоинкремента (MSB) в имени регистра не учитывается
+        registers = self._registers.get(address, {})
+        return registers.get(reg & 0x7f, registers.get(reg, hex(reg)))
+
+    def elapsed(self):
+        return (time.perf_counter_ns() - self._start) * 1e-9
+
+    def bus_time(self):
+        # Оценка времени занятости шины передачей, с
+        return self.bus_clocks / float(self.speed)
+
+    def utilization(self):
+        # Доля времени, в течение которой шина передавала данные
+        elapsed = self.elapsed()
+        return self.bus_time() / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        with self._lock:
+            sensors = {}
+            for (sensor, register), (count, length) in sorted(self.transfers.items()):
+                entry = sensors.setdefault(sensor, {'transactions': 0, 'bytes': 0, 'registers': {}})
+                entry['transactions'] += count
+                entry['bytes'] += length
+                entry['registers'][register] = {'transactions': count, 'bytes': length}
+            return {
+                'elapsed_s': self.elapsed(),
+                'speed_hz': self.speed,
+                'transactions': self.transactions,
+                'bus_time_s': self.bus_time(),
+                'utilization': self.utilization(),
+                'sensors': sensors,
+                'latency': dict((method, histogram.as_dict()) for method, histogram in self.latency.items()),
+            }
+
+    def summary(self):
+        report = self.report()
+        lines = ['I2C: {transactions} transactions in {elapsed_s:.3f} s, bus busy {bus_time_s:.4f} s '
+                 '({utilization:.1%} of {speed_hz} Hz)'.format(**report)]
+        for sensor, entry in sorted(report['sensors'].items()):
+            lines.append('  {:<14} {:>8} transactions {:>10} bytes'.format(sensor, entry['transactions'],
+                                                                            entry['bytes']))
+            for register, counters in sorted(entry['registers'].items()):
+                lines.append('    {:<18} {:>8} transactions {:>10} bytes'.format(register, counters['transactions'],
+                                                                                   counters['bytes']))
+        for method, histogram in sorted(report['latency'].items()):
+            lines.append('  {:<20} n={count} mean={mean_us:.1f} us p50<{p50_us} us p99<{p99_us} us '
+                         'max={max_us:.1f} us'.format(method, **histogram))
+        return '\n'.join(lines)
+
+    def dump(self, path=None):
+        if path is None:
+            print(self.summary())
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
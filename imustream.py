@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# asyncio streaming of TroykaIMU samples
+# Bus I/O runs in the AcquisitionEngine thread, samples are fanned out to any number of async consumers
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   async def main():
+#       imu = TroykaIMU()
+#       async for timestamp, gyro in imu.stream('gyroscope'):
+#           print(timestamp, gyro)
+
+import asyncio
+from acquisition import AcquisitionEngine
+from pytroykaimu import IMUSample
+
+
+class Broadcast(object):
+    # Раздача элементов всем подписчикам через ограниченные очереди.
+    # При переполнении очереди подписчика выбрасывается самый старый элемент
+    def __init__(self):
+        self._queues = set()
+        self.dropped = 0
+
+    def publish(self, item):
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(item)
+
+    async def subscribe(self, maxsize=64):
+        queue = asyncio.Queue(maxsize)
+        self._queues.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._queues.discard(queue)
+
+    @property
+    def subscribers(self):
+        return len(self._queues)
+
+
+class IMUStream(object):
+    # Мост между потоком AcquisitionEngine и событийным циклом asyncio.
+    # Канал 'imu' выдаёт IMUSample на каждый замер гироскопа с последними значениями
+    # акселерометра и магнитометра
+    channels = tuple(AcquisitionEngine.widths)
+
+    def __init__(self, imu, engine=None):
+        self.imu = imu
+        self.engine = engine if engine is not None else AcquisitionEngine(imu)
+        self._broadcasts = {}
+        self._loop = None
+        self._latest = {}
+        # Число активных подписок; поток опроса работает, пока есть хотя бы одна
+        self._subscribers = 0
+        # True, если движок запустил этот поток (внешний запущенный движок не останавливаем)
+        self._owns_engine = False
+        self.engine.add_listener(self._on_sample)
+
+    def _broadcast(self, channel):
+        if channel not in self._broadcasts:
+            if channel != 'imu' and channel not in self.channels:
+                raise ValueError('Unknown channel {}'.format(channel))
+            self._broadcasts[channel] = Broadcast()
+        return self._broadcasts[channel]
+
+    def _on_sample(self, name, timestamp, sample):
+        # Вызывается в потоке опроса: передаём замер в событийный цикл
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._publish, name, timestamp, sample)
+        except RuntimeError:
+            # Событийный цикл уже закрыт
+            self._loop = None
+
+    def _publish(self, name, timestamp, sample):
+        self._latest[name] = sample
+        broadcast = self._broadcasts.get(name)
+        if broadcast is not None:
+            broadcast.publish((timestamp, sample))
+        imu_broadcast = self._broadcasts.get('imu')
+        if name == 'gyroscope' and imu_broadcast is not None:
+            if 'accelerometer' in self._latest and 'magnetometer' in self._latest:
+                imu_broadcast.publish(IMUSample(timestamp, sample, self._latest['accelerometer'],
+                                                self._latest['magnetometer']))
+
+    async def subscribe(self, channel, maxsize=64):
+        broadcast = self._broadcast(channel)
+        self._loop = asyncio.get_running_loop()
+        if self._subscribers == 0 and not self.engine.running:
+            self.engine.start()
+            self._owns_engine = True
+        self._subscribers += 1
+        try:
+            async for item in broadcast.subscribe(maxsize):
+                yield item
+        finally:
+            # Последний подписчик отписался или его итератор закрыт: шину больше не опрашиваем
+            self._subscribers -= 1
+            if self._subscribers == 0 and self._owns_engine:
+                self._owns_engine = False
+                self.engine.stop()
+
+    def stop(self):
+        self._owns_engine = False
+        self.engine.stop()
@@ -19,10 +19,26 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
 
-import smbus
+import time
+from ctrlregisters import CtrlRegisters
 
+try:
+    import smbus
+except ImportError:
+    smbus = None
+try:
+    # smbus2 читает FIFO целиком одной транзакцией I2C_RDWR, без ограничения SMBus в 32 байта
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
+try:
+    # Векторный разбор кадров нужен только для чтения FIFO массивом numpy
+    from rawframes import decode_xyz
+except ImportError:
+    decode_xyz = None
 
-class L3G4200D(object):
+
+class L3G4200D(CtrlRegisters):
     register = {
         'WHO_AM_I'          : 0x0F,
         'CTRL_REG1'         : 0x20,
@@ -69,6 +85,26 @@ class L3G4200D(object):
         '2000'              : 0.07,
     }
 
+    # CTRL_REG1 DR1 DR0: частота выдачи данных
+    output_data_rate = {
+        '100Hz'             : 0b00,
+        '200Hz'             : 0b01,
+        '400Hz'             : 0b10,
+        '800Hz'             : 0b11,
+    }
+
+    # FIFO_CTRL_REG FM2 FM1 FM0 WTM4 WTM3 WTM2 WTM1 WTM0
+    fifo_mode = {
+        'BYPASS'            : 0b000,
+        'FIFO'              : 0b001,
+        'STREAM'            : 0b010,
+        'STREAM_TO_FIFO'    : 0b011,
+        'BYPASS_TO_STREAM'  : 0b100,
+    }
+
+    # Регистры управления, записываемые одной транзакцией
+    ctrl_registers = ('CTRL_REG1', 'CTRL_REG2', 'CTRL_REG3', 'CTRL_REG4', 'CTRL_REG5')
+
     # Default
     I2C_DEFAULT_ADDRESS = 0b01101000
     I2C_IDENTITY = 0xD3
@@ -80,32 +116,65 @@ class L3G4200D(object):
     _ctrlReg3 = 0
     _ctrlReg4 = 0
     _ctrlReg5 = 0
+    _fifoCtrlReg = 0
+    _last_sample_ns = None
+    dropped_samples = 0
+    # Время последнего чтения данных, time.monotonic_ns()
+    timestamp = None
     # Additional constants
     DEG_TO_RAD = 0.0175
+    FIFO_SIZE = 32
+    # SMBus block transfer is limited to 32 bytes: 5 samples of 6 bytes
+    FIFO_SAMPLES_PER_BLOCK = 5
 
     def __init__(self, port=1,
                  address=I2C_DEFAULT_ADDRESS,
-                 sens_range=range_fs[0]):
-        # Подключаемся к шине I2C
-        self.wire = smbus.SMBus(port)
+                 sens_range=range_fs[0],
+                 bus=None,
+                 profile=None,
+                 reset=True,
+                 warm=False):
+        # Подключаемся к шине I2C (или к переданной шине, например VirtualSMBus)
+        self.wire = bus if bus is not None else smbus.SMBus(port)
         # Запоминаем адрес
         self._addr = address
-        # Сбрасываем все регистры по умолчанию
-        self.reboot()
-        # Устанавливаем чувствительность
-        self.set_range(sens_range)
-        # Влючаем
-        self.enable()
-        # x axis enable
-        self.axis_x(True)
-        # y axis enable
-        self.axis_y(True)
-        # z axis enable
-        self.axis_z(True)
+        # Сбрасываем все регистры по умолчанию (reset=False - датчик уже проверен кэшем discovery)
+        if reset and not warm:
+            self.reboot()
+        # Чувствительность, включение и оси X, Y, Z записываем одной транзакцией
+        if profile is None:
+            profile = self.profile(sens_range)
+        configure = self.warm_configure if warm else self.configure
+        if not configure(profile):
+            print('cannot configure device in address ', self._addr)
 
     def identity(self):
         return self.wire.read_byte_data(self._addr, self.register['WHO_AM_I']) == self.I2C_IDENTITY
 
+    # Профиль конфигурации: итоговые значения CTRL_REG1..CTRL_REG5
+    @classmethod
+    def profile(cls, sens_range=range_fs[0], power=True, axis_x=True, axis_y=True, axis_z=True,
+                data_rate=output_data_rate['100Hz']):
+        return {
+            'CTRL_REG1': (data_rate << 6) | (power << 3) | (axis_z << 2) | (axis_y << 1) | axis_x,
+            'CTRL_REG2': 0,
+            'CTRL_REG3': 0,
+            'CTRL_REG4': cls.range_conf(sens_range),
+            'CTRL_REG5': 0,
+        }
+
+    def ctrl_address(self):
+        return self._addr
+
+    def warm_sync(self):
+        # Режим FIFO после сброса не восстанавливается профилем: берём его теневое значение с датчика
+        self._fifoCtrlReg = self.wire.read_byte_data(self._addr, self.register['FIFO_CTRL_REG'])
+
+    def sync_range(self):
+        for sens_range, conf in self.adr_fs_conf.items():
+            if self._ctrlReg4 & 0x30 == conf:
+                self._mult = self.sens_fs[sens_range]
+
     # Register 1 operations
     # CtrlReg1  - DR1 DR0 BW1 BW0 PD Zen Yen Xen
     # Power-Down mode
@@ -117,6 +186,19 @@ class L3G4200D(object):
             self._ctrlReg1 &= ~(1 << 3)
         self.wire.write_byte_data(self._addr, self.register['CTRL_REG1'], self._ctrlReg1)
 
+    # Data rate selection. Default value: 00 (100 Hz; Others: 200, 400, 800 Hz)
+    def set_output_data_rate(self, rate=output_data_rate['100Hz']):
+        self._ctrlReg1 &= 0x3f
+        self._ctrlReg1 |= (rate << 6)
+        self.wire.write_byte_data(self._addr, self.register['CTRL_REG1'], self._ctrlReg1)
+
+    # Текущая частота выдачи данных, Гц (0 - power-down)
+    # DR1 DR0: 100, 200, 400, 800 Hz
+    def data_rate_hz(self):
+        if not self._ctrlReg1 & (1 << 3):
+            return 0
+        return (100, 200, 400, 800)[self._ctrlReg1 >> 6]
+
     # X axis enable. Default value: 1 (0: X axis disabled; 1: X axis enabled)
     def axis_x(self, enable=True):
         if enable:
@@ -155,17 +237,153 @@ class L3G4200D(object):
         # Reboot memory content. Default value: 0 (0: normal mode; 1: reboot memory content)
         self.wire.write_byte_data(self._addr, self.register['CTRL_REG5'], self._ctrlReg5 | (1 << 7))
 
+    # FIFO enable. Default value: 0 (0: FIFO disable; 1: FIFO Enable)
+    def fifo_enable(self, enable=True):
+        if enable:
+            self._ctrlReg5 |= (1 << 6)
+        else:
+            self._ctrlReg5 &= ~(1 << 6)
+        self.wire.write_byte_data(self._addr, self.register['CTRL_REG5'], self._ctrlReg5)
+
+    # FIFO_CTRL_REG operations
+    # FM2 FM1 FM0 WTM4 WTM3 WTM2 WTM1 WTM0
+    # FIFO mode selection. Default value: 000 (BYPASS). Watermark level 0..31
+    def set_fifo_mode(self, mode=fifo_mode['STREAM'], watermark=0):
+        self._fifoCtrlReg = (mode << 5) | (watermark & 0x1f)
+        self.wire.write_byte_data(self._addr, self.register['FIFO_CTRL_REG'], self._fifoCtrlReg)
+
+    # Включаем FIFO в режиме STREAM: датчик копит до 32 замеров, старые перезаписываются
+    def fifo_stream(self, enable=True, watermark=0):
+        if enable:
+            self.set_fifo_mode(self.fifo_mode['STREAM'], watermark)
+            self.fifo_enable(True)
+        else:
+            self.fifo_enable(False)
+            self.set_fifo_mode(self.fifo_mode['BYPASS'])
+
+    # FIFO_SRC_REG
+    # WTM OVRN EMPTY FSS4 FSS3 FSS2 FSS1 FSS0
+    def read_fifo_source(self):
+        return self.wire.read_byte_data(self._addr, self.register['FIFO_SRC_REG'])
+
+    # Количество непрочитанных замеров в FIFO (0..32)
+    def read_fifo_level(self):
+        source = self.read_fifo_source()
+        if source & (1 << 5):
+            return 0
+        if source & (1 << 6):
+            # FIFO заполнен целиком, FSS показывает 31
+            return self.FIFO_SIZE
+        return source & 0x1f
+
+    def read_fifo_frames(self, count=None):
+        # Читаем все накопленные замеры блоками. При включенном FIFO адрес OUT_Z_H
+        # автоматически переходит обратно на OUT_X_L, поэтому несколько замеров
+        # читаются одной транзакцией. Возвращает сырые кадры по 6 байт подряд
+        if count is None:
+            count = self.read_fifo_level()
+        if count > 0 and i2c_msg is not None and hasattr(self.wire, 'i2c_rdwr'):
+            # I2C_RDWR не ограничен 32 байтами: весь FIFO одним чтением
+            read = i2c_msg.read(self._addr, count * 6)
+            self.wire.i2c_rdwr(i2c_msg.write(self._addr, [self.register['OUT_X_L'] | (1 << 7)]), read)
+            self.timestamp = time.monotonic_ns()
+            return bytearray(list(read))
+        frames = bytearray()
+        while count > 0:
+            chunk = min(count, self.FIFO_SAMPLES_PER_BLOCK)
+            frames += bytearray(self.wire.read_i2c_block_data(self._addr, self.register['OUT_X_L'] | (1 << 7),
+                                                              chunk * 6))
+            count -= chunk
+        self.timestamp = time.monotonic_ns()
+        return frames
+
+    # Метки времени замеров, прочитанных из FIFO, восстановленные по ODR:
+    # последний замер считаем сделанным в момент чтения, предыдущие - с шагом 1/ODR
+    def fifo_timestamps(self, count, end=None):
+        if end is None:
+            end = self.timestamp
+        rate = self.data_rate_hz()
+        period = int(1e9 / rate) if rate else 0
+        return [end - (count - 1 - i) * period for i in range(count)]
+
+    def read_fifo_xyz(self, count=None):
+        values = self.read_fifo_frames(count)
+        return [(self.signed_int32(values[i + 1] << 8 | values[i]),
+                 self.signed_int32(values[i + 3] << 8 | values[i + 2]),
+                 self.signed_int32(values[i + 5] << 8 | values[i + 4])) for i in range(0, len(values), 6)]
+
+    # FIFO целиком как массив (N, 3) рад/с
+    def read_fifo_radians_per_second_array(self, count=None):
+        if decode_xyz is None:
+            # rawframes работает на numpy; остальной драйвер без него обходится
+            raise ImportError("numpy is required for read_fifo_radians_per_second_array")
+        return self.convert_radians_per_second(decode_xyz(self.read_fifo_frames(count)))
+
+    def read_fifo_degrees_per_second_xyz(self, count=None):
+        return [(x * self._mult, y * self._mult, z * self._mult) for x, y, z in self.read_fifo_xyz(count)]
+
+    def read_fifo_radians_per_second_xyz(self, count=None):
+        return [(x * self._mult * self.DEG_TO_RAD, y * self._mult * self.DEG_TO_RAD, z * self._mult * self.DEG_TO_RAD)
+                for x, y, z in self.read_fifo_xyz(count)]
+
     def read_axis(self, reg):
         # assert MSB to enable register address auto increment
-        return self.signed_int32(self.wire.read_word_data(self._addr, reg | (1 << 7)))
+        value = self.signed_int32(self.wire.read_word_data(self._addr, reg | (1 << 7)))
+        self.timestamp = time.monotonic_ns()
+        return value
 
     def read_xyz(self):
         # assert MSB to enable register address auto increment
         values = self.wire.read_i2c_block_data(self._addr, self.register['OUT_X_L'] | (1 << 7), 6)
+        self.timestamp = time.monotonic_ns()
         return (self.signed_int32(values[1] << 8 | values[0]),
                 self.signed_int32(values[3] << 8 | values[2]),
                 self.signed_int32(values[5] << 8 | values[4]))
 
+    # STATUS_REG
+    # ZYXOR ZOR YOR XOR ZYXDA ZDA YDA XDA
+    def read_status(self):
+        return self.wire.read_byte_data(self._addr, self.register['STATUS_REG'])
+
+    def data_ready(self):
+        return bool(self.read_status() & (1 << 3))
+
+    def read_new_xyz(self):
+        # STATUS_REG и OUT_X_L..OUT_Z_H идут подряд: статус и данные читаем одной транзакцией.
+        # Возвращает None, если новых данных нет; при переполнении (ZYXOR) считаем пропущенные замеры
+        values = self.wire.read_i2c_block_data(self._addr, self.register['STATUS_REG'] | (1 << 7), 7)
+        status = values[0]
+        if not status & (1 << 3):
+            return None
+        now = self.timestamp = time.monotonic_ns()
+        if status & (1 << 7):
+            self.dropped_samples += self._missed_samples(now)
+        self._last_sample_ns = now
+        return (self.signed_int32(values[2] << 8 | values[1]),
+                self.signed_int32(values[4] << 8 | values[3]),
+                self.signed_int32(values[6] << 8 | values[5]))
+
+    def _missed_samples(self, now):
+        # Оценка числа перезаписанных замеров по времени с последнего чтения
+        rate = self.data_rate_hz()
+        if self._last_sample_ns is None or not rate:
+            return 1
+        return max(1, int(round((now - self._last_sample_ns) * 1e-9 * rate)) - 1)
+
+    def read_new_radians_per_second_xyz(self):
+        values = self.read_new_xyz()
+        if values is not None:
+            return (values[0] * self._mult * self.DEG_TO_RAD,
+                    values[1] * self._mult * self.DEG_TO_RAD,
+                    values[2] * self._mult * self.DEG_TO_RAD)
+
+    # Пакетный перевод массива сырых кадров (N, 3) из rawframes.decode_xyz одной векторной операцией
+    def convert_degrees_per_second(self, frames):
+        return frames * self._mult
+
+    def convert_radians_per_second(self, frames):
+        return frames * (self._mult * self.DEG_TO_RAD)
+
     def read_degrees_per_second_xyz(self):
         x, y, z = self.read_xyz()
         return x * self._mult, y * self._mult, z * self._mult
@@ -21,10 +21,16 @@
 
 
 
-import smbus
+import time
+from ctrlregisters import CtrlRegisters
 
+try:
+    import smbus
+except ImportError:
+    smbus = None
 
-class LIS331DLH(object):
+
+class LIS331DLH(CtrlRegisters):
     register = {
         'WHO_AM_I'	: 0x0F,
         'CTRL_REG1'			: 0x20,
@@ -80,6 +86,9 @@ class LIS331DLH(object):
         'NORMAL 1000Hz'     : 0b00111,
     }
 
+    # Регистры управления, записываемые одной транзакцией
+    ctrl_registers = ('CTRL_REG1', 'CTRL_REG2', 'CTRL_REG3', 'CTRL_REG4', 'CTRL_REG5')
+
     I2C_DEFAULT_ADDRESS = 0b0011000
     I2C_IDENTITY = 0x32
 
@@ -89,33 +98,58 @@ class LIS331DLH(object):
     _ctrlReg3 = 0
     _ctrlReg4 = 0
     _ctrlReg5 = 0
+    _last_sample_ns = None
+    dropped_samples = 0
+    # Время последнего чтения данных, time.monotonic_ns()
+    timestamp = None
     # Additional constants
     G = 9.8
 
     def __init__(self, port=1,
                  address=I2C_DEFAULT_ADDRESS,
                  sens_range=range_fs[0],
-                 data_rate=output_data_rate['NORMAL 50Hz']):
-        # Подключаемся к шине I2C
-        self.wire = smbus.SMBus(port)
+                 data_rate=output_data_rate['NORMAL 50Hz'],
+                 bus=None,
+                 profile=None,
+                 reset=True,
+                 warm=False):
+        # Подключаемся к шине I2C (или к переданной шине, например VirtualSMBus)
+        self.wire = bus if bus is not None else smbus.SMBus(port)
         # Запоминаем адрес
         self._addr = address
         # Сбрасываем все регистры по умолчанию
-        self.reboot()
-        # Устанавливаем чувствительность
-        self.set_range(sens_range)
-        # Устанавливаем чувствительность (Установка ODR включает прибор)
-        self.set_output_data_rate(data_rate)
-        # x axis enable
-        self.axis_x(True)
-        # y axis enable
-        self.axis_y(True)
-        # z axis enable
-        self.axis_z(True)
+        if reset and not warm:
+            self.reboot()
+        # Диапазон, ODR (включает прибор) и оси X, Y, Z записываем одной транзакцией
+        if profile is None:
+            profile = self.profile(sens_range, data_rate)
+        configure = self.warm_configure if warm else self.configure
+        if not configure(profile):
+            print('cannot configure device in address ', self._addr)
 
     def identity(self):
         return self.wire.read_byte_data(self._addr, self.register['WHO_AM_I']) == self.I2C_IDENTITY
 
+    # Профиль конфигурации: итоговые значения CTRL_REG1..CTRL_REG5
+    @classmethod
+    def profile(cls, sens_range=range_fs[0], data_rate=output_data_rate['NORMAL 50Hz'],
+                axis_x=True, axis_y=True, axis_z=True):
+        return {
+            'CTRL_REG1': (data_rate << 3) | (axis_z << 2) | (axis_y << 1) | axis_x,
+            'CTRL_REG2': 0,
+            'CTRL_REG3': 0,
+            'CTRL_REG4': cls.range_conf(sens_range),
+            'CTRL_REG5': 0,
+        }
+
+    def ctrl_address(self):
+        return self._addr
+
+    def sync_range(self):
+        for sens_range, conf in self.adr_fs_conf.items():
+            if self._ctrlReg4 & 0x30 == conf:
+                self._mult = self.mult_sens[sens_range]
+
     # Register 1 operations
     # PM2 PM1 PM0 DR1 DR0 Zen Yen Xen
     # Power-Down mode
@@ -128,6 +162,15 @@ class LIS331DLH(object):
             self._ctrlReg1 &= 0x1f
         self.wire.write_byte_data(self._addr, self.register['CTRL_REG1'], self._ctrlReg1)
 
+    # Текущая частота выдачи данных, Гц (0 - power-down)
+    def data_rate_hz(self):
+        power_mode = self._ctrlReg1 >> 5
+        if power_mode == 0:
+            return 0
+        if power_mode == 1:
+            return (50, 100, 400, 1000)[(self._ctrlReg1 >> 3) & 0x3]
+        return (0.5, 1, 2, 5, 10)[min(power_mode - 2, 4)]
+
     # Data rate selection. Default value: 00 (00:50 Hz; Others: refer to Table 20)
     def set_output_data_rate(self, rate=output_data_rate['NORMAL 50Hz']):
         self._ctrlReg1 &= 0x7
@@ -177,15 +220,53 @@ class LIS331DLH(object):
 
     def read_axis(self, reg):
         # assert MSB to enable register address auto increment
-        return self.signed_int32(self.wire.read_word_data(self._addr, reg | (1 << 7)))
+        value = self.signed_int32(self.wire.read_word_data(self._addr, reg | (1 << 7)))
+        self.timestamp = time.monotonic_ns()
+        return value
 
     def read_xyz(self):
         # assert MSB to enable register address auto increment
         values = self.wire.read_i2c_block_data(self._addr, self.register['OUT_X_L'] | (1 << 7), 6)
+        self.timestamp = time.monotonic_ns()
         return (self.signed_int32(values[1] << 8 | values[0]),
                 self.signed_int32(values[3] << 8 | values[2]),
                 self.signed_int32(values[5] << 8 | values[4]))
 
+    # STATUS_REG
+    # ZYXOR ZOR YOR XOR ZYXDA ZDA YDA XDA
+    def read_status(self):
+        return self.wire.read_byte_data(self._addr, self.register['STATUS_REG'])
+
+    def data_ready(self):
+        return bool(self.read_status() & (1 << 3))
+
+    def read_new_xyz(self):
+        # STATUS_REG и OUT_X_L..OUT_Z_H идут подряд: статус и данные читаем одной транзакцией.
+        # Возвращает None, если новых данных нет; при переполнении (ZYXOR) считаем пропущенные замеры
+        values = self.wire.read_i2c_block_data(self._addr, self.register['STATUS_REG'] | (1 << 7), 7)
+        status = values[0]
+        if not status & (1 << 3):
+            return None
+        now = self.timestamp = time.monotonic_ns()
+        if status & (1 << 7):
+            self.dropped_samples += self._missed_samples(now)
+        self._last_sample_ns = now
+        return (self.signed_int32(values[2] << 8 | values[1]),
+                self.signed_int32(values[4] << 8 | values[3]),
+                self.signed_int32(values[6] << 8 | values[5]))
+
+    def _missed_samples(self, now):
+        # Оценка числа перезаписанных замеров по времени с последнего чтения
+        rate = self.data_rate_hz()
+        if self._last_sample_ns is None or not rate:
+            return 1
+        return max(1, int(round((now - self._last_sample_ns) * 1e-9 * rate)) - 1)
+
+    def read_new_gxyz(self):
+        values = self.read_new_xyz()
+        if values is not None:
+            return values[0] * self._mult, values[1] * self._mult, values[2] * self._mult
+
     def read_gx(self):
         return self.read_axis(self.register['OUT_X_L']) * self._mult
 
@@ -204,6 +285,13 @@ class LIS331DLH(object):
     def read_az(self):
         return self.read_axis(self.register['OUT_Z_L']) * self._mult * self.G
 
+    # Пакетный перевод массива сырых кадров (N, 3) из rawframes.decode_xyz одной векторной операцией
+    def convert_g(self, frames):
+        return frames * self._mult
+
+    def convert_acceleration(self, frames):
+        return frames * (self._mult * self.G)
+
     def read_gxyz(self):
         gx, gy, gz = self.read_xyz()
         return gx * self._mult, gy * self._mult, gz * self._mult
@@ -19,11 +19,17 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
 
-import smbus
+import time
+from ctrlregisters import CtrlRegisters
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
 from math import atan2, pi, degrees
 
 
-class LIS3MDL(object):
+class LIS3MDL(CtrlRegisters):
     register = {
         'WHO_AM_I'          : 0x0F,
         'CTRL_REG1'		    : 0x20,
@@ -89,6 +95,9 @@ class LIS3MDL(object):
                            'F',
                            }
 
+    # Регистры управления, записываемые одной транзакцией
+    ctrl_registers = ('CTRL_REG1', 'CTRL_REG2', 'CTRL_REG3', 'CTRL_REG4', 'CTRL_REG5')
+
     # Default
     I2C_DEFAULT_ADDRESS = 0b0011100
     I2C_IDENTITY = 0x3d
@@ -105,6 +114,10 @@ class LIS3MDL(object):
     _ctrlReg3 = 0
     _ctrlReg4 = 0
     _ctrlReg5 = 0
+    _last_sample_ns = None
+    dropped_samples = 0
+    # Время последнего чтения данных, time.monotonic_ns()
+    timestamp = None
 
     _calibration_matrix = [[0.0, 0.0, 0.0],
                            [0.0, 0.0, 0.0],
@@ -117,30 +130,50 @@ class LIS3MDL(object):
                  sens_range=range_fs[0],
                  temperature_sensor_enable=True,
                  axis_operation_mode=axis_operation_mode['ULTRA_HIGH_PERF'],
-                 output_data_rate=configuration['ODR_80']
-                 ):
-        # Подключаемся к шине I2C
-        self.wire = smbus.SMBus(port)
+                 output_data_rate=configuration['ODR_80'],
+                 bus=None,
+                 profile=None,
+                 reset=True,
+                 warm=False):
+        # Подключаемся к шине I2C (или к переданной шине, например VirtualSMBus)
+        self.wire = bus if bus is not None else smbus.SMBus(port)
         # Запоминаем адрес
         self._address = address
         # Сбрасываем все регистры по умолчанию
-        self.soft_reset()
-        # Устанавливаем чувствительность
-        self.set_range(sens_range)
-        # Влючаем
-        self.enable()
-        # Temperature sensor enable
-        self.temperature_sensor(temperature_sensor_enable)
-        # Ultra High Performance Mode Selected for XY Axis
-        self.operation_mode_xy_axis(axis_operation_mode)
-        # Ultra High Performance Mode Selected for Z Axis
-        self.operation_mode_z_axis(axis_operation_mode)
-        # Output Data Rate of 80 Hz Selected
-        self.output_data_rate(output_data_rate)
+        if reset and not warm:
+            self.soft_reset()
+        # Чувствительность, включение, датчик температуры, режимы осей XY и Z
+        # и ODR записываем одной транзакцией
+        if profile is None:
+            profile = self.profile(sens_range, temperature_sensor_enable, axis_operation_mode, output_data_rate)
+        configure = self.warm_configure if warm else self.configure
+        if not configure(profile):
+            print('cannot configure device in address ', self._address)
 
     def identity(self):
         return self.wire.read_byte_data(self._address, self.register['WHO_AM_I']) == self.I2C_IDENTITY
 
+    # Профиль конфигурации: итоговые значения CTRL_REG1..CTRL_REG5
+    @classmethod
+    def profile(cls, sens_range=range_fs[0],
+                temperature_sensor_enable=True,
+                axis_operation_mode=axis_operation_mode['ULTRA_HIGH_PERF'],
+                output_data_rate=configuration['ODR_80'],
+                fast_odr=False,
+                fast_read=False):
+        return {
+            'CTRL_REG1': (temperature_sensor_enable << 7) | axis_operation_mode | output_data_rate | (fast_odr << 1),
+            'CTRL_REG2': cls.range_conf(sens_range),
+            'CTRL_REG3': 0,
+            'CTRL_REG4': axis_operation_mode >> 3,
+            'CTRL_REG5': fast_read << 7,
+        }
+
+    def sync_range(self):
+        for sens_range, conf in self.adr_fs_conf.items():
+            if self._ctrlReg2 & 0x60 == conf:
+                self._mult = self.sens_fs[sens_range]
+
     # Register 1 operations
     # TEMP_EN OM1 OM0 DO2 DO1 DO0 FAST_ODR ST
     # Temperature sensor enable. Default value: 0
@@ -162,6 +195,17 @@ class LIS3MDL(object):
         self._ctrlReg1 |= rate
         self.wire.write_byte_data(self._address, self.register['CTRL_REG1'], self._ctrlReg1)
 
+    # Текущая частота выдачи данных, Гц (0 - power-down или single-conversion)
+    def data_rate_hz(self):
+        if self._ctrlReg3 & 0x3:
+            return 0
+        if self._ctrlReg3 & (1 << 5):
+            return 0.625
+        if self._ctrlReg1 & (1 << 1):
+            # FAST_ODR: частота зависит от режима работы осей
+            return (1000, 560, 300, 155)[(self._ctrlReg1 >> 5) & 0x3]
+        return (0.625, 1.25, 2.5, 5, 10, 20, 40, 80)[(self._ctrlReg1 >> 2) & 0x7]
+
     # FAST_ODR enables data rates higher than 80 Hz. Default value: 0
     # (0: Fast_ODR disabled; 1: FAST_ODR enabled)
     def fast_odr(self, enable=False):
@@ -224,6 +268,9 @@ class LIS3MDL(object):
 
     # Register 5 operations
     # FAST_READ BDU 0 0 0 0 0 0
+    # FAST_READ: автоинкремент только по старшим байтам OUT_X_H, OUT_Y_H, OUT_Z_H.
+    # read_xyz читает 3 байта вместо 6; значения остаются в 16-битной шкале (младший байт = 0),
+    # поэтому _mult, калибровка и азимут работают без изменений при 8-битном разрешении
     def fast_read(self, enable=False):
         if enable:
             self._ctrlReg5 |= (1 << 7)
@@ -233,16 +280,81 @@ class LIS3MDL(object):
 
     # Getting data operations
     def read_axis(self, reg):
+        # reg - младший регистр оси (OUT_X_L, OUT_Y_L, OUT_Z_L)
+        if self._ctrlReg5 & (1 << 7):
+            # Режим FAST_READ: только старший байт, как в read_fast_xyz
+            value = self.signed_int32(self.wire.read_byte_data(self._address, reg + 1) << 8)
+            self.timestamp = time.monotonic_ns()
+            return value
         # assert MSB to enable register address auto increment
-        return self.signed_int32(self.wire.read_word_data(self._address, reg | (1 << 7)))
+        value = self.signed_int32(self.wire.read_word_data(self._address, reg | (1 << 7)))
+        self.timestamp = time.monotonic_ns()
+        return value
 
     def read_xyz(self):
+        if self._ctrlReg5 & (1 << 7):
+            return self.read_fast_xyz()
         # assert MSB to enable register address auto increment
         values = self.wire.read_i2c_block_data(self._address, self.register['OUT_X_L'] | (1 << 7), 6)
+        self.timestamp = time.monotonic_ns()
         return (self.signed_int32(values[1] << 8 | values[0]),
                 self.signed_int32(values[3] << 8 | values[2]),
                 self.signed_int32(values[5] << 8 | values[4]))
 
+    def read_fast_xyz(self):
+        # Режим FAST_READ: только старшие байты
+        values = self.wire.read_i2c_block_data(self._address, self.register['OUT_X_H'] | (1 << 7), 3)
+        self.timestamp = time.monotonic_ns()
+        return (self.signed_int32(values[0] << 8),
+                self.signed_int32(values[1] << 8),
+                self.signed_int32(values[2] << 8))
+
+    # STATUS_REG
+    # ZYXOR ZOR YOR XOR ZYXDA ZDA YDA XDA
+    def read_status(self):
+        return self.wire.read_byte_data(self._address, self.register['STATUS_REG'])
+
+    def data_ready(self):
+        return bool(self.read_status() & (1 << 3))
+
+    def read_new_xyz(self):
+        # STATUS_REG и OUT_X_L..OUT_Z_H идут подряд: статус и данные читаем одной транзакцией.
+        # Возвращает None, если новых данных нет; при переполнении (ZYXOR) считаем пропущенные замеры
+        if self._ctrlReg5 & (1 << 7):
+            # В режиме FAST_READ автоинкремент после STATUS_REG попадает на OUT_X_L,
+            # поэтому статус и старшие байты читаем отдельно
+            status = self.read_status()
+            values = None
+        else:
+            values = self.wire.read_i2c_block_data(self._address, self.register['STATUS_REG'] | (1 << 7), 7)
+            status = values[0]
+        if not status & (1 << 3):
+            return None
+        if values is None:
+            sample = self.read_fast_xyz()
+        else:
+            sample = (self.signed_int32(values[2] << 8 | values[1]),
+                      self.signed_int32(values[4] << 8 | values[3]),
+                      self.signed_int32(values[6] << 8 | values[5]))
+        now = self.timestamp = time.monotonic_ns()
+        if status & (1 << 7):
+            self.dropped_samples += self._missed_samples(now)
+        self._last_sample_ns = now
+        return sample
+
+    def _missed_samples(self, now):
+        # Оценка числа перезаписанных замеров по времени с последнего чтения
+        rate = self.data_rate_hz()
+        if self._last_sample_ns is None or not rate:
+            return 1
+        return max(1, int(round((now - self._last_sample_ns) * 1e-9 * rate)) - 1)
+
+    def read_new_calibrate_gauss_xyz(self):
+        values = self.read_new_xyz()
+        if values is not None:
+            calibrate_gauss = self.calibrate(values)
+            return calibrate_gauss[0] / self._mult, calibrate_gauss[1] / self._mult, calibrate_gauss[2] / self._mult
+
     def read_gauss_x(self):
         return self.read_axis(self.register['OUT_X_L']) / self._mult
 
@@ -256,6 +368,14 @@ class LIS3MDL(object):
         gauss = self.read_xyz()
         return gauss[0] / self._mult, gauss[1] / self._mult, gauss[2] / self._mult
 
+    # Пакетный перевод массива сырых кадров (N, 3) из rawframes.decode_xyz
+    def convert_gauss(self, frames):
+        return frames / self._mult
+
+    def convert_calibrate_gauss(self, frames):
+        # (raw - bias) * calibration_matrix^T / mult для всех кадров сразу
+        return (frames - self._bias).dot(list(zip(*self._calibration_matrix))) / self._mult
+
     def read_calibrate_xyz(self):
         return self.calibrate()
 
@@ -263,10 +383,11 @@ class LIS3MDL(object):
         calibrate_gauss = self.read_calibrate_xyz()
         return calibrate_gauss[0] / self._mult, calibrate_gauss[1] / self._mult, calibrate_gauss[2] / self._mult
 
-    def calibrate(self):
+    def calibrate(self, read_values=None):
         calibrated_values = []
         uncalibrated_values = []
-        read_values = self.read_xyz()
+        if read_values is None:
+            read_values = self.read_xyz()
         for i in range(0, 3):
             # Обязательно делать калибровку в raw
             uncalibrated_values.append(read_values[i] - self._bias[i])
@@ -19,10 +19,16 @@
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
 
-import smbus
+import time
+from ctrlregisters import CtrlRegisters
 
+try:
+    import smbus
+except ImportError:
+    smbus = None
 
-class LPS331AP(object):
+
+class LPS331AP(CtrlRegisters):
     register = {
         'REF_P_XL'          : 0x08,
         'REF_P_L'           : 0x09,
@@ -68,6 +74,36 @@ class LPS331AP(object):
         'P(25Hz) T(25Hz)'   : 7,
     }
 
+    # Регистры управления, записываемые одной транзакцией
+    ctrl_registers = ('CTRL_REG1', 'CTRL_REG2', 'CTRL_REG3')
+
+    # RES_CONF AVGT2 AVGT1 AVGT0 AVGP3 AVGP2 AVGP1 AVGP0
+    # Число усреднений давления и температуры: больше - меньше шум, но дольше преобразование
+    pressure_averages = {
+        1                   : 0b0000,
+        2                   : 0b0001,
+        4                   : 0b0010,
+        8                   : 0b0011,
+        16                  : 0b0100,
+        32                  : 0b0101,
+        64                  : 0b0110,
+        128                 : 0b0111,
+        256                 : 0b1000,
+        384                 : 0b1001,
+        512                 : 0b1010,
+    }
+
+    temperature_averages = {
+        1                   : 0b000,
+        2                   : 0b001,
+        4                   : 0b010,
+        8                   : 0b011,
+        16                  : 0b100,
+        32                  : 0b101,
+        64                  : 0b110,
+        128                 : 0b111,
+    }
+
     # Default
     I2C_DEFAULT_ADDRESS_LOW = 0b1011100
     I2C_DEFAULT_ADDRESS_HIGH = 0b1011101
@@ -79,28 +115,45 @@ class LPS331AP(object):
     _ctrlReg1 = 0
     _ctrlReg2 = 0
     _ctrlReg3 = 0
+    # RES_CONF по умолчанию: 512 усреднений давления, 128 температуры
+    _resConf = 0x7A
+    _conversion_pending = False
     _address = I2C_DEFAULT_ADDRESS_LOW
+    _last_sample_ns = None
+    dropped_samples = 0
+    # Время последнего чтения данных, time.monotonic_ns()
+    timestamp = None
     # Additional constants
     CELSIUS_TO_KELVIN_OFFSET = 273.15
 
     def __init__(self, port=1,
                  set_pressure_measure=DEFAULT_PRESSURE_MEASURE,
                  set_temperature_measure=DEFAULT_TEMPERATURE_MEASURE,
-                 set_output_data_rate=output_data_rate['P(7Hz)T(7Hz)']):
-        # Подключаемся к шине I2C
-        self.wire = smbus.SMBus(port)
-        # Устанавливаем адрес устройства
-        if not self.auto_detect_address():
+                 set_output_data_rate=output_data_rate['P(7Hz)T(7Hz)'],
+                 bus=None,
+                 profile=None,
+                 address=None,
+                 reset=True,
+                 warm=False):
+        # Подключаемся к шине I2C (или к переданной шине, например VirtualSMBus)
+        self.wire = bus if bus is not None else smbus.SMBus(port)
+        # Устанавливаем адрес устройства: заданный явно или найденный опросом
+        if address is not None:
+            self._address = address
+        elif not self.auto_detect_address():
             print('cannot connect device in address ', self._address)
             return
-        # Сброс всего по умолчанию
-        self.soft_reset()
-        # reboot
-        self.reboot()
-        # Включаем
-        self.device_enable(True)
-        # setup Output_data_rate
-        self.setup_output_data_rate(set_output_data_rate)
+        if reset and not warm:
+            # Сброс всего по умолчанию
+            self.soft_reset()
+            # reboot
+            self.reboot()
+        # Включение и Output_data_rate записываем одной транзакцией
+        if profile is None:
+            profile = self.profile(set_output_data_rate)
+        configure = self.warm_configure if warm else self.configure
+        if not configure(profile):
+            print('cannot configure device in address ', self._address)
         # Устанавливаем единицы измерения
         # Давления
         self._measure_of_pressure = set_pressure_measure
@@ -110,6 +163,20 @@ class LPS331AP(object):
     def identity(self, address=_address):
         return self.wire.read_byte_data(address, self.register['WHO_AM_I']) == self.I2C_IDENTITY
 
+    # Профиль конфигурации: итоговые значения CTRL_REG1..CTRL_REG3
+    @classmethod
+    def profile(cls, set_output_data_rate=output_data_rate['P(7Hz)T(7Hz)'], power=True,
+                block_data_update=False):
+        return {
+            'CTRL_REG1': (power << 7) | (set_output_data_rate << 4) | (block_data_update << 2),
+            'CTRL_REG2': 0,
+            'CTRL_REG3': 0,
+        }
+
+    def warm_sync(self):
+        # Число усреднений (RES_CONF) тоже сохранилось на датчике
+        self.read_resolution()
+
     def auto_detect_address(self):
         # try each possible address and stop if reading WHO_AM_I returns the expected response
         if self.identity(self.I2C_DEFAULT_ADDRESS_LOW):
@@ -121,10 +188,56 @@ class LPS331AP(object):
         else:
             return False
 
+    # Текущая частота выдачи давления, Гц (0 - power-down или ONE SHOT)
+    def data_rate_hz(self):
+        if not self._ctrlReg1 & (1 << 7):
+            return 0
+        return (0, 1, 7, 12.5, 25, 7, 12.5, 25)[(self._ctrlReg1 >> 4) & 0x7]
+
+    # STATUS_REG
+    # - - P_OR T_OR - - P_DA T_DA
+    def read_status(self):
+        return self.wire.read_byte_data(self._address, self.register['STATUS_REG'])
+
+    def data_ready(self):
+        return bool(self.read_status() & (1 << 1))
+
+    def read_new_raw(self):
+        # STATUS_REG, PRESS_OUT_XL..H и TEMP_OUT_L..H идут подряд: читаем одной транзакцией.
+        # Возвращает None, если нового давления нет. Температура обновляется реже давления (ODR 7/1, 12.5/1,
+        # 25/1 Гц): без нового T_DA вместо неё возвращается None, а не прошлое значение.
+        # dropped_samples считает пропущенные замеры давления (P_OR)
+        values = self.wire.read_i2c_block_data(self._address, self.register['STATUS_REG'] | (1 << 7), 6)
+        status = values[0]
+        if not status & (1 << 1):
+            return None
+        now = self.timestamp = time.monotonic_ns()
+        if status & (1 << 5):
+            rate = self.data_rate_hz()
+            if self._last_sample_ns is None or not rate:
+                self.dropped_samples += 1
+            else:
+                self.dropped_samples += max(1, int(round((now - self._last_sample_ns) * 1e-9 * rate)) - 1)
+        self._last_sample_ns = now
+        pressure = values[3] << 16 | values[2] << 8 | values[1]
+        if not status & (1 << 0):
+            return pressure, None
+        return pressure, self.signed_int32(values[5] << 8 | values[4])
+
+    def read_new(self, measure=DEFAULT_PRESSURE_MEASURE):
+        # Новые давление и температура (C) или None; температура None, если новой ещё нет
+        values = self.read_new_raw()
+        if values is not None:
+            if measure not in self.pressure_measure.keys():
+                measure = self.DEFAULT_PRESSURE_MEASURE
+            temperature = None if values[1] is None else values[1] / 480 + 42.5
+            return values[0] / self.pressure_measure[measure], temperature
+
     # Pressure read data
     def read_pressure_raw(self):
         # assert MSB to enable register address auto increment
         values = self.wire.read_i2c_block_data(self._address, self.register['PRESS_POUT_XL_REH'] | (1 << 7), 3)
+        self.timestamp = time.monotonic_ns()
         # Pressure output data: Pout(m bar)=(PRESS_OUT_H & PRESS_OUT_L & PRESS_OUT_XL)[dec]/4096
         return values[2] << 16 | values[1] << 8 | values[0]
 
@@ -134,10 +247,21 @@ class LPS331AP(object):
         else:
             return self.read_pressure_raw() / self.pressure_measure[self.DEFAULT_PRESSURE_MEASURE]
 
+    # Пакетный перевод массивов из rawframes.decode_pressure / decode_pressure_temperature
+    def convert_pressure(self, raw, measure=DEFAULT_PRESSURE_MEASURE):
+        if measure not in self.pressure_measure.keys():
+            measure = self.DEFAULT_PRESSURE_MEASURE
+        return raw / self.pressure_measure[measure]
+
+    def convert_temperature(self, raw):
+        return raw / 480 + 42.5
+
     # Temperature read data
     def read_temperature_raw(self):
         # assert MSB to enable register address auto increment
-        return self.signed_int32(self.wire.read_word_data(self._address, self.register['TEMP_OUT_L'] | (1 << 7)))
+        value = self.signed_int32(self.wire.read_word_data(self._address, self.register['TEMP_OUT_L'] | (1 << 7)))
+        self.timestamp = time.monotonic_ns()
+        return value
 
     def read_temperature(self, measure=DEFAULT_TEMPERATURE_MEASURE):
         if measure in self.temperature_measure:
@@ -149,6 +273,20 @@ class LPS331AP(object):
     def read_temperature_f(self):
         return self.read_temperature_raw() / 480 * 1.8 + 108.5
 
+    # RES_CONF operations
+    # Внимание: RES_CONF = 0x7A не допускается при ODR 25 Гц / 25 Гц
+    def set_resolution(self, pressure_average=512, temperature_average=128):
+        if pressure_average in self.pressure_averages and temperature_average in self.temperature_averages:
+            self._resConf = self.temperature_averages[temperature_average] << 4 | \
+                            self.pressure_averages[pressure_average]
+            self.wire.write_byte_data(self._address, self.register['RES_CONF'], self._resConf)
+
+    def read_resolution(self):
+        self._resConf = self.wire.read_byte_data(self._address, self.register['RES_CONF'])
+        pressure = [avg for avg, conf in self.pressure_averages.items() if conf == self._resConf & 0xf]
+        temperature = [avg for avg, conf in self.temperature_averages.items() if conf == self._resConf >> 4 & 0x7]
+        return pressure[0] if pressure else None, temperature[0] if temperature else None
+
     # Register 1 operations
     # PD ODR2 ODR1 ODR0 DIFF_EN DBDU DELTA_EN SIM
     # Power-Down mode
@@ -223,13 +361,36 @@ class LPS331AP(object):
         # ‘1’. At the end of conversion the new data are available in the output registers, the STAUS_REG[0]
         # and STAUS_REG[1] bits are set to ‘1’ and the ONE_SHOT bit comes back to ‘0’ by hardware.
         if enable:
-            self._ctrlReg1 |= (self.output_data_rate['ONE SHOT'] << 4)
+            # ODR2-ODR0 = 000
+            ctrl_reg1 = self._ctrlReg1 & ~(0x7 << 4)
+            if ctrl_reg1 != self._ctrlReg1:
+                self._ctrlReg1 = ctrl_reg1
+                self.wire.write_byte_data(self._address, self.register['CTRL_REG1'], self._ctrlReg1)
             self._ctrlReg2 |= 0b1
         else:
             self._ctrlReg2 &= ~0b1
         self.wire.write_byte_data(self._address, self.register['CTRL_REG2'], self._ctrlReg2)
         return
 
+    # Конвейерный режим ONE SHOT: start_conversion() запускает преобразование и сразу возвращает
+    # управление, collect() позже одной транзакцией проверяет STATUS_REG и забирает давление
+    # и температуру. Пока преобразование не готово, collect() возвращает None
+    def start_conversion(self):
+        self.one_shot(True)
+        # ONE_SHOT сбрасывается аппаратно по окончании преобразования
+        self._ctrlReg2 &= ~0b1
+        self._conversion_pending = True
+
+    @property
+    def conversion_pending(self):
+        return self._conversion_pending
+
+    def collect(self, measure=DEFAULT_PRESSURE_MEASURE):
+        values = self.read_new(measure)
+        if values is not None:
+            self._conversion_pending = False
+        return values
+
     @staticmethod
     def signed_int32(number):
         if number & (1 << 15):
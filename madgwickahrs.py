@@ -14,22 +14,413 @@
 """
 
 import warnings
+from math import sqrt, exp, asin
 import numpy as np
-from numpy.linalg import norm
 from quaternion import Quaternion
 
+try:
+    # numba compiles the step kernels, so the batch loops run without Python objects per sample
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _kernel(function):
+    return njit(cache=True)(function) if njit is not None else function
+
+
+# Result codes of the step kernels
+STEP_OK = 0
+STEP_ZERO_ACCELEROMETER = 1
+STEP_ZERO_MAGNETOMETER = 2
+
+_WARNINGS = {
+    STEP_ZERO_ACCELEROMETER: "accelerometer is zero",
+    STEP_ZERO_MAGNETOMETER: "magnetometer is zero",
+}
+
+
+def _vector(values):
+    """
+    Return the components of a three-element sensor vector as plain floats
+    :param values: A sequence or an array of any shape with three elements
+    :return: x, y, z
+    """
+    if isinstance(values, np.ndarray):
+        values = values.ravel().tolist()
+    x, y, z = values
+    return x, y, z
+
+
+# Arithmetic parts of a step. They have no branches and no function calls, so the same code runs
+# on floats inside the compiled kernels and on (K,) arrays in MadgwickAHRSBank
+
+def _earth_field(q0, q1, q2, q3, mx, my, mz):
+    """
+    Direction of the normalised magnetometer measurement in the earth frame: h = q * (0, m) * q.conj()
+    :return: hx, hy, hz
+    """
+    tw = mx * q1 + my * q2 + mz * q3
+    tx = mx * q0 - my * q3 + mz * q2
+    ty = mx * q3 + my * q0 - mz * q1
+    tz = -(mx * q2) + my * q1 + mz * q0
+    hx = q0 * tx + q1 * tw + q2 * tz - q3 * ty
+    hy = q0 * ty - q1 * tz + q2 * tw + q3 * tx
+    hz = q0 * tz + q1 * ty - q2 * tx + q3 * tw
+    return hx, hy, hz
+
+
+def _ahrs_gradient(q0, q1, q2, q3, ax, ay, az, mx, my, mz, b1, b3):
+    """
+    Gradient j.T.dot(f) of the AHRS objective function for normalised measurements
+    :param b1, b3: Horizontal and vertical components of the earth magnetic field reference
+    :return: s0, s1, s2, s3
+    """
+    f0 = 2 * (q1 * q3 - q0 * q2) - ax
+    f1 = 2 * (q0 * q1 + q2 * q3) - ay
+    f2 = 2 * (0.5 - q1 ** 2 - q2 ** 2) - az
+    f3 = 2 * b1 * (0.5 - q2 ** 2 - q3 ** 2) + 2 * b3 * (q1 * q3 - q0 * q2) - mx
+    f4 = 2 * b1 * (q1 * q2 - q0 * q3) + 2 * b3 * (q0 * q1 + q2 * q3) - my
+    f5 = 2 * b1 * (q0 * q2 + q1 * q3) + 2 * b3 * (0.5 - q1 ** 2 - q2 ** 2) - mz
+    # rows of the Jacobian j written out
+    s0 = (-2 * q2 * f0 + 2 * q1 * f1 + -2 * b3 * q2 * f3 + (-2 * b1 * q3 + 2 * b3 * q1) * f4 +
+          2 * b1 * q2 * f5)
+    s1 = (2 * q3 * f0 + 2 * q0 * f1 + -4 * q1 * f2 + 2 * b3 * q3 * f3 + (2 * b1 * q2 + 2 * b3 * q0) * f4 +
+          (2 * b1 * q3 - 4 * b3 * q1) * f5)
+    s2 = (-2 * q0 * f0 + 2 * q3 * f1 + -4 * q2 * f2 + (-4 * b1 * q2 - 2 * b3 * q0) * f3 +
+          (2 * b1 * q1 + 2 * b3 * q3) * f4 + (2 * b1 * q0 - 4 * b3 * q2) * f5)
+    s3 = (2 * q1 * f0 + 2 * q2 * f1 + (-4 * b1 * q3 + 2 * b3 * q1) * f3 + (-2 * b1 * q0 + 2 * b3 * q2) * f4 +
+          2 * b1 * q1 * f5)
+    return s0, s1, s2, s3
+
+
+def _imu_gradient(q0, q1, q2, q3, ax, ay, az):
+    """
+    Gradient j.T.dot(f) of the IMU objective function for a normalised accelerometer measurement
+    :return: s0, s1, s2, s3
+    """
+    f0 = 2 * (q1 * q3 - q0 * q2) - ax
+    f1 = 2 * (q0 * q1 + q2 * q3) - ay
+    f2 = 2 * (0.5 - q1 ** 2 - q2 ** 2) - az
+    s0 = -2 * q2 * f0 + 2 * q1 * f1
+    s1 = 2 * q3 * f0 + 2 * q0 * f1 + -4 * q1 * f2
+    s2 = -2 * q0 * f0 + 2 * q3 * f1 + -4 * q2 * f2
+    s3 = 2 * q1 * f0 + 2 * q2 * f1
+    return s0, s1, s2, s3
+
+
+def _mag_gradient(q0, q1, q2, q3, mx, my, mz, b1, b3):
+    """
+    Magnetometer part of the AHRS gradient for a normalised magnetometer measurement
+    :param b1, b3: Horizontal and vertical components of the earth magnetic field reference
+    :return: s0, s1, s2, s3
+    """
+    f3 = 2 * b1 * (0.5 - q2 ** 2 - q3 ** 2) + 2 * b3 * (q1 * q3 - q0 * q2) - mx
+    f4 = 2 * b1 * (q1 * q2 - q0 * q3) + 2 * b3 * (q0 * q1 + q2 * q3) - my
+    f5 = 2 * b1 * (q0 * q2 + q1 * q3) + 2 * b3 * (0.5 - q1 ** 2 - q2 ** 2) - mz
+    s0 = -2 * b3 * q2 * f3 + (-2 * b1 * q3 + 2 * b3 * q1) * f4 + 2 * b1 * q2 * f5
+    s1 = 2 * b3 * q3 * f3 + (2 * b1 * q2 + 2 * b3 * q0) * f4 + (2 * b1 * q3 - 4 * b3 * q1) * f5
+    s2 = (-4 * b1 * q2 - 2 * b3 * q0) * f3 + (2 * b1 * q1 + 2 * b3 * q3) * f4 + (2 * b1 * q0 - 4 * b3 * q2) * f5
+    s3 = (-4 * b1 * q3 + 2 * b3 * q1) * f3 + (-2 * b1 * q0 + 2 * b3 * q2) * f4 + 2 * b1 * q1 * f5
+    return s0, s1, s2, s3
+
+
+def _rate(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta):
+    """
+    Rate of change of quaternion: q * (0, gyroscope) * 0.5 - beta * step
+    :param s0, s1, s2, s3: The normalised corrective step
+    :return: qdot0, qdot1, qdot2, qdot3
+    """
+    qdot0 = (-q1 * gx - q2 * gy - q3 * gz) * 0.5 - beta * s0
+    qdot1 = (q0 * gx + q2 * gz - q3 * gy) * 0.5 - beta * s1
+    qdot2 = (q0 * gy - q1 * gz + q3 * gx) * 0.5 - beta * s2
+    qdot3 = (q0 * gz + q1 * gy - q2 * gx) * 0.5 - beta * s3
+    return qdot0, qdot1, qdot2, qdot3
+
+
+_earth_field_kernel = _kernel(_earth_field)
+_ahrs_gradient_kernel = _kernel(_ahrs_gradient)
+_imu_gradient_kernel = _kernel(_imu_gradient)
+_mag_gradient_kernel = _kernel(_mag_gradient)
+_rate_kernel = _kernel(_rate)
+
+
+@_kernel
+def _integrate(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta, dt):
+    """
+    Apply the corrective step to the gyroscope rate of change and integrate the quaternion
+    :param q0, q1, q2, q3: The quaternion before the step
+    :param gx, gy, gz: The gyroscope data in radians per second
+    :param s0, s1, s2, s3: The gradient of the objective function
+    :param beta: Algorithm gain beta
+    :param dt: Step period in seconds
+    :return: The normalised quaternion after the step
+    """
+    norm = sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+    if norm > 0:
+        # normalise step magnitude
+        s0 /= norm
+        s1 /= norm
+        s2 /= norm
+        s3 /= norm
+    qdot0, qdot1, qdot2, qdot3 = _rate_kernel(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta)
+
+    # Integrate to yield quaternion
+    q0 += qdot0 * dt
+    q1 += qdot1 * dt
+    q2 += qdot2 * dt
+    q3 += qdot3 * dt
+    norm = sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    return q0 / norm, q1 / norm, q2 / norm, q3 / norm  # normalise quaternion
+
+
+@_kernel
+def _ahrs_step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, mx, my, mz, beta, dt):
+    """
+    One update step with data from a AHRS sensor array
+    :return: Result code and the quaternion after the step (unchanged unless the code is STEP_OK)
+    """
+    # Normalise accelerometer measurement
+    norm = sqrt(ax * ax + ay * ay + az * az)
+    if norm == 0:
+        return STEP_ZERO_ACCELEROMETER, q0, q1, q2, q3
+    ax /= norm
+    ay /= norm
+    az /= norm
+
+    # Normalise magnetometer measurement
+    norm = sqrt(mx * mx + my * my + mz * mz)
+    if norm == 0:
+        return STEP_ZERO_MAGNETOMETER, q0, q1, q2, q3
+    mx /= norm
+    my /= norm
+    mz /= norm
+
+    # Reference direction of Earth's magnetic field
+    hx, hy, hz = _earth_field_kernel(q0, q1, q2, q3, mx, my, mz)
+    b1 = sqrt(hx * hx + hy * hy)
+
+    # Gradient descent algorithm corrective step
+    s0, s1, s2, s3 = _ahrs_gradient_kernel(q0, q1, q2, q3, ax, ay, az, mx, my, mz, b1, hz)
+    q0, q1, q2, q3 = _integrate(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta, dt)
+    return STEP_OK, q0, q1, q2, q3
+
+
+@_kernel
+def _imu_step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, beta, dt):
+    """
+    One update step with data from a IMU sensor array
+    :return: Result code and the quaternion after the step (unchanged unless the code is STEP_OK)
+    """
+    # Normalise accelerometer measurement
+    norm = sqrt(ax * ax + ay * ay + az * az)
+    if norm == 0:
+        return STEP_ZERO_ACCELEROMETER, q0, q1, q2, q3
+    ax /= norm
+    ay /= norm
+    az /= norm
+
+    # Gradient descent algorithm corrective step
+    s0, s1, s2, s3 = _imu_gradient_kernel(q0, q1, q2, q3, ax, ay, az)
+    q0, q1, q2, q3 = _integrate(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta, dt)
+    return STEP_OK, q0, q1, q2, q3
+
+
+@_kernel
+def _mag_step(q0, q1, q2, q3, gx, gy, gz, mx, my, mz, beta, dt):
+    """
+    Update step corrected by the magnetometer alone
+    :return: Result code and the quaternion after the step (unchanged unless the code is STEP_OK)
+    """
+    # Normalise magnetometer measurement
+    norm = sqrt(mx * mx + my * my + mz * mz)
+    if norm == 0:
+        return STEP_ZERO_MAGNETOMETER, q0, q1, q2, q3
+    mx /= norm
+    my /= norm
+    mz /= norm
+
+    # Reference direction of Earth's magnetic field
+    hx, hy, hz = _earth_field_kernel(q0, q1, q2, q3, mx, my, mz)
+    b1 = sqrt(hx * hx + hy * hy)
+
+    s0, s1, s2, s3 = _mag_gradient_kernel(q0, q1, q2, q3, mx, my, mz, b1, hz)
+    q0, q1, q2, q3 = _integrate(q0, q1, q2, q3, gx, gy, gz, s0, s1, s2, s3, beta, dt)
+    return STEP_OK, q0, q1, q2, q3
+
+
+@_kernel
+def _ahrs_batch(q0, q1, q2, q3, gyroscope, accelerometer, magnetometer, beta, dt, out):
+    """
+    Sequential AHRS steps over rows of sensor data; out is a flat buffer of 4 * N quaternion components
+    :return: The number of skipped samples
+    """
+    skipped = 0
+    for i in range(len(dt)):
+        g = gyroscope[i]
+        a = accelerometer[i]
+        m = magnetometer[i]
+        code, r0, r1, r2, r3 = _ahrs_step(q0, q1, q2, q3, g[0], g[1], g[2], a[0], a[1], a[2], m[0], m[1], m[2],
+                                          beta, dt[i])
+        if code == STEP_OK:
+            q0, q1, q2, q3 = r0, r1, r2, r3
+        else:
+            skipped += 1
+        out[4 * i] = q0
+        out[4 * i + 1] = q1
+        out[4 * i + 2] = q2
+        out[4 * i + 3] = q3
+    return skipped
+
+
+@_kernel
+def _imu_batch(q0, q1, q2, q3, gyroscope, accelerometer, beta, dt, out):
+    """
+    Sequential IMU steps over rows of sensor data; out is a flat buffer of 4 * N quaternion components
+    :return: The number of skipped samples
+    """
+    skipped = 0
+    for i in range(len(dt)):
+        g = gyroscope[i]
+        a = accelerometer[i]
+        code, r0, r1, r2, r3 = _imu_step(q0, q1, q2, q3, g[0], g[1], g[2], a[0], a[1], a[2], beta, dt[i])
+        if code == STEP_OK:
+            q0, q1, q2, q3 = r0, r1, r2, r3
+        else:
+            skipped += 1
+        out[4 * i] = q0
+        out[4 * i + 1] = q1
+        out[4 * i + 2] = q2
+        out[4 * i + 3] = q3
+    return skipped
+
+
+@_kernel
+def _ahrs_bank(q, gyroscope, accelerometer, magnetometer, beta, dt):
+    """
+    One AHRS step of K filters in place; q is a (K, 4) state array, the rest are (K, 3) and (K,) arrays
+    :return: The number of filters that skipped the step
+    """
+    skipped = 0
+    for k in range(q.shape[0]):
+        g = gyroscope[k]
+        a = accelerometer[k]
+        m = magnetometer[k]
+        code, q0, q1, q2, q3 = _ahrs_step(q[k, 0], q[k, 1], q[k, 2], q[k, 3], g[0], g[1], g[2], a[0], a[1], a[2],
+                                          m[0], m[1], m[2], beta[k], dt[k])
+        if code == STEP_OK:
+            q[k, 0], q[k, 1], q[k, 2], q[k, 3] = q0, q1, q2, q3
+        else:
+            skipped += 1
+    return skipped
+
+
+@_kernel
+def _imu_bank(q, gyroscope, accelerometer, beta, dt):
+    """
+    One IMU step of K filters in place
+    :return: The number of filters that skipped the step
+    """
+    skipped = 0
+    for k in range(q.shape[0]):
+        g = gyroscope[k]
+        a = accelerometer[k]
+        code, q0, q1, q2, q3 = _imu_step(q[k, 0], q[k, 1], q[k, 2], q[k, 3], g[0], g[1], g[2], a[0], a[1], a[2],
+                                         beta[k], dt[k])
+        if code == STEP_OK:
+            q[k, 0], q[k, 1], q[k, 2], q[k, 3] = q0, q1, q2, q3
+        else:
+            skipped += 1
+    return skipped
+
+
+def _bank_tensors():
+    """
+    Constant tensors of the numpy bank step in the (components, K) layout. The rotation matrix is
+    R = I + sum q_i q_j P_ij with the diagonal written as 1 - 2 (qj^2 + qk^2), as in the gradients above
+    :return: identity (9, 1);
+             jacobian (36, 4): jacobian.dot(q) stacks dR/dq_i = 2 P_i.q for i = 0..3;
+             rate (4, 12): rate.dot(q g.T stacked) = q * (0, g) * 0.5
+    """
+    # R[r, c] = sum of 2 * coefficient * q_i * q_j
+    terms = {
+        (0, 0): ((-1, 2, 2), (-1, 3, 3)),
+        (0, 1): ((1, 1, 2), (-1, 0, 3)),
+        (0, 2): ((1, 0, 2), (1, 1, 3)),
+        (1, 0): ((1, 1, 2), (1, 0, 3)),
+        (1, 1): ((-1, 1, 1), (-1, 3, 3)),
+        (1, 2): ((1, 2, 3), (-1, 0, 1)),
+        (2, 0): ((1, 1, 3), (-1, 0, 2)),
+        (2, 1): ((1, 0, 1), (1, 2, 3)),
+        (2, 2): ((-1, 1, 1), (-1, 2, 2)),
+    }
+    p = np.zeros((4, 4, 3, 3))
+    for (row, column), products in terms.items():
+        for coefficient, i, j in products:
+            p[i, j, row, column] += coefficient
+            p[j, i, row, column] += coefficient
+    rate = np.zeros((4, 3, 4))
+    for i, g, out, sign in ((1, 0, 0, -1), (2, 1, 0, -1), (3, 2, 0, -1),
+                            (0, 0, 1, 1), (2, 2, 1, 1), (3, 1, 1, -1),
+                            (0, 1, 2, 1), (1, 2, 2, -1), (3, 0, 2, 1),
+                            (0, 2, 3, 1), (1, 1, 3, 1), (2, 0, 3, -1)):
+        rate[i, g, out] = 0.5 * sign
+    return (np.eye(3).reshape(9, 1), np.ascontiguousarray(2 * p.reshape(4, 36).T),
+            np.ascontiguousarray(rate.reshape(12, 4).T))
+
+
+_BANK_IDENTITY, _BANK_JACOBIAN, _BANK_RATE = _bank_tensors()
+
+
+def _rows(values, count=None):
+    """
+    Prepare an (N, 3) sensor array for the batch kernels: a float array for compiled kernels,
+    nested lists of floats for the Python ones
+    """
+    values = np.ascontiguousarray(values, dtype=np.float64).reshape(-1, 3)
+    if count is not None and len(values) != count:
+        raise ValueError("Expecting {} rows, got {}".format(count, len(values)))
+    return values if njit is not None else values.tolist()
+
 
 class MadgwickAHRS(object):
     sample_period = 1 / 256
-    quaternion = Quaternion(1, 0, 0, 0)
+    # Filter state, plain floats w, x, y, z: the update steps work without numpy temporaries
+    _q = (1.0, 0.0, 0.0, 0.0)
     beta = 1
+    # Gain schedule: beta starts at beta_initial and decays to beta with the time constant beta_decay, seconds.
+    # None disables the schedule
+    beta_initial = None
+    beta_decay = 1.0
+    # Filter time since the start of convergence, seconds
+    convergence_time = 0.0
+    # Accelerometer gate: corrections are skipped when |a| differs from gravity by more than the relative
+    # accel_tolerance (None disables the gate). gravity is 1 for LIS331DLH.read_gxyz
+    accel_tolerance = None
+    gravity = 1.0
+    # Magnetometer gates: expected field magnitude with the relative mag_tolerance and expected dip angle
+    # (rad, positive when the field points down) with dip_tolerance; None disables a gate
+    mag_field = None
+    mag_tolerance = 0.15
+    mag_dip = None
+    dip_tolerance = 0.1
+    # Numbers of corrections skipped by the gates
+    rejected_accel = 0
+    rejected_mag = 0
+    # Timestamp of the previous step in nanoseconds (time.monotonic_ns())
+    timestamp = None
+    # Time integrated by propagate since the last accelerometer and magnetometer corrections, seconds
+    _accel_elapsed = 0.0
+    _mag_elapsed = 0.0
 
-    def __init__(self, sampleperiod=None, quaternion=None, beta=None):
+    def __init__(self, sampleperiod=None, quaternion=None, beta=None, beta_initial=None, beta_decay=None):
         """
         Initialize the class with the given parameters.
         :param sampleperiod: The sample frequency
         :param quaternion: Initial quaternion
-        :param beta: Algorithm gain beta
+        :param beta: Algorithm gain beta, the steady state value when the gain schedule is enabled
+        :param beta_initial: Gain at the start of convergence, enables the gain schedule
+        :param beta_decay: Time constant of the gain schedule in seconds
         :return:
         """
         if sampleperiod is not None:
@@ -38,98 +429,508 @@ class MadgwickAHRS(object):
             self.quaternion = quaternion
         if beta is not None:
             self.beta = beta
+        if beta_initial is not None:
+            self.beta_initial = beta_initial
+        if beta_decay is not None:
+            self.beta_decay = beta_decay
+
+    @property
+    def quaternion(self):
+        """
+        The current orientation. A new Quaternion object is created on every access
+        :return: Quaternion
+        """
+        return Quaternion(np.array(self._q))
+
+    @quaternion.setter
+    def quaternion(self, quaternion):
+        if isinstance(quaternion, Quaternion):
+            quaternion = quaternion.q
+        w, x, y, z = np.asarray(quaternion, dtype=float).ravel().tolist()
+        self._q = (w, x, y, z)
+
+    def step_period(self, dt=None, timestamp=None):
+        """
+        Return the integration period of the current step
+        :param dt: Explicit step period in seconds
+        :param timestamp: Sample timestamp in nanoseconds; the period is the difference to the previous timestamp
+        :return: dt if given, the timestamp difference if available, sample_period otherwise
+        """
+        if timestamp is not None:
+            previous, self.timestamp = self.timestamp, timestamp
+            if dt is None and previous is not None and timestamp > previous:
+                dt = (timestamp - previous) * 1e-9
+        if dt is None:
+            dt = self.sample_period
+        return dt
+
+    @property
+    def current_beta(self):
+        """
+        The gain used by the corrective steps at the current filter time
+        :return: beta
+        """
+        beta = float(self.beta)
+        if self.beta_initial is not None:
+            beta += (self.beta_initial - beta) * exp(-self.convergence_time / self.beta_decay)
+        return beta
+
+    def _gain(self, dt):
+        # Advance the gain schedule by one step and return the gain of the step
+        if self.beta_initial is not None:
+            self.convergence_time += dt
+        return self.current_beta
+
+    def reset_gain(self):
+        """
+        Restart the gain schedule, e.g. after a disturbance or a manual change of the orientation
+        """
+        self.convergence_time = 0.0
+
+    def align(self, accelerometer, magnetometer=None):
+        """
+        Start from the orientation given by the accelerometer and magnetometer (TRIAD) instead of converging to it
+        :param accelerometer: A three-element accelerometer measurement or an (N, 3) array of samples taken at rest
+        :param magnetometer: A three-element magnetometer measurement or an (N, 3) array; without it the heading
+                             is arbitrary
+        :return: The starting Quaternion
+        """
+        accelerometer = np.asarray(accelerometer, dtype=np.float64).reshape(-1, 3).mean(axis=0).tolist()
+        if magnetometer is not None:
+            magnetometer = np.asarray(magnetometer, dtype=np.float64).reshape(-1, 3).mean(axis=0).tolist()
+        quaternion = Quaternion.from_accel_mag(accelerometer, magnetometer)
+        self.quaternion = quaternion
+        # The orientation is already valid: skip the high initial gain of the schedule
+        self.convergence_time = float('inf')
+        return quaternion
+
+    def _gated(self):
+        return (self.beta_initial is not None or self.accel_tolerance is not None or self.mag_field is not None or
+                self.mag_dip is not None)
 
-    def update(self, gyroscope, accelerometer, magnetometer):
+    def _accel_accepted(self, ax, ay, az):
+        """
+        Check the accelerometer measurement against the gravity gate
+        :return: False if the correction has to be skipped
+        """
+        if self.accel_tolerance is None:
+            return True
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        # A zero measurement is left to the step, which warns about it
+        if norm == 0 or abs(norm / self.gravity - 1) <= self.accel_tolerance:
+            return True
+        self.rejected_accel += 1
+        return False
+
+    def _mag_accepted(self, mx, my, mz):
+        """
+        Check the magnetometer measurement against the field magnitude and dip angle gates
+        :return: False if the correction has to be skipped
+        """
+        if self.mag_field is None and self.mag_dip is None:
+            return True
+        norm = sqrt(mx * mx + my * my + mz * mz)
+        if norm == 0:
+            return True
+        if self.mag_field is not None and abs(norm / self.mag_field - 1) > self.mag_tolerance:
+            self.rejected_mag += 1
+            return False
+        if self.mag_dip is not None:
+            # Dip angle relative to the vertical of the current estimate
+            q0, q1, q2, q3 = self._q
+            hx, hy, hz = _earth_field(q0, q1, q2, q3, mx / norm, my / norm, mz / norm)
+            if abs(asin(min(1.0, max(-1.0, -hz))) - self.mag_dip) > self.dip_tolerance:
+                self.rejected_mag += 1
+                return False
+        return True
+
+    def update(self, gyroscope, accelerometer, magnetometer, dt=None, timestamp=None):
         """
         Perform one update step with data from a AHRS sensor array
         :param gyroscope: A three-element array containing the gyroscope data in radians per second.
         :param accelerometer: A three-element array containing the accelerometer data.
         :param magnetometer: A three-element array containing the magnetometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
         :return:
         """
-        q = self.quaternion
-
-        gyroscope = np.array(gyroscope, dtype=float).flatten()
-        accelerometer = np.array(accelerometer, dtype=float).flatten()
-        magnetometer = np.array(magnetometer, dtype=float).flatten()
-
-        # Normalise accelerometer measurement
-        if norm(accelerometer) is 0:
-            warnings.warn("accelerometer is zero")
+        dt = float(self.step_period(dt, timestamp))
+        beta = self._gain(dt)
+        q0, q1, q2, q3 = self._q
+        gx, gy, gz = _vector(gyroscope)
+        ax, ay, az = _vector(accelerometer)
+        mx, my, mz = _vector(magnetometer)
+        # Rejected measurements drop out of the corrective step
+        accel = self._accel_accepted(ax, ay, az)
+        mag = self._mag_accepted(mx, my, mz)
+        if accel and mag:
+            code, q0, q1, q2, q3 = _ahrs_step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, mx, my, mz, beta, dt)
+        elif accel:
+            code, q0, q1, q2, q3 = _imu_step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, beta, dt)
+        elif mag:
+            code, q0, q1, q2, q3 = _mag_step(q0, q1, q2, q3, gx, gy, gz, mx, my, mz, beta, dt)
+        else:
+            code = STEP_OK
+            q0, q1, q2, q3 = _integrate(q0, q1, q2, q3, gx, gy, gz, 0.0, 0.0, 0.0, 0.0, 0.0, dt)
+        if code != STEP_OK:
+            warnings.warn(_WARNINGS[code])
             return
-        accelerometer /= norm(accelerometer)
+        self._q = (q0, q1, q2, q3)
 
-        # Normalise magnetometer measurement
-        if norm(magnetometer) is 0:
-            warnings.warn("magnetometer is zero")
-            return
-        magnetometer /= norm(magnetometer)
-
-        h = q * (Quaternion(0, magnetometer[0], magnetometer[1], magnetometer[2]) * q.conj())
-        b = np.array([0, norm(h[1:3]), 0, h[3]])
-
-        # Gradient descent algorithm corrective step
-        f = np.array([
-            2 * (q[1] * q[3] - q[0] * q[2]) - accelerometer[0],
-            2 * (q[0] * q[1] + q[2] * q[3]) - accelerometer[1],
-            2 * (0.5 - q[1] ** 2 - q[2] ** 2) - accelerometer[2],
-            2 * b[1] * (0.5 - q[2] ** 2 - q[3] ** 2) + 2 * b[3] * (q[1] * q[3] - q[0] * q[2]) - magnetometer[0],
-            2 * b[1] * (q[1] * q[2] - q[0] * q[3]) + 2 * b[3] * (q[0] * q[1] + q[2] * q[3]) - magnetometer[1],
-            2 * b[1] * (q[0] * q[2] + q[1] * q[3]) + 2 * b[3] * (0.5 - q[1] ** 2 - q[2] ** 2) - magnetometer[2]
-        ])
-        j = np.array([
-            [-2 * q[2], 2 * q[3], -2 * q[0], 2 * q[1]],
-            [2 * q[1], 2 * q[0], 2 * q[3], 2 * q[2]],
-            [0, -4 * q[1], -4 * q[2], 0],
-            [-2 * b[3] * q[2], 2 * b[3] * q[3], -4 * b[1] * q[2] - 2 * b[3] * q[0], -4 * b[1] * q[3] + 2 * b[3] * q[1]],
-            [-2 * b[1] * q[3] + 2 * b[3] * q[1], 2 * b[1] * q[2] + 2 * b[3] * q[0], 2 * b[1] * q[1] + 2 * b[3] * q[3],
-             -2 * b[1] * q[0] + 2 * b[3] * q[2]],
-            [2 * b[1] * q[2], 2 * b[1] * q[3] - 4 * b[3] * q[1], 2 * b[1] * q[0] - 4 * b[3] * q[2], 2 * b[1] * q[1]]
-        ])
-        step = j.T.dot(f)
-        step /= norm(step)  # normalise step magnitude
-
-        # Compute rate of change of quaternion
-        qdot = (q * Quaternion(0, gyroscope[0], gyroscope[1], gyroscope[2])) * 0.5 - self.beta * step.T
-
-        # Integrate to yield quaternion
-        q += qdot * self.sample_period
-        self.quaternion = Quaternion(q / norm(q))  # normalise quaternion
-
-    def update_imu(self, gyroscope, accelerometer):
+    def update_imu(self, gyroscope, accelerometer, dt=None, timestamp=None):
         """
         Perform one update step with data from a IMU sensor array
         :param gyroscope: A three-element array containing the gyroscope data in radians per second.
         :param accelerometer: A three-element array containing the accelerometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
         """
-        q = self.quaternion
+        dt = float(self.step_period(dt, timestamp))
+        beta = self._gain(dt)
+        q0, q1, q2, q3 = self._q
+        gx, gy, gz = _vector(gyroscope)
+        ax, ay, az = _vector(accelerometer)
+        if self._accel_accepted(ax, ay, az):
+            code, q0, q1, q2, q3 = _imu_step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, beta, dt)
+        else:
+            code = STEP_OK
+            q0, q1, q2, q3 = _integrate(q0, q1, q2, q3, gx, gy, gz, 0.0, 0.0, 0.0, 0.0, 0.0, dt)
+        if code != STEP_OK:
+            warnings.warn(_WARNINGS[code])
+            return
+        self._q = (q0, q1, q2, q3)
+
+    def propagate(self, gyroscope, dt=None, timestamp=None):
+        """
+        Integrate the gyroscope alone. Together with correct_accel and correct_mag this splits update into
+        a cheap step for every gyroscope sample and corrections run only when fresh sensor data arrives
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        """
+        dt = float(self.step_period(dt, timestamp))
+        self._gain(dt)
+        q0, q1, q2, q3 = self._q
+        gx, gy, gz = _vector(gyroscope)
+        self._q = _integrate(q0, q1, q2, q3, gx, gy, gz, 0.0, 0.0, 0.0, 0.0, 0.0, dt)
+        self._accel_elapsed += dt
+        self._mag_elapsed += dt
+
+    def _correction_period(self, dt, elapsed):
+        # By default a correction covers the time propagated since the previous one
+        if dt is not None:
+            return float(dt)
+        return elapsed if elapsed > 0 else float(self.sample_period)
 
-        gyroscope = np.array(gyroscope, dtype=float).flatten()
-        accelerometer = np.array(accelerometer, dtype=float).flatten()
+    def correct_accel(self, accelerometer, dt=None):
+        """
+        Corrective step towards the accelerometer measurement (roll and pitch)
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param dt: Period covered by the correction in seconds, defaults to the time propagated since the previous
+                   accelerometer correction
+        """
+        dt = self._correction_period(dt, self._accel_elapsed)
+        self._accel_elapsed = 0.0
+        q0, q1, q2, q3 = self._q
+        ax, ay, az = _vector(accelerometer)
+        if not self._accel_accepted(ax, ay, az):
+            return
+        code, q0, q1, q2, q3 = _imu_step(q0, q1, q2, q3, 0.0, 0.0, 0.0, ax, ay, az, self.current_beta, dt)
+        if code != STEP_OK:
+            warnings.warn(_WARNINGS[code])
+            return
+        self._q = (q0, q1, q2, q3)
 
-        # Normalise accelerometer measurement
-        if norm(accelerometer) is 0:
-            warnings.warn("accelerometer is zero")
+    def correct_mag(self, magnetometer, dt=None):
+        """
+        Corrective step towards the magnetometer measurement (mostly heading)
+        :param magnetometer: A three-element array containing the magnetometer data.
+        :param dt: Period covered by the correction in seconds, defaults to the time propagated since the previous
+                   magnetometer correction
+        """
+        dt = self._correction_period(dt, self._mag_elapsed)
+        self._mag_elapsed = 0.0
+        q0, q1, q2, q3 = self._q
+        mx, my, mz = _vector(magnetometer)
+        if not self._mag_accepted(mx, my, mz):
+            return
+        code, q0, q1, q2, q3 = _mag_step(q0, q1, q2, q3, 0.0, 0.0, 0.0, mx, my, mz, self.current_beta, dt)
+        if code != STEP_OK:
+            warnings.warn(_WARNINGS[code])
             return
-        accelerometer /= norm(accelerometer)
-
-        # Gradient descent algorithm corrective step
-        f = np.array([
-            2 * (q[1] * q[3] - q[0] * q[2]) - accelerometer[0],
-            2 * (q[0] * q[1] + q[2] * q[3]) - accelerometer[1],
-            2 * (0.5 - q[1] ** 2 - q[2] ** 2) - accelerometer[2]
-        ])
-        j = np.array([
-            [-2 * q[2], 2 * q[3], -2 * q[0], 2 * q[1]],
-            [2 * q[1], 2 * q[0], 2 * q[3], 2 * q[2]],
-            [0, -4 * q[1], -4 * q[2], 0]
-        ])
-        step = j.T.dot(f)
-        step /= norm(step)  # normalise step magnitude
-
-        # Compute rate of change of quaternion
-        qdot = (q * Quaternion(0, gyroscope[0], gyroscope[1], gyroscope[2])) * 0.5 - self.beta * step.T
-
-        # Integrate to yield quaternion
-        q += qdot * self.sample_period
-        self.quaternion = Quaternion(q / norm(q))  # normalise quaternion
+        self._q = (q0, q1, q2, q3)
+
+    def _batch_periods(self, count, dt):
+        """
+        Step periods of a batch
+        :param count: Number of samples
+        :param dt: None (sample_period), a scalar or a sequence of N periods in seconds
+        :return: A float array (compiled kernels) or a list of N periods
+        """
+        periods = np.empty(count)
+        periods[:] = self.sample_period if dt is None else dt
+        return periods if njit is not None else periods.tolist()
+
+    def _sequential(self, step, dt, *columns):
+        """
+        Run a batch through the per-sample step: the gain schedule and the gates depend on the state at every sample
+        :return: An (N, 4) array of quaternions after every step
+        """
+        columns = [np.asarray(column, dtype=np.float64).reshape(-1, 3) for column in columns]
+        count = len(columns[0])
+        for column in columns[1:]:
+            if len(column) != count:
+                raise ValueError("Expecting {} rows, got {}".format(count, len(column)))
+        periods = np.empty(count)
+        periods[:] = self.sample_period if dt is None else dt
+        out = np.empty((count, 4))
+        for i, row in enumerate(zip(*[column.tolist() for column in columns])):
+            step(*row, dt=periods[i])
+            out[i] = self._q
+        return out
+
+    def _finish_batch(self, out, skipped):
+        trajectory = np.asarray(out, dtype=np.float64).reshape(-1, 4)
+        if len(trajectory):
+            w, x, y, z = trajectory[-1].tolist()
+            self._q = (w, x, y, z)
+        if skipped:
+            warnings.warn("{} samples with a zero accelerometer or magnetometer were skipped".format(skipped))
+        return trajectory
+
+    def update_batch(self, gyroscope, accelerometer, magnetometer, dt=None):
+        """
+        Perform sequential update steps over arrays of AHRS sensor data, continuing from the current state
+        :param gyroscope: An (N, 3) array containing the gyroscope data in radians per second.
+        :param accelerometer: An (N, 3) array containing the accelerometer data.
+        :param magnetometer: An (N, 3) array containing the magnetometer data.
+        :param dt: Step period in seconds, a scalar or N per-sample periods; defaults to sample_period
+        :return: An (N, 4) array of quaternions after every step
+        """
+        if self._gated():
+            return self._sequential(self.update, dt, gyroscope, accelerometer, magnetometer)
+        gyroscope = _rows(gyroscope)
+        count = len(gyroscope)
+        accelerometer = _rows(accelerometer, count)
+        magnetometer = _rows(magnetometer, count)
+        out = np.empty(4 * count) if njit is not None else [0.0] * (4 * count)
+        q0, q1, q2, q3 = self._q
+        skipped = _ahrs_batch(q0, q1, q2, q3, gyroscope, accelerometer, magnetometer, float(self.beta),
+                              self._batch_periods(count, dt), out)
+        return self._finish_batch(out, skipped)
+
+    def update_imu_batch(self, gyroscope, accelerometer, dt=None):
+        """
+        Perform sequential update steps over arrays of IMU sensor data, continuing from the current state
+        :param gyroscope: An (N, 3) array containing the gyroscope data in radians per second.
+        :param accelerometer: An (N, 3) array containing the accelerometer data.
+        :param dt: Step period in seconds, a scalar or N per-sample periods; defaults to sample_period
+        :return: An (N, 4) array of quaternions after every step
+        """
+        if self._gated():
+            return self._sequential(self.update_imu, dt, gyroscope, accelerometer)
+        gyroscope = _rows(gyroscope)
+        count = len(gyroscope)
+        accelerometer = _rows(accelerometer, count)
+        out = np.empty(4 * count) if njit is not None else [0.0] * (4 * count)
+        q0, q1, q2, q3 = self._q
+        skipped = _imu_batch(q0, q1, q2, q3, gyroscope, accelerometer, float(self.beta),
+                             self._batch_periods(count, dt), out)
+        return self._finish_batch(out, skipped)
+
+    async def stream(self, samples):
+        """
+        Run the filter over an asynchronous stream of IMU samples
+        :param samples: An async iterable of IMUSample objects, e.g. TroykaIMU.stream('imu')
+        :return: An async generator of (timestamp, quaternion) pairs
+        """
+        async for sample in samples:
+            self.update(sample.gyro, sample.accel, sample.mag, timestamp=sample.timestamp)
+            yield sample.timestamp, self.quaternion
+
+
+class MadgwickAHRSBank(object):
+    """
+    K Madgwick filters updated in lockstep, e.g. one per IMU of a rig or a sweep over beta.
+    The state is a (K, 4) quaternion array; every step updates all filters at once.
+    numba is required for the bank to pay off for a few filters: the numpy fallback costs about as much
+    as eight single MadgwickAHRS updates per step and only wins from about ten filters up
+    """
+    timestamp = None
+
+    def __init__(self, beta, sampleperiod=None, quaternions=None):
+        """
+        Initialize the bank
+        :param beta: K algorithm gains, one per filter
+        :param sampleperiod: Sample period, a scalar or K periods
+        :param quaternions: Initial quaternions, a four-element array or a (K, 4) array
+        """
+        self.beta = np.array(beta, dtype=np.float64).ravel()
+        count = len(self.beta)
+        self.sample_period = np.empty(count)
+        self.sample_period[:] = MadgwickAHRS.sample_period if sampleperiod is None else sampleperiod
+        self.q = np.zeros((count, 4))
+        self.q[:, 0] = 1
+        self._buffers = None
+        if quaternions is not None:
+            self.q[:] = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+
+    # Measuring the step period from timestamps is shared with the single filter
+    step_period = MadgwickAHRS.step_period
+
+    def __len__(self):
+        return len(self.q)
+
+    def quaternion(self, k):
+        """
+        Orientation of one filter of the bank
+        :param k: Index of the filter
+        :return: Quaternion
+        """
+        return Quaternion(self.q[k].copy())
+
+    def _rows(self, values):
+        # (K, 3) input; a single three-element measurement is shared by all filters
+        rows = np.empty((len(self.q), 3))
+        rows[:] = values
+        return rows
+
+    def _periods(self, dt):
+        periods = np.empty(len(self.q))
+        periods[:] = dt
+        return periods
+
+    def update(self, gyroscope, accelerometer, magnetometer, dt=None, timestamp=None):
+        """
+        Perform one update step of all filters with data from AHRS sensor arrays
+        :param gyroscope: A (K, 3) array or a three-element array shared by all filters, radians per second
+        :param accelerometer: A (K, 3) array or a three-element array containing the accelerometer data
+        :param magnetometer: A (K, 3) array or a three-element array containing the magnetometer data
+        :param dt: Step period in seconds, a scalar or K periods; defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        :return: The (K, 4) quaternion array
+        """
+        dt = self._periods(self.step_period(dt, timestamp))
+        gyroscope = self._rows(gyroscope)
+        accelerometer = self._rows(accelerometer)
+        magnetometer = self._rows(magnetometer)
+        if njit is not None:
+            skipped = _ahrs_bank(self.q, gyroscope, accelerometer, magnetometer, self.beta, dt)
+        else:
+            skipped = self._step(gyroscope, accelerometer, magnetometer, dt)
+        if skipped:
+            warnings.warn("{} filters skipped a zero accelerometer or magnetometer".format(skipped))
+        return self.q
+
+    def update_imu(self, gyroscope, accelerometer, dt=None, timestamp=None):
+        """
+        Perform one update step of all filters with data from IMU sensor arrays
+        :param gyroscope: A (K, 3) array or a three-element array shared by all filters, radians per second
+        :param accelerometer: A (K, 3) array or a three-element array containing the accelerometer data
+        :param dt: Step period in seconds, a scalar or K periods; defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        :return: The (K, 4) quaternion array
+        """
+        dt = self._periods(self.step_period(dt, timestamp))
+        gyroscope = self._rows(gyroscope)
+        accelerometer = self._rows(accelerometer)
+        if njit is not None:
+            skipped = _imu_bank(self.q, gyroscope, accelerometer, self.beta, dt)
+        else:
+            skipped = self._step(gyroscope, accelerometer, None, dt)
+        if skipped:
+            warnings.warn("{} filters skipped a zero accelerometer".format(skipped))
+        return self.q
+
+    def _workspace(self):
+        """
+        Work buffers of the numpy step in the (components, K) layout, allocated once per bank size
+        """
+        count = len(self.q)
+        if self._buffers is None or self._buffers['q'].shape[1] != count:
+            self._buffers = {
+                'q': np.empty((4, count)),
+                'vectors': np.empty((2, 3, count)),
+                'gyroscope': np.empty((3, count)),
+                'norm': np.empty((2, count)),
+                'd': np.empty((36, count)),
+                'r': np.empty((9, count)),
+                'w': np.zeros((9, count)),
+                'field': np.empty((3, count)),
+                'qg': np.empty((4, 3, count)),
+                's': np.empty((4, count)),
+                'qdot': np.empty((4, count)),
+            }
+        return self._buffers
+
+    def _step(self, gyroscope, accelerometer, magnetometer, dt):
+        """
+        Vectorised step of all filters with numpy, used when numba is not available.
+        The rows of the rotation matrix are quadratic forms of q (written as in the single filter kernels),
+        so the Jacobian is one matrix product D = _BANK_JACOBIAN.dot(q), the rotation is R = I + q.D / 2
+        and the gradient J.T.f is a single contraction with D. The work runs on preallocated (components, K)
+        buffers; results agree with the kernels up to rounding.
+        A step still costs a few tens of numpy calls (about 50-80 us at K = 1, 75-90 us at K = 64 against
+        about 10 us for one MadgwickAHRS.update): without numba the bank pays off from about ten filters up
+        :return: The number of filters that skipped the step
+        """
+        buffers = self._workspace()
+        q = buffers['q']
+        q[:] = self.q.T
+        count = 1 if magnetometer is None else 2
+        vectors = buffers['vectors'][:count]
+        vectors[0] = accelerometer.T
+        if magnetometer is not None:
+            vectors[1] = magnetometer.T
+        norm = np.einsum('nck,nck->nk', vectors, vectors, out=buffers['norm'][:count])
+        valid = norm.all(axis=0)
+        # A zero measurement stays zero; its filter keeps the previous state
+        norm[norm == 0] = 1
+        np.sqrt(norm, out=norm)
+        vectors /= norm[:, None]
+
+        # dR/dq_i = D[i], R = I + q.D / 2 (rows: earth x, y, z axes in the sensor frame)
+        d = np.dot(_BANK_JACOBIAN, q, out=buffers['d']).reshape(4, 9, -1)
+        r = np.einsum('ik,ixk->xk', q, d, out=buffers['r'])
+        r *= 0.5
+        r += _BANK_IDENTITY
+
+        # f: the accelerometer part is row z - a, the magnetometer part b1 x + b3 z - m;
+        # the weights w collect f so that J.T.f = sum over x of D[:, x] * w[x]
+        w = buffers['w']
+        np.subtract(r[6:9], vectors[0], out=w[6:9])
+        if magnetometer is not None:
+            h = np.einsum('rck,ck->rk', r.reshape(3, 3, -1), vectors[1])
+            b1 = np.hypot(h[0], h[1])
+            b3 = h[2]
+            field = np.multiply(b1, r[0:3], out=buffers['field'])
+            field += b3 * r[6:9]
+            field -= vectors[1]
+            np.multiply(b1, field, out=w[0:3])
+            field *= b3
+            w[6:9] += field
+        else:
+            w[0:3] = 0
+        s = np.einsum('ixk,xk->ik', d, w, out=buffers['s'])
+
+        # normalise step magnitude where it is not zero
+        norm = np.einsum('ik,ik->k', s, s, out=buffers['norm'][0])
+        norm[norm == 0] = 1
+        s /= np.sqrt(norm, out=norm)
+
+        # q = q + (q * (0, gyroscope) * 0.5 - beta * step) * dt, normalised
+        g = buffers['gyroscope']
+        g[:] = gyroscope.T
+        qg = np.multiply(q[:, None, :], g, out=buffers['qg'])
+        qdot = np.dot(_BANK_RATE, qg.reshape(12, -1), out=buffers['qdot'])
+        s *= self.beta
+        qdot -= s
+        qdot *= dt
+        qdot += q
+        norm = np.einsum('ik,ik->k', qdot, qdot, out=buffers['norm'][0])
+        qdot /= np.sqrt(norm, out=norm)
+        if valid.all():
+            self.q[:] = qdot.T
+            return 0
+        self.q[valid] = qdot.T[valid]
+        return len(valid) - np.count_nonzero(valid)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    Mahony AHRS: explicit complementary filter with a proportional-integral correction.
+    Same interface as MadgwickAHRS; the integral term estimates the gyroscope bias.
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+    You should have received a copy of the GNU Lesser General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import warnings
+from math import sqrt
+from madgwickahrs import MadgwickAHRS, _vector
+
+
+class MahonyAHRS(object):
+    sample_period = 1 / 256
+    # Filter state, plain floats w, x, y, z
+    _q = (1.0, 0.0, 0.0, 0.0)
+    # Proportional and integral gains
+    kp = 1.0
+    ki = 0.1
+    # Integral of the error, rad
+    _integral = (0.0, 0.0, 0.0)
+    # Timestamp of the previous step in nanoseconds (time.monotonic_ns())
+    timestamp = None
+
+    def __init__(self, sampleperiod=None, quaternion=None, kp=None, ki=None):
+        """
+        Initialize the class with the given parameters.
+        :param sampleperiod: The sample period in seconds
+        :param quaternion: Initial quaternion
+        :param kp: Proportional gain: how fast the attitude follows the accelerometer and magnetometer
+        :param ki: Integral gain: how fast the gyroscope bias is learned, 0 disables the bias estimate
+        :return:
+        """
+        if sampleperiod is not None:
+            self.sample_period = sampleperiod
+        if quaternion is not None:
+            self.quaternion = quaternion
+        if kp is not None:
+            self.kp = kp
+        if ki is not None:
+            self.ki = ki
+
+    # Orientation, step period and streaming work exactly as in MadgwickAHRS
+    quaternion = MadgwickAHRS.quaternion
+    step_period = MadgwickAHRS.step_period
+    stream = MadgwickAHRS.stream
+
+    @property
+    def gyro_bias(self):
+        """
+        Estimated gyroscope bias in radians per second, to be subtracted from the measurement
+        :return: x, y, z
+        """
+        ki = self.ki
+        return -ki * self._integral[0], -ki * self._integral[1], -ki * self._integral[2]
+
+    def update(self, gyroscope, accelerometer, magnetometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a AHRS sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param magnetometer: A three-element array containing the magnetometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        :return:
+        """
+        mx, my, mz = _vector(magnetometer)
+        norm = sqrt(mx * mx + my * my + mz * mz)
+        if norm == 0:
+            # Without the magnetometer only roll and pitch can be corrected
+            warnings.warn("magnetometer is zero")
+            self.update_imu(gyroscope, accelerometer, dt, timestamp)
+            return
+        mx /= norm
+        my /= norm
+        mz /= norm
+
+        dt = self.step_period(dt, timestamp)
+        q0, q1, q2, q3 = self._q
+        ax, ay, az = _vector(accelerometer)
+
+        # Normalise accelerometer measurement
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if norm == 0:
+            warnings.warn("accelerometer is zero")
+            return
+        ax /= norm
+        ay /= norm
+        az /= norm
+
+        # Reference direction of Earth's magnetic field
+        hx = 2 * mx * (0.5 - q2 * q2 - q3 * q3) + 2 * my * (q1 * q2 - q0 * q3) + 2 * mz * (q1 * q3 + q0 * q2)
+        hy = 2 * mx * (q1 * q2 + q0 * q3) + 2 * my * (0.5 - q1 * q1 - q3 * q3) + 2 * mz * (q2 * q3 - q0 * q1)
+        bx = sqrt(hx * hx + hy * hy)
+        bz = 2 * mx * (q1 * q3 - q0 * q2) + 2 * my * (q2 * q3 + q0 * q1) + 2 * mz * (0.5 - q1 * q1 - q2 * q2)
+
+        # Estimated direction of gravity (v) and magnetic field (w) in the sensor frame
+        vx = 2 * (q1 * q3 - q0 * q2)
+        vy = 2 * (q0 * q1 + q2 * q3)
+        vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+        wx = 2 * bx * (0.5 - q2 * q2 - q3 * q3) + 2 * bz * (q1 * q3 - q0 * q2)
+        wy = 2 * bx * (q1 * q2 - q0 * q3) + 2 * bz * (q0 * q1 + q2 * q3)
+        wz = 2 * bx * (q0 * q2 + q1 * q3) + 2 * bz * (0.5 - q1 * q1 - q2 * q2)
+
+        # Error is the sum of cross products between measured and estimated directions
+        ex = (ay * vz - az * vy) + (my * wz - mz * wy)
+        ey = (az * vx - ax * vz) + (mz * wx - mx * wz)
+        ez = (ax * vy - ay * vx) + (mx * wy - my * wx)
+        self._integrate(q0, q1, q2, q3, _vector(gyroscope), ex, ey, ez, dt)
+
+    def update_imu(self, gyroscope, accelerometer, dt=None, timestamp=None):
+        """
+        Perform one update step with data from a IMU sensor array
+        :param gyroscope: A three-element array containing the gyroscope data in radians per second.
+        :param accelerometer: A three-element array containing the accelerometer data.
+        :param dt: Step period in seconds, defaults to sample_period
+        :param timestamp: Sample timestamp in nanoseconds, used to measure the step period
+        """
+        dt = self.step_period(dt, timestamp)
+        q0, q1, q2, q3 = self._q
+        ax, ay, az = _vector(accelerometer)
+
+        # Normalise accelerometer measurement
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if norm == 0:
+            warnings.warn("accelerometer is zero")
+            return
+        ax /= norm
+        ay /= norm
+        az /= norm
+
+        # Estimated direction of gravity in the sensor frame
+        vx = 2 * (q1 * q3 - q0 * q2)
+        vy = 2 * (q0 * q1 + q2 * q3)
+        vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+
+        # Error is the cross product between measured and estimated directions of gravity
+        ex = ay * vz - az * vy
+        ey = az * vx - ax * vz
+        ez = ax * vy - ay * vx
+        self._integrate(q0, q1, q2, q3, _vector(gyroscope), ex, ey, ez, dt)
+
+    def _integrate(self, q0, q1, q2, q3, gyroscope, ex, ey, ez, dt):
+        """
+        Apply the PI feedback to the gyroscope data and integrate the quaternion
+        :param q0, q1, q2, q3: The quaternion before the step
+        :param gyroscope: The gyroscope data in radians per second
+        :param ex, ey, ez: The error between measured and estimated directions
+        :param dt: Step period in seconds
+        """
+        gx, gy, gz = gyroscope
+        kp = self.kp
+        ki = self.ki
+        if ki > 0:
+            # Integral term accumulates the error: it converges to minus the gyroscope bias over ki
+            ix, iy, iz = self._integral
+            ix += ex * dt
+            iy += ey * dt
+            iz += ez * dt
+            self._integral = (ix, iy, iz)
+            gx += ki * ix
+            gy += ki * iy
+            gz += ki * iz
+        gx += kp * ex
+        gy += kp * ey
+        gz += kp * ez
+
+        # Integrate rate of change of quaternion: q * (0, gyroscope) * 0.5
+        dt *= 0.5
+        qa, qb, qc = q0, q1, q2
+        q0 += (-qb * gx - qc * gy - q3 * gz) * dt
+        q1 += (qa * gx + qc * gz - q3 * gy) * dt
+        q2 += (qa * gy - qb * gz + q3 * gx) * dt
+        q3 += (qa * gz + qb * gy - qc * gx) * dt
+        norm = sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self._q = (q0 / norm, q1 / norm, q2 / norm, q3 / norm)  # normalise quaternion
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Multi-bus, multi-IMU acquisition manager
+# One acquisition worker per I2C bus, samples are exchanged through shared memory ring buffers
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример: два модуля на шине 1 (второй с перемычками на альтернативных адресах) и один на шине 3
+#   manager = IMUManager([
+#       (1, [None, {'gyroscope': 0x69, 'accelerometer': 0x19, 'magnetometer': 0x1E, 'barometer': 0x5D}]),
+#       (3, [None]),
+#   ])
+#   manager.start()
+#   for timestamp, imu, sensor, values in manager.read_new():
+#       print(timestamp, imu, sensor, values)
+#   manager.stop()
+
+import multiprocessing
+import queue
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from acquisition import AcquisitionScheduler
+
+# Одна запись кольцевого буфера: метка времени и до трёх значений (у барометра третье - NaN)
+RECORD = np.dtype([('timestamp', '<i8'), ('values', '<f8', (3,))])
+
+
+class SharedRings(object):
+    # Набор кольцевых буферов в одном блоке разделяемой памяти.
+    # Начало блока - счётчики записей (int64) по каналам, далее записи всех каналов.
+    # В каждый канал пишет только один процесс
+    def __init__(self, channels, capacity, name=None):
+        self.channels = channels
+        self.capacity = capacity
+        size = 8 * channels + RECORD.itemsize * channels * capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.counts = np.ndarray((channels,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((channels, capacity), dtype=RECORD, buffer=self.shm.buf, offset=8 * channels)
+        if name is None:
+            self.counts[:] = 0
+            # Незаполненные значения (третье у барометра) остаются NaN
+            self.records['values'] = np.nan
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def append(self, channel, timestamp, values):
+        count = int(self.counts[channel])
+        record = self.records[channel, count % self.capacity]
+        record['timestamp'] = timestamp
+        record['values'][:len(values)] = values
+        # Счётчик увеличиваем после записи данных
+        self.counts[channel] = count + 1
+
+    def since(self, channel, position):
+        # Записи канала после position. Возвращает (новая позиция, записи)
+        count = int(self.counts[channel])
+        start = max(position, count - self.capacity)
+        records = self.records[channel, np.arange(start, count) % self.capacity]
+        # Отбрасываем записи, которые писатель успел перезаписать во время копирования. Запись номер count
+        # занимает ячейку записи count - capacity ещё до увеличения счётчика, поэтому ненадёжна и она
+        overwritten = int(self.counts[channel]) - self.capacity - start + 1
+        if overwritten > 0:
+            records = records[overwritten:]
+        return count, records
+
+    def close(self, unlink=False):
+        self.counts = self.records = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _check_addresses(port, modules, sensors):
+    # Два модуля на одном адресе читали бы один и тот же датчик. Проверяем фактические адреса:
+    # барометр без явного адреса находится автоопределением, которое берёт первый отвечающий
+    claimed = {}
+    for index, imu in enumerate(modules):
+        for sensor in sensors:
+            address = getattr(imu, sensor).ctrl_address()
+            if address in claimed:
+                raise ValueError('bus {}: {} of module {} uses address 0x{:02X} of {} of module {}, '
+                                 'set distinct addresses'.format(port, sensor, index, address,
+                                                                 claimed[address][1], claimed[address][0]))
+            claimed[address] = (index, sensor)
+
+
+def _acquire(port, imus, bus_factory, rings_name, channels, capacity, first_channel, stop, errors):
+    # Рабочий цикл одной шины: опрашивает все модули на шине и пишет замеры в разделяемую память.
+    # Ошибка (например, IOError шины) передаётся родителю через очередь errors
+    from pytroykaimu import TroykaIMU
+    rings = SharedRings(channels, capacity, rings_name)
+    try:
+        bus = bus_factory(port) if bus_factory is not None else None
+        modules = [TroykaIMU(port, bus=bus, addresses=addresses) for addresses in imus]
+        sensors = AcquisitionScheduler.sensors
+        _check_addresses(port, modules, sensors)
+        schedulers = [AcquisitionScheduler(imu) for imu in modules]
+        while not stop.is_set():
+            for index, scheduler in enumerate(schedulers):
+                base = first_channel + index * len(sensors)
+                for name, timestamp, sample in scheduler.poll():
+                    rings.append(base + sensors.index(name), timestamp, sample)
+            due = [d for d in (s.next_due() for s in schedulers) if d is not None]
+            if not due:
+                break
+            delay = min(due) - time.monotonic()
+            if delay > 0:
+                stop.wait(delay)
+    except Exception as error:
+        errors.put((port, '{!r}'.format(error)))
+    finally:
+        rings.close()
+
+
+class IMUManager(object):
+    # specs - список (номер шины, [адреса модуля или None для адресов по умолчанию, ...])
+    # processes - True: отдельный процесс на шину (масштабируется по ядрам), False: поток на шину
+    # bus_factory - функция port -> объект шины (например, для VirtualSMBus); None - smbus.SMBus(port)
+    def __init__(self, specs, processes=True, capacity=4096, bus_factory=None):
+        self.specs = [(port, list(imus)) for port, imus in specs]
+        self.processes = processes
+        self.capacity = capacity
+        self.bus_factory = bus_factory
+        # Глобальный номер модуля -> (шина, номер на шине)
+        self.imus = [(port, index) for port, imus in self.specs for index in range(len(imus))]
+        self.sensors = AcquisitionScheduler.sensors
+        self.rings = SharedRings(len(self.imus) * len(self.sensors), capacity)
+        self._positions = [0] * self.rings.channels
+        self._workers = []
+        self._stop = None
+        self._errors = None
+
+    def channel(self, imu, sensor):
+        return imu * len(self.sensors) + self.sensors.index(sensor)
+
+    def start(self):
+        if self.processes:
+            self._stop = multiprocessing.Event()
+            self._errors = multiprocessing.Queue()
+            worker = multiprocessing.Process
+        else:
+            self._stop = threading.Event()
+            self._errors = queue.Queue()
+            worker = threading.Thread
+        first_channel = 0
+        for port, imus in self.specs:
+            args = (port, imus, self.bus_factory, self.rings.name, self.rings.channels, self.capacity,
+                    first_channel, self._stop, self._errors)
+            process = worker(target=_acquire, args=args, name='IMUManager bus {}'.format(port))
+            process.daemon = True
+            process.start()
+            self._workers.append(process)
+            first_channel += len(imus) * len(self.sensors)
+
+    def stop(self, timeout=None):
+        if self._stop is not None:
+            self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def check(self):
+        # Поднимает IOError, если рабочий цикл какой-либо шины завершился с ошибкой
+        if self._errors is None:
+            return
+        try:
+            port, error = self._errors.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            raise IOError('IMUManager worker for bus {} failed: {}'.format(port, error))
+        for worker in self._workers:
+            # Процесс, убитый сигналом, не успевает ничего сообщить
+            exitcode = getattr(worker, 'exitcode', None)
+            if exitcode:
+                raise IOError('IMUManager worker {} exited with code {}'.format(worker.name, exitcode))
+
+    def close(self):
+        self.stop()
+        self.rings.close(unlink=True)
+
+    def latest(self, imu, sensor, n=1):
+        # Последние n замеров датчика модуля: (метки времени, значения)
+        self.check()
+        channel = self.channel(imu, sensor)
+        count = int(self.rings.counts[channel])
+        position, records = self.rings.since(channel, max(0, count - n))
+        return records['timestamp'], self._values(sensor, records)
+
+    def _values(self, sensor, records):
+        return records['values'][:, :2] if sensor == 'barometer' else records['values']
+
+    def read_new(self):
+        # Все новые замеры всех модулей с прошлого вызова, упорядоченные по времени:
+        # [(метка времени, номер модуля, датчик, значения)]
+        self.check()
+        merged = []
+        for channel in range(self.rings.channels):
+            self._positions[channel], records = self.rings.since(channel, self._positions[channel])
+            imu, sensor = divmod(channel, len(self.sensors))
+            sensor = self.sensors[sensor]
+            for timestamp, values in zip(records['timestamp'].tolist(), self._values(sensor, records).tolist()):
+                merged.append((timestamp, imu, sensor, values))
+        merged.sort(key=lambda item: item[0])
+        return merged
@@ -17,15 +17,191 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 #
+import time
+import warnings
 from lis331dlh import LIS331DLH     # Акселерометр
 from l3g4200d import L3G4200D       # Гироскоп
 from lis3mdl import LIS3MDL         # Магнитометр
 from lps331ap import LPS331AP       # Барометр
 
+try:
+    # smbus2 умеет объединять несколько сообщений в одну транзакцию I2C_RDWR
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
+
+
+class IMUSample(object):
+    # Один согласованный замер всех датчиков модуля с общей меткой времени
+    __slots__ = ('timestamp', 'gyro', 'accel', 'mag', 'pressure', 'temperature')
+
+    def __init__(self, timestamp, gyro, accel, mag, pressure=None, temperature=None):
+        self.timestamp = timestamp      # time.monotonic_ns()
+        self.gyro = gyro                # rad/s
+        self.accel = accel              # g
+        self.mag = mag                  # calibrated gauss
+        self.pressure = pressure        # mmHg
+        self.temperature = temperature  # C
+
+    def __repr__(self):
+        return 'IMUSample(timestamp={}, gyro={}, accel={}, mag={}, pressure={}, temperature={})'.format(
+            self.timestamp, self.gyro, self.accel, self.mag, self.pressure, self.temperature)
+
 
 class TroykaIMU(object):
-    def __init__(self):
-        self.accelerometer = LIS331DLH()
-        self.gyroscope = L3G4200D()
-        self.magnetometer = LIS3MDL()
-        self.barometer = LPS331AP()
+    def __init__(self, port=1, bus=None, profiles=None, addresses=None, reset=True, warm=False):
+        # bus - общий объект шины (smbus.SMBus, smbus2.SMBus или VirtualSMBus)
+        # profiles - профили конфигурации датчиков, например
+        #   {'gyroscope': L3G4200D.profile('2000'), 'accelerometer': LIS331DLH.profile('4G')}
+        # addresses - адреса датчиков, если они отличаются от адресов по умолчанию, например
+        #   {'gyroscope': 0x69, 'accelerometer': 0x19, 'magnetometer': 0x1E}
+        #   адрес барометра без явного указания определяется опросом
+        # reset - сбрасывать датчики при подключении (см. discovery.open_imu)
+        # warm - подключиться к работающим датчикам без сброса, переписав только отличающиеся регистры
+        profiles = profiles or {}
+        addresses = addresses or {}
+        self.accelerometer = LIS331DLH(port, addresses.get('accelerometer', LIS331DLH.I2C_DEFAULT_ADDRESS),
+                                       bus=bus, profile=profiles.get('accelerometer'), reset=reset, warm=warm)
+        self.gyroscope = L3G4200D(port, addresses.get('gyroscope', L3G4200D.I2C_DEFAULT_ADDRESS),
+                                  bus=bus, profile=profiles.get('gyroscope'), reset=reset, warm=warm)
+        self.magnetometer = LIS3MDL(port, addresses.get('magnetometer', LIS3MDL.I2C_DEFAULT_ADDRESS),
+                                    bus=bus, profile=profiles.get('magnetometer'), reset=reset, warm=warm)
+        self.barometer = LPS331AP(port, bus=bus, profile=profiles.get('barometer'),
+                                  address=addresses.get('barometer'), reset=reset, warm=warm)
+        self._stream = None
+
+    def stream(self, channel, maxsize=64):
+        # Асинхронный поток замеров: async for timestamp, sample in imu.stream('gyroscope')
+        # channel - 'gyroscope', 'accelerometer', 'magnetometer', 'barometer' или 'imu' (IMUSample)
+        if self._stream is None:
+            # asyncio нужен только потребителям потоков, импортируем по требованию
+            from imustream import IMUStream
+            self._stream = IMUStream(self)
+        return self._stream.subscribe(channel, maxsize)
+
+    def initial_alignment(self, samples=16, ahrs=None, timeout=1.0):
+        # Начальная ориентация по среднему samples новых замеров акселерометра и магнитометра (TRIAD):
+        # фильтр сразу выдаёт верную ориентацию, без сходимости от Quaternion(1, 0, 0, 0).
+        # Модуль должен быть неподвижен. ahrs - фильтр (MadgwickAHRS, MahonyAHRS, EKFAHRS), которому передаётся
+        # ориентация: через align, если он есть, иначе через свойство quaternion;
+        # timeout - сколько ждать новых замеров, сек. Возвращает Quaternion
+        # Quaternion тянет за собой numpy, импортируем по требованию
+        from quaternion import Quaternion
+        accel = []
+        mag = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            rates = []
+            if len(accel) < samples:
+                value = self.accelerometer.read_new_gxyz()
+                if value is not None:
+                    accel.append(value)
+                rates.append(self.accelerometer.data_rate_hz())
+            if len(mag) < samples:
+                value = self.magnetometer.read_new_calibrate_gauss_xyz()
+                if value is not None:
+                    mag.append(value)
+                rates.append(self.magnetometer.data_rate_hz())
+            if len(accel) >= samples and len(mag) >= samples:
+                break
+            # Не крутимся на шине: ждём период более быстрого из ещё нужных датчиков.
+            # Выключенный датчик (частота 0) новых замеров не даст, ждать его незачем
+            rate = max(rates)
+            if rate <= 0:
+                break
+            time.sleep(max(0.0, min(1.0 / rate, deadline - time.monotonic())))
+        # Если новых замеров не дождались, берём текущие значения регистров: датчик, возможно, выключен
+        # и ориентация получится по одному, возможно устаревшему, замеру
+        if not accel:
+            warnings.warn('no new accelerometer samples in {} s, aligning with a single register read'.format(timeout))
+            accel.append(self.accelerometer.read_gxyz())
+        if not mag:
+            warnings.warn('no new magnetometer samples in {} s, aligning with a single register read'.format(timeout))
+            mag.append(self.magnetometer.read_calibrate_gauss_xyz())
+        accel = [sum(axis) / len(accel) for axis in zip(*accel)]
+        mag = [sum(axis) / len(mag) for axis in zip(*mag)]
+        if ahrs is not None and hasattr(ahrs, 'align'):
+            # align дополнительно пропускает начальное большое усиление MadgwickAHRS
+            return ahrs.align(accel, mag)
+        quaternion = Quaternion.from_accel_mag(accel, mag)
+        if ahrs is not None:
+            ahrs.quaternion = quaternion
+        return quaternion
+
+    def read_all(self, barometer=False):
+        # Читаем все датчики за один проход. Если шина поддерживает I2C_RDWR (smbus2),
+        # все запросы уходят одним системным вызовом, иначе читаем датчики по очереди
+        if i2c_msg is not None and hasattr(self.gyroscope.wire, 'i2c_rdwr'):
+            blocks = self._read_blocks_rdwr(barometer)
+        else:
+            blocks = self._read_blocks(barometer)
+        timestamp = time.monotonic_ns()
+
+        gyro = self._unpack_xyz(self.gyroscope, blocks[0])
+        accel = self._unpack_xyz(self.accelerometer, blocks[1])
+        mag = self.magnetometer.calibrate(self._unpack_xyz(self.magnetometer, blocks[2]))
+
+        mult, deg_to_rad = self.gyroscope._mult, self.gyroscope.DEG_TO_RAD
+        sample = IMUSample(timestamp,
+                           (gyro[0] * mult * deg_to_rad, gyro[1] * mult * deg_to_rad, gyro[2] * mult * deg_to_rad),
+                           (accel[0] * self.accelerometer._mult,
+                            accel[1] * self.accelerometer._mult,
+                            accel[2] * self.accelerometer._mult),
+                           (mag[0] / self.magnetometer._mult,
+                            mag[1] / self.magnetometer._mult,
+                            mag[2] / self.magnetometer._mult))
+        if barometer:
+            values = blocks[3]
+            # PRESS_OUT_XL PRESS_OUT_L PRESS_OUT_H TEMP_OUT_L TEMP_OUT_H
+            pressure = values[2] << 16 | values[1] << 8 | values[0]
+            temperature = self.barometer.signed_int32(values[4] << 8 | values[3])
+            sample.pressure = pressure / self.barometer.pressure_measure[self.barometer.DEFAULT_PRESSURE_MEASURE]
+            sample.temperature = temperature / 480 + 42.5
+        return sample
+
+    def _block_requests(self, barometer):
+        # (адрес, регистр с битом автоинкремента, длина)
+        requests = [
+            (self.gyroscope._addr, self.gyroscope.register['OUT_X_L'] | (1 << 7), 6),
+            (self.accelerometer._addr, self.accelerometer.register['OUT_X_L'] | (1 << 7), 6),
+            self._magnetometer_request(),
+        ]
+        if barometer:
+            # Давление и температура идут подряд: 0x28..0x2C
+            requests.append((self.barometer._address,
+                             self.barometer.register['PRESS_POUT_XL_REH'] | (1 << 7), 5))
+        return requests
+
+    def _magnetometer_request(self):
+        magnetometer = self.magnetometer
+        if magnetometer._ctrlReg5 & (1 << 7):
+            # FAST_READ: автоинкремент только по старшим байтам OUT_X_H, OUT_Y_H, OUT_Z_H
+            return magnetometer._address, magnetometer.register['OUT_X_H'] | (1 << 7), 3
+        return magnetometer._address, magnetometer.register['OUT_X_L'] | (1 << 7), 6
+
+    def _read_blocks(self, barometer):
+        wire = self.gyroscope.wire
+        return [wire.read_i2c_block_data(address, reg, length)
+                for address, reg, length in self._block_requests(barometer)]
+
+    def _read_blocks_rdwr(self, barometer):
+        messages = []
+        reads = []
+        for address, reg, length in self._block_requests(barometer):
+            read = i2c_msg.read(address, length)
+            messages.append(i2c_msg.write(address, [reg]))
+            messages.append(read)
+            reads.append(read)
+        self.gyroscope.wire.i2c_rdwr(*messages)
+        return [list(read) for read in reads]
+
+    @staticmethod
+    def _unpack_xyz(sensor, values):
+        if len(values) == 3:
+            # Только старшие байты (FAST_READ), 16-битная шкала как у read_fast_xyz
+            return (sensor.signed_int32(values[0] << 8),
+                    sensor.signed_int32(values[1] << 8),
+                    sensor.signed_int32(values[2] << 8))
+        return (sensor.signed_int32(values[1] << 8 | values[0]),
+                sensor.signed_int32(values[3] << 8 | values[2]),
+                sensor.signed_int32(values[5] << 8 | values[4]))
@@ -13,8 +13,9 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import warnings
 import numpy as np
-from math import atan2, asin, sin, acos, cos, degrees
+from math import atan2, asin, sin, acos, cos, degrees, sqrt
 import numbers
 
 
@@ -80,6 +81,54 @@ class Quaternion:
         s = sin(rad / 2)
         return Quaternion(cos(rad / 2), x * s, y * s, z * s)
 
+    @staticmethod
+    def from_accel_mag(accelerometer, magnetometer=None):
+        """
+        Ориентация по направлениям силы тяжести и магнитного поля (TRIAD)
+        Orientation from the directions of gravity and of the magnetic field (TRIAD), in the frame of MadgwickAHRS:
+        the earth z axis points up and the x axis points to the horizontal component of the field
+        :param accelerometer: A three-element accelerometer measurement taken at rest
+        :param magnetometer: A three-element magnetometer measurement; without it, or if it is zero
+                             (an uncalibrated LIS3MDL) or parallel to gravity, the yaw is 0 relative to the sensor
+        :return: Quaternion rotating the sensor frame into the earth frame
+        """
+        ax, ay, az = accelerometer
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if norm == 0:
+            raise ValueError("accelerometer is zero")
+        ux, uy, uz = ax / norm, ay / norm, az / norm
+        # Без магнитометра за север берём ось x датчика (ось y, если x вертикальна)
+        reference = (1.0, 0.0, 0.0) if abs(ux) < 0.9 else (0.0, 1.0, 0.0)
+        mx, my, mz = reference if magnetometer is None else magnetometer
+        # North: the field without its vertical component
+        dot = mx * ux + my * uy + mz * uz
+        nx, ny, nz = mx - dot * ux, my - dot * uy, mz - dot * uz
+        norm = sqrt(nx * nx + ny * ny + nz * nz)
+        if norm <= 1e-9 * sqrt(mx * mx + my * my + mz * mz):
+            warnings.warn("magnetometer is zero or parallel to the accelerometer, the yaw is set to 0")
+            mx, my, mz = reference
+            dot = mx * ux + my * uy + mz * uz
+            nx, ny, nz = mx - dot * ux, my - dot * uy, mz - dot * uz
+            norm = sqrt(nx * nx + ny * ny + nz * nz)
+        nx, ny, nz = nx / norm, ny / norm, nz / norm
+        # Rows of the rotation matrix are the earth axes in the sensor frame: north, up x north, up
+        wx, wy, wz = uy * nz - uz * ny, uz * nx - ux * nz, ux * ny - uy * nx
+        r = ((nx, ny, nz), (wx, wy, wz), (ux, uy, uz))
+        trace = r[0][0] + r[1][1] + r[2][2]
+        if trace > 0:
+            s = sqrt(trace + 1) * 2
+            q = (s / 4, (r[2][1] - r[1][2]) / s, (r[0][2] - r[2][0]) / s, (r[1][0] - r[0][1]) / s)
+        elif r[0][0] > r[1][1] and r[0][0] > r[2][2]:
+            s = sqrt(1 + r[0][0] - r[1][1] - r[2][2]) * 2
+            q = ((r[2][1] - r[1][2]) / s, s / 4, (r[0][1] + r[1][0]) / s, (r[0][2] + r[2][0]) / s)
+        elif r[1][1] > r[2][2]:
+            s = sqrt(1 + r[1][1] - r[0][0] - r[2][2]) * 2
+            q = ((r[0][2] - r[2][0]) / s, (r[0][1] + r[1][0]) / s, s / 4, (r[1][2] + r[2][1]) / s)
+        else:
+            s = sqrt(1 + r[2][2] - r[0][0] - r[1][1]) * 2
+            q = ((r[1][0] - r[0][1]) / s, (r[0][2] + r[2][0]) / s, (r[1][2] + r[2][1]) / s, s / 4)
+        return Quaternion(q[0], q[1], q[2], q[3])
+
     @property
     def get_euler_angles(self):
         pitch = asin(2 * self[1] * self[2] + 2 * self[0] * self[3])
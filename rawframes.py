@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Batch decoding of raw sensor frames
+# Turns concatenated little-endian output register blocks into numpy arrays without per-value Python work
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   frames = decode_xyz(gyro.read_fifo_frames())      # (N, 3) int16
+#   rad_s = gyro.convert_radians_per_second(frames)   # (N, 3) float
+
+import numpy as np
+
+# OUT_X_L OUT_X_H OUT_Y_L OUT_Y_H OUT_Z_L OUT_Z_H
+XYZ_FRAME = np.dtype('<i2')
+# PRESS_OUT_XL PRESS_OUT_L PRESS_OUT_H TEMP_OUT_L TEMP_OUT_H
+PRESSURE_TEMPERATURE_FRAME = np.dtype([('pressure', 'u1', (3,)), ('temperature', '<i2')])
+
+
+def as_buffer(values):
+    # smbus возвращает список байт, его приходится один раз упаковать;
+    # bytes, bytearray и memoryview используются как есть
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return values
+    return bytearray(values)
+
+
+def decode_xyz(values):
+    # (N, 3) int16 представление буфера, без копирования данных
+    return np.frombuffer(as_buffer(values), dtype=XYZ_FRAME).reshape(-1, 3)
+
+
+def decode_xyz_high(values):
+    # Кадры режима FAST_READ LIS3MDL (только старшие байты, 3 байта на замер) -> (N, 3) int16
+    # в той же шкале, что и полные 16-битные кадры
+    return np.frombuffer(as_buffer(values), dtype=np.int8).reshape(-1, 3).astype(np.int16) << 8
+
+
+def _join_pressure(data):
+    # 24-битное давление: PRESS_OUT_H & PRESS_OUT_L & PRESS_OUT_XL
+    data = data.astype(np.int32)
+    return data[:, 0] | data[:, 1] << 8 | data[:, 2] << 16
+
+
+def decode_pressure(values):
+    # Кадры read_pressure_raw по 3 байта -> (N,) int32
+    return _join_pressure(np.frombuffer(as_buffer(values), dtype=np.uint8).reshape(-1, 3))
+
+
+def decode_pressure_temperature(values):
+    # Кадры по 5 байт (давление и температура подряд) -> (N,) int32, (N,) int16
+    frames = np.frombuffer(as_buffer(values), dtype=PRESSURE_TEMPERATURE_FRAME)
+    return _join_pressure(frames['pressure']), frames['temperature']
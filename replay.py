@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Replay of recorded flight logs
+# Reproduces the driver outputs from raw flightlog records and feeds them to the same processing
+# as live data, as fast as possible or with the original timing.
+# Exception: without a magnetometer calibration the replay gives uncalibrated gauss (LIS3MDL.read_gauss_xyz),
+# while the live calibrated read with the default all-zero calibration matrix gives zeros
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   replay = Replay('flight.imu', calibration_matrix, bias)
+#   timestamps, quaternions = replay.run(MadgwickAHRS(beta=0.05))
+#
+# Подбор параметров по множеству записей в несколько процессов:
+#   results = run_files(paths, functools.partial(MadgwickAHRS, beta=0.05), calibration_matrix, bias)
+
+import multiprocessing
+import time
+import numpy as np
+from flightlog import FlightLogReader
+from l3g4200d import L3G4200D
+from lps331ap import LPS331AP
+from pytroykaimu import IMUSample
+
+
+class Replay(object):
+    sensors = ('gyroscope', 'accelerometer', 'magnetometer', 'barometer')
+
+    # calibration_matrix, bias - калибровка магнитометра, как в LIS3MDL.calibrate_matrix; с ней результат
+    # совпадает с read_new_calibrate_gauss_xyz. Без калибровки магнитометр выдаётся в гауссах без поправок,
+    # как read_gauss_xyz, а не нулями, как read_new_calibrate_gauss_xyz с нулевой матрицей по умолчанию
+    # measure - единицы давления, как в LPS331AP.read_new
+    def __init__(self, path, calibration_matrix=None, bias=None, measure=LPS331AP.DEFAULT_PRESSURE_MEASURE):
+        self.log = FlightLogReader(path)
+        self.calibration_matrix = calibration_matrix
+        self.bias = bias
+        self.measure = measure
+        self._values = None
+
+    def close(self):
+        self._values = None
+        self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Пересчёт повторяет операции драйверов в том же порядке, поэтому результат совпадает побитно
+    def _gyroscope(self, raw, mult):
+        # L3G4200D.read_new_radians_per_second_xyz: x * _mult * DEG_TO_RAD
+        return raw * mult * L3G4200D.DEG_TO_RAD
+
+    def _accelerometer(self, raw, mult):
+        # LIS331DLH.read_new_gxyz: x * _mult
+        return raw * mult
+
+    def _magnetometer(self, raw, mult):
+        if self.calibration_matrix is None:
+            # LIS3MDL.read_gauss_xyz: x / _mult (расхождение с живыми данными, см. __init__)
+            return raw / mult
+        # LIS3MDL.calibrate: сумма по j слева направо от нуля, затем деление на _mult
+        uncalibrated = raw.astype(np.float64) - np.asarray(self.bias, dtype=np.float64)
+        calibrated = np.zeros(uncalibrated.shape)
+        for i in range(0, 3):
+            for j in range(0, 3):
+                calibrated[:, i] += self.calibration_matrix[i][j] * uncalibrated[:, j]
+        return calibrated / mult
+
+    def _barometer(self, pressure, temperature):
+        # LPS331AP.read_new: давление / pressure_measure, температура / 480 + 42.5
+        measure = self.measure if self.measure in LPS331AP.pressure_measure else LPS331AP.DEFAULT_PRESSURE_MEASURE
+        return np.column_stack((pressure / LPS331AP.pressure_measure[measure], temperature / 480 + 42.5))
+
+    def values(self, name):
+        # Метки времени и выходы драйвера для всех замеров датчика: (N,), (N, 3) или (N, 2)
+        if self._values is None:
+            self._values = {}
+        if name not in self._values:
+            channel = self.log.channels[[c.name for c in self.log.channels].index(name)]
+            if name == 'barometer':
+                timestamps, pressure, temperature = self.log.channel(name)
+                self._values[name] = timestamps, self._barometer(pressure, temperature)
+            else:
+                timestamps, raw = self.log.channel(name)
+                self._values[name] = timestamps, getattr(self, '_' + name)(raw, channel.mult)
+        return self._values[name]
+
+    def _merged(self):
+        # Порядок замеров всех датчиков по времени: имена каналов, метки времени, номер канала и номер замера
+        names = [c.name for c in self.log.channels if c.name in self.sensors]
+        columns = [self.values(name) for name in names]
+        timestamps = np.concatenate([column[0] for column in columns])
+        order = np.argsort(timestamps, kind='stable')
+        sensor = np.concatenate([np.full(len(column[0]), i) for i, column in enumerate(columns)])[order]
+        index = np.concatenate([np.arange(len(column[0])) for column in columns])[order]
+        return names, columns, timestamps[order], sensor, index
+
+    def samples(self, realtime=False, speed=1.0):
+        # Замеры в порядке времени, как у AcquisitionScheduler.poll: (имя, метка времени нс, замер)
+        # realtime=True - выдавать с исходными интервалами (speed - ускорение)
+        names, columns, timestamps, sensor, index = self._merged()
+        sensor = sensor.tolist()
+        index = index.tolist()
+        rows = [column[1].tolist() for column in columns]
+        start = None
+        for i, timestamp in enumerate(timestamps.tolist()):
+            if realtime:
+                if start is None:
+                    start = (time.monotonic(), timestamp)
+                delay = start[0] + (timestamp - start[1]) * 1e-9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield names[sensor[i]], timestamp, tuple(rows[sensor[i]][index[i]])
+
+    def imu_samples(self, realtime=False, speed=1.0):
+        # IMUSample на каждый замер гироскопа с последними значениями остальных датчиков,
+        # как канал 'imu' в IMUStream
+        latest = {}
+        for name, timestamp, sample in self.samples(realtime, speed):
+            latest[name] = sample
+            if name == 'gyroscope' and 'accelerometer' in latest and 'magnetometer' in latest:
+                barometer = latest.get('barometer', (None, None))
+                yield IMUSample(timestamp, sample, latest['accelerometer'], latest['magnetometer'],
+                                barometer[0], barometer[1])
+
+    def aligned(self):
+        # То же, что imu_samples, массивами: метки времени замеров гироскопа (N,) и значения
+        # гироскопа, акселерометра и магнитометра на эти моменты (N, 3)
+        names, columns, timestamps, sensor, index = self._merged()
+        latest = {}
+        for name in ('accelerometer', 'magnetometer'):
+            # Номер последнего замера датчика к каждой позиции общего порядка (-1 - ещё не было)
+            own = sensor == names.index(name)
+            latest[name] = np.maximum.accumulate(np.where(own, index, -1))
+        gyroscope = (sensor == names.index('gyroscope')) & (latest['accelerometer'] >= 0) & \
+            (latest['magnetometer'] >= 0)
+        return (timestamps[gyroscope],
+                columns[names.index('gyroscope')][1][index[gyroscope]],
+                columns[names.index('accelerometer')][1][latest['accelerometer'][gyroscope]],
+                columns[names.index('magnetometer')][1][latest['magnetometer'][gyroscope]])
+
+    def run(self, ahrs, realtime=False, speed=1.0, magnetometer=True):
+        # Прогон фильтра ориентации по записи. Возвращает метки времени (N,) и кватернионы (N, 4).
+        # Фильтр с update_batch (MadgwickAHRS) без realtime считается одним вызовом,
+        # остальные (MahonyAHRS, EKFAHRS) - по замеру с метками времени, как с живыми данными
+        if not realtime and hasattr(ahrs, 'update_batch'):
+            return self._run_batch(ahrs, magnetometer)
+        timestamps = []
+        quaternions = []
+        for sample in self.imu_samples(realtime, speed):
+            if magnetometer:
+                ahrs.update(sample.gyro, sample.accel, sample.mag, timestamp=sample.timestamp)
+            else:
+                ahrs.update_imu(sample.gyro, sample.accel, timestamp=sample.timestamp)
+            timestamps.append(sample.timestamp)
+            quaternions.append(ahrs.quaternion.q)
+        return np.array(timestamps, dtype=np.int64), np.array(quaternions, dtype=np.float64).reshape(-1, 4)
+
+    def _run_batch(self, ahrs, magnetometer):
+        # Весь прогон одним вызовом update_batch; шаг по меткам времени считается как в step_period
+        timestamps, gyroscope, accelerometer, magnetometer_values = self.aligned()
+        previous = np.concatenate(([-1 if ahrs.timestamp is None else ahrs.timestamp], timestamps[:-1]))
+        dt = np.where((previous >= 0) & (timestamps > previous), (timestamps - previous) * 1e-9, ahrs.sample_period)
+        if magnetometer:
+            quaternions = ahrs.update_batch(gyroscope, accelerometer, magnetometer_values, dt)
+        else:
+            quaternions = ahrs.update_imu_batch(gyroscope, accelerometer, dt)
+        if len(timestamps):
+            ahrs.timestamp = int(timestamps[-1])
+        return timestamps, quaternions
+
+
+def _run_file(args):
+    path, ahrs_factory, calibration_matrix, bias, magnetometer = args
+    with Replay(path, calibration_matrix, bias) as replay:
+        return replay.run(ahrs_factory(), magnetometer=magnetometer)
+
+
+def run_files(paths, ahrs_factory, calibration_matrix=None, bias=None, magnetometer=True, processes=None):
+    # Прогон фильтра по нескольким записям в пуле процессов, по записи на задачу.
+    # ahrs_factory должна передаваться между процессами (класс, functools.partial и т.п.)
+    # Возвращает список (метки времени, кватернионы) в порядке paths
+    tasks = [(path, ahrs_factory, calibration_matrix, bias, magnetometer) for path in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_run_file, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
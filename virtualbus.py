@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+#
+# Virtual SMBus backend with register-level emulators of the TroykaIMU sensors
+# Allows running and benchmarking the drivers without Raspberry Pi hardware
+#
+# Copyright 2016 Seliverstov Dmitriy <selidimail@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+# Пример:
+#   bus = troyka_bus(speed=400000, overhead=0.00005)
+#   imu = TroykaIMU(bus=bus)
+#   imu.read_all()
+#   print(bus.transactions, bus.busy_time)
+
+import errno
+import time
+from collections import deque
+from math import sin, pi
+
+
+# Источники данных для эмуляторов
+# Источник - либо итерируемый объект (записанный поток замеров),
+# либо функция от времени замера в секундах
+def constant(*values):
+    def source(t):
+        return values
+    return source
+
+
+def sine(amplitude, frequency, offset=(0, 0, 0)):
+    def source(t):
+        return tuple(int(o + a * sin(2 * pi * frequency * t)) for a, o in zip(amplitude, offset))
+    return source
+
+
+class RegisterFile(object):
+    # Базовый эмулятор карты регистров датчика ST с автоинкрементом адреса по старшему биту
+    WHO_AM_I = 0x0F
+    STATUS_REG = 0x27
+    OUT_FIRST = 0x28
+    OUT_LAST = 0x2D
+
+    identity = 0x00
+    # Значения регистров после включения питания / программного сброса
+    defaults = {}
+    # Регистры только для чтения
+    read_only = ()
+    # STATUS_REG: ZYXDA и ZYXOR
+    data_ready_mask = 1 << 3
+    overrun_mask = 1 << 7
+
+    def __init__(self, source=None):
+        self.regs = bytearray(256)
+        self.reset()
+        self.set_source(source if source is not None else constant(0, 0, 0))
+        self._last_sample_time = None
+
+    def set_source(self, source):
+        if callable(source):
+            self._source = source
+            self._stream = None
+        else:
+            self._source = None
+            self._stream = iter(source)
+        self._sample = None
+
+    def reset(self):
+        self.regs[:] = bytes(256)
+        self.regs[self.WHO_AM_I] = self.identity
+        for reg, value in self.defaults.items():
+            self.regs[reg] = value
+
+    # Частота выдачи данных в Гц по текущим регистрам управления (0 - датчик выключен)
+    def output_data_rate(self):
+        return 0
+
+    def next_sample(self, t):
+        if self._source is not None:
+            self._sample = self._source(t)
+        else:
+            # Записанный поток: по окончании повторяем последний замер
+            self._sample = next(self._stream, self._sample)
+        return self._sample
+
+    def store_sample(self, sample):
+        for i, value in enumerate(sample):
+            self.regs[self.OUT_FIRST + 2 * i] = value & 0xff
+            self.regs[self.OUT_FIRST + 2 * i + 1] = (value >> 8) & 0xff
+
+    def tick(self, now):
+        # Выдаём все замеры, которые датчик успел сделать к моменту now
+        odr = self.output_data_rate()
+        if odr <= 0:
+            self._last_sample_time = None
+            return
+        if self._last_sample_time is None:
+            self._last_sample_time = now
+            return
+        period = 1.0 / odr
+        count = int((now - self._last_sample_time) / period)
+        for i in range(count):
+            self._last_sample_time += period
+            self.new_sample(self.next_sample(self._last_sample_time))
+
+    def new_sample(self, sample):
+        status = self.regs[self.STATUS_REG]
+        if status & self.data_ready_mask:
+            status |= self.overrun_mask
+        self.regs[self.STATUS_REG] = status | self.data_ready_mask
+        self.store_sample(sample)
+
+    def read(self, reg):
+        value = self.regs[reg]
+        self.after_read(reg)
+        return value
+
+    def after_read(self, reg):
+        # Чтение старшего байта оси Z означает, что замер забран
+        if reg == self.OUT_LAST:
+            self.regs[self.STATUS_REG] &= ~(self.data_ready_mask | self.overrun_mask) & 0xff
+
+    def next_address(self, reg):
+        return (reg + 1) & 0x7f
+
+    def write(self, reg, value):
+        if reg == self.WHO_AM_I or reg in self.read_only:
+            return
+        self.regs[reg] = value & 0xff
+        self.after_write(reg)
+
+    def after_write(self, reg):
+        pass
+
+    def write_at(self, reg, value, now):
+        # Запись с временем шины now, с: эмуляторы с запускаемыми записью процессами
+        # (например, преобразование ONE SHOT) переопределяют этот метод
+        self.write(reg, value)
+
+
+class LIS331DLHRegisters(RegisterFile):
+    identity = 0x32
+    defaults = {0x20: 0x07}
+    read_only = (0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x31, 0x35)
+
+    def __init__(self, source=None):
+        # По умолчанию датчик лежит горизонтально: 1g по оси Z в диапазоне 2G
+        RegisterFile.__init__(self, source if source is not None else constant(0, 0, 16384))
+
+    def output_data_rate(self):
+        ctrl1 = self.regs[0x20]
+        power_mode = ctrl1 >> 5
+        if power_mode == 0:
+            return 0
+        if power_mode == 1:
+            return (50, 100, 400, 1000)[(ctrl1 >> 3) & 0x3]
+        return (0.5, 1, 2, 5, 10)[min(power_mode - 2, 4)]
+
+    def after_write(self, reg):
+        # BOOT сбрасывается аппаратно
+        if reg == 0x21:
+            self.regs[0x21] &= 0x7f
+
+
+class L3G4200DRegisters(RegisterFile):
+    identity = 0xD3
+    defaults = {0x20: 0x07}
+    read_only = (0x26, 0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x2F, 0x31)
+    FIFO_SIZE = 32
+
+    def __init__(self, source=None):
+        self.fifo = deque(maxlen=self.FIFO_SIZE)
+        RegisterFile.__init__(self, source)
+
+    def reset(self):
+        RegisterFile.reset(self)
+        self.fifo.clear()
+
+    def output_data_rate(self):
+        ctrl1 = self.regs[0x20]
+        if not ctrl1 & (1 << 3):
+            return 0
+        return (100, 200, 400, 800)[ctrl1 >> 6]
+
+    def fifo_active(self):
+        return self.regs[0x24] & (1 << 6) and self.regs[0x2E] >> 5
+
+    def new_sample(self, sample):
+        if not self.fifo_active():
+            RegisterFile.new_sample(self, sample)
+            return
+        mode = self.regs[0x2E] >> 5
+        if len(self.fifo) == self.FIFO_SIZE and mode == 0b001:
+            # FIFO mode: после заполнения новые данные не принимаются
+            return
+        self.fifo.append(sample)
+        # Выходные регистры показывают самый старый замер в FIFO
+        self.store_sample(self.fifo[0])
+        self.regs[self.STATUS_REG] |= self.data_ready_mask
+
+    def read(self, reg):
+        if reg == 0x2F:
+            level = len(self.fifo)
+            source = min(level, 31)
+            if level == 0:
+                source |= 1 << 5
+            if level == self.FIFO_SIZE:
+                source |= 1 << 6
+            return source
+        return RegisterFile.read(self, reg)
+
+    def after_read(self, reg):
+        if reg == self.OUT_LAST and self.fifo_active():
+            if self.fifo:
+                self.fifo.popleft()
+            if self.fifo:
+                self.store_sample(self.fifo[0])
+            else:
+                self.regs[self.STATUS_REG] = 0
+            return
+        RegisterFile.after_read(self, reg)
+
+    def next_address(self, reg):
+        # При включенном FIFO после OUT_Z_H адрес возвращается на OUT_X_L
+        if reg == self.OUT_LAST and self.fifo_active():
+            return self.OUT_FIRST
+        return RegisterFile.next_address(self, reg)
+
+    def after_write(self, reg):
+        if reg == 0x24:
+            self.regs[0x24] &= 0x7f
+        if reg in (0x24, 0x2E) and not self.fifo_active():
+            self.fifo.clear()
+
+
+class LIS3MDLRegisters(RegisterFile):
+    identity = 0x3D
+    defaults = {0x20: 0x10, 0x22: 0x03}
+    read_only = (0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x2E, 0x2F, 0x31)
+
+    def __init__(self, source=None):
+        # По умолчанию поле около 0.5 Гаусс с наклонением вниз в диапазоне 4 Гаусс
+        RegisterFile.__init__(self, source if source is not None else constant(1500, 0, -3000))
+
+    def reset(self):
+        RegisterFile.reset(self)
+        # TEMP_OUT: 25 C
+        self.regs[0x2E] = 0
+        self.regs[0x2F] = 0
+
+    def output_data_rate(self):
+        ctrl1 = self.regs[0x20]
+        ctrl3 = self.regs[0x22]
+        if ctrl3 & 0x3 != 0:
+            return 0
+        if ctrl3 & (1 << 5):
+            return 0.625
+        if ctrl1 & (1 << 1):
+            return (1000, 560, 300, 155)[(ctrl1 >> 5) & 0x3]
+        return (0.625, 1.25, 2.5, 5, 10, 20, 40, 80)[(ctrl1 >> 2) & 0x7]
+
+    def after_write(self, reg):
+        if reg == 0x21:
+            if self.regs[0x21] & (1 << 2):
+                # SOFT_RST: регистры конфигурации по умолчанию
+                self.reset()
+            self.regs[0x21] &= ~((1 << 3) | (1 << 2)) & 0xff
+        if reg == 0x22 and self.regs[0x22] & 0x3 == 0x1:
+            # Single-conversion mode: один замер и переход в power-down
+            self.new_sample(self.next_sample(self._last_sample_time or 0))
+            self.regs[0x22] |= 0x3
+
+    def next_address(self, reg):
+        # FAST_READ: автоинкремент только по старшим байтам
+        if self.regs[0x24] & (1 << 7) and reg in (0x29, 0x2B):
+            return reg + 2
+        return RegisterFile.next_address(self, reg)
+
+
+class LPS331APRegisters(RegisterFile):
+    identity = 0xBB
+    defaults = {0x10: 0x7A}
+    read_only = (0x24, 0x27, 0x28, 0x29, 0x2A, 0x2B, 0x2C)
+    # STATUS_REG: P_DA T_DA, P_OR T_OR
+    data_ready_mask = (1 << 1) | (1 << 0)
+    overrun_mask = (1 << 5) | (1 << 4)
+    PRESS_OUT_H = 0x2A
+    TEMP_OUT_H = 0x2C
+    # Время преобразования в режиме ONE SHOT, с
+    conversion_time = 0.04
+
+    def __init__(self, source=None):
+        self._conversion_done = None
+        RegisterFile.__init__(self, source if source is not None else constant(1013 * 4096, 0))
+
+    def output_data_rate(self):
+        ctrl1 = self.regs[0x20]
+        if not ctrl1 & (1 << 7):
+            return 0
+        return (0, 1, 7, 12.5, 25, 7, 12.5, 25)[(ctrl1 >> 4) & 0x7]
+
+    def store_sample(self, sample):
+        pressure, temperature = sample
+        self.regs[0x28] = pressure & 0xff
+        self.regs[0x29] = (pressure >> 8) & 0xff
+        self.regs[0x2A] = (pressure >> 16) & 0xff
+        self.regs[0x2B] = temperature & 0xff
+        self.regs[0x2C] = (temperature >> 8) & 0xff
+
+    def tick(self, now):
+        if self._conversion_done is not None and now >= self._conversion_done:
+            self._conversion_done = None
+            self.regs[0x21] &= ~0x1 & 0xff
+            self.new_sample(self.next_sample(now))
+        RegisterFile.tick(self, now)
+
+    def after_read(self, reg):
+        if reg == self.PRESS_OUT_H:
+            self.regs[self.STATUS_REG] &= ~((1 << 1) | (1 << 5)) & 0xff
+        elif reg == self.TEMP_OUT_H:
+            self.regs[self.STATUS_REG] &= ~((1 << 0) | (1 << 4)) & 0xff
+
+    def write_at(self, reg, value, now):
+        # ONE_SHOT в CTRL_REG2 запускает преобразование, результат готов через conversion_time
+        self.write(reg, value)
+        if reg == 0x21 and value & 0x1 and self.regs[0x20] & (1 << 7):
+            self._conversion_done = now + self.conversion_time
+
+    def after_write(self, reg):
+        if reg == 0x21:
+            if self.regs[0x21] & (1 << 2):
+                self.reset()
+            self.regs[0x21] &= ~((1 << 7) | (1 << 2)) & 0xff
+
+
+class VirtualSMBus(object):
+    # Эмулятор шины с интерфейсом smbus.SMBus
+    # speed    - частота шины, Гц (100000 или 400000)
+    # overhead - накладные расходы на одну транзакцию (системный вызов, драйвер), с
+    # realtime - True: реально ждать время транзакции; False: только учитывать его в часах шины
+    def __init__(self, speed=400000, overhead=0.0, realtime=False):
+        self.speed = speed
+        self.overhead = overhead
+        self.realtime = realtime
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self._start = time.monotonic()
+
+    def attach(self, address, device):
+        self.devices[address] = device
+        return device
+
+    # Часы шины, с: реальное время плюс учтённое время транзакций
+    def now(self):
+        if self.realtime:
+            return time.monotonic() - self._start
+        return time.monotonic() - self._start + self.busy_time
+
+    def transaction_time(self, bus_bytes, starts=1):
+        # 9 тактов на байт (8 бит + ACK) и 2 такта на START/STOP
+        return self.overhead + (bus_bytes * 9 + starts * 2) / float(self.speed)
+
+    def _transfer(self, bus_bytes, starts=1):
+        latency = self.transaction_time(bus_bytes, starts)
+        self.transactions += 1
+        self.bytes += bus_bytes
+        if self.realtime:
+            deadline = time.monotonic() + latency
+            while time.monotonic() < deadline:
+                pass
+        self.busy_time += latency
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise IOError(errno.EREMOTEIO, 'Remote I/O error')
+        device.tick(self.now())
+        return device
+
+    def _read(self, device, reg, length):
+        auto_increment = reg & (1 << 7)
+        reg &= 0x7f
+        values = []
+        for i in range(length):
+            values.append(device.read(reg))
+            if auto_increment:
+                reg = device.next_address(reg)
+        return values
+
+    def _write(self, device, reg, values):
+        auto_increment = reg & (1 << 7)
+        reg &= 0x7f
+        for value in values:
+            device.write_at(reg, value, self.now())
+            if auto_increment:
+                reg = device.next_address(reg)
+
+    # smbus.SMBus interface
+    def read_byte_data(self, address, reg):
+        device = self._device(address)
+        self._transfer(4, starts=2)
+        return self._read(device, reg, 1)[0]
+
+    def read_word_data(self, address, reg):
+        device = self._device(address)
+        self._transfer(5, starts=2)
+        values = self._read(device, reg, 2)
+        return values[1] << 8 | values[0]
+
+    def read_i2c_block_data(self, address, reg, length=32):
+        device = self._device(address)
+        self._transfer(3 + length, starts=2)
+        return self._read(device, reg, length)
+
+    def write_byte_data(self, address, reg, value):
+        device = self._device(address)
+        self._transfer(3)
+        self._write(device, reg, [value])
+
+    def write_i2c_block_data(self, address, reg, values):
+        device = self._device(address)
+        self._transfer(2 + len(values))
+        self._write(device, reg, values)
+
+    # smbus2.SMBus.i2c_rdwr: все сообщения одной транзакцией
+    def i2c_rdwr(self, *messages):
+        bus_bytes = sum(1 + message.len for message in messages)
+        self._transfer(bus_bytes, starts=len(messages))
+        reg = {}
+        for message in messages:
+            device = self._device(message.addr)
+            if message.flags & 0x1:
+                values = self._read(device, reg.get(message.addr, 0), message.len)
+                for i, value in enumerate(values):
+                    message.buf[i] = bytes((value,))
+            else:
+                data = list(message)
+                reg[message.addr] = data[0]
+                if len(data) > 1:
+                    self._write(device, data[0], data[1:])
+
+    def close(self):
+        pass
+
+
+def troyka_bus(gyro=None, accel=None, mag=None, baro=None, **kwargs):
+    # Виртуальная шина со всеми датчиками TroykaIMU по адресам по умолчанию
+    bus = VirtualSMBus(**kwargs)
+    bus.attach(0b0011000, LIS331DLHRegisters(accel))
+    bus.attach(0b1101000, L3G4200DRegisters(gyro))
+    bus.attach(0b0011100, LIS3MDLRegisters(mag))
+    bus.attach(0b1011100, LPS331APRegisters(baro))
+    return bus